@@ -1,5 +1,28 @@
+import os
+
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def prepare_shared_dir(path):
+    """Создаёт каталог общих файлов процессов, закрытый для других.
+
+    Кэши в нём читаются через pickle: каталог, который создал или может
+    менять другой пользователь, использовать нельзя.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if (not os.path.isdir(path) or os.path.islink(path)
+            or info.st_uid != os.getuid() or info.st_mode & 0o077):
+        raise ImproperlyConfigured(
+            f'Каталог {path} должен принадлежать пользователю приложения '
+            f'и быть закрыт для остальных (0700).')
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        prepare_shared_dir(settings.SHARED_MEMORY_DIR)
@@ -0,0 +1,73 @@
+"""Аутентификация по токену с кэшем пользователей.
+
+Токен вместе с пользователем кладётся в кэш tokens: время жизни и число
+записей задают TIMEOUT и MAX_ENTRIES этого кэша. Рядом с записью хранится
+поколение токена; запись действительна, только пока её поколение совпадает
+с текущим. При выходе, смене пароля, деактивации и удалении пользователя
+поколение меняется. Запрос, прочитавший токен из базы до отзыва, запомнил
+старое поколение, поэтому его запись уже не подойдёт, даже если бэкенд
+выполняет add не атомарно или вытеснил часть ключей: без поколения или
+записи токен просто читается из базы.
+"""
+import hashlib
+import uuid
+
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.authentication import TokenAuthentication
+
+CACHE_ALIAS = 'tokens'
+
+
+def _cache():
+    return caches[CACHE_ALIAS]
+
+
+def _keys(token_key):
+    # сами токены в общем кэше не хранятся
+    digest = hashlib.sha256(token_key.encode()).hexdigest()
+    return f'token:{digest}', f'token-generation:{digest}'
+
+
+def _new_generations(keys):
+    _cache().set_many({
+        generation_key: uuid.uuid4().hex for _, generation_key in keys})
+
+
+def revoke(token_keys):
+    """Делает записи токенов недействительными.
+
+    Поколение меняется и сразу, и после фиксации транзакции: запрос,
+    который успел прочитать ещё не удалённый токен, закэширует его со
+    старым поколением.
+    """
+    keys = [_keys(token_key) for token_key in token_keys]
+    if not keys:
+        return
+    _new_generations(keys)
+    _cache().delete_many([entry_key for entry_key, _ in keys])
+    transaction.on_commit(lambda: _new_generations(keys))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication без запроса к базе для известного токена."""
+
+    def authenticate_credentials(self, key):
+        cache = _cache()
+        entry_key, generation_key = _keys(key)
+        values = cache.get_many([entry_key, generation_key])
+        generation = values.get(generation_key)
+        cached = values.get(entry_key)
+        if (cached is not None and generation is not None
+                and cached[0] == generation):
+            token = cached[1]
+            return token.user, token
+        if generation is None:
+            generation = uuid.uuid4().hex
+            if not cache.add(generation_key, generation):
+                generation = cache.get(generation_key)
+        # поколение прочитано до базы: отзыв после этого момента его сменит
+        user, token = super().authenticate_credentials(key)
+        if generation is not None:
+            cache.set(entry_key, (generation, token))
+        return user, token
@@ -0,0 +1,126 @@
+"""Автодополнение ингредиентов в памяти процесса.
+
+Названия ингредиентов хранятся в отсортированных списках, поиск идёт
+бинарным поиском, поэтому ввод в строке поиска не обращается к базе.
+Регистр и буквы «ё»/«е» не различаются. Сначала идут совпадения с начала
+названия, за ними — совпадения с начала любого следующего слова, а если
+их меньше предела — вхождения в любом месте названия, как у прежнего
+поиска по name__icontains.
+"""
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple
+
+from django.conf import settings
+
+from recipes.models import Ingredient
+
+from .models import ChangeCounter
+
+VERSION_KEY = 'ingredients'
+WORD_START = re.compile(r'(?<=[\s\-(,.])\w')
+
+IndexState = namedtuple(
+    'IndexState',
+    'version modified items names prefix_keys prefix_refs word_keys '
+    'word_refs')
+
+
+def normalize(value):
+    return value.casefold().replace('ё', 'е')
+
+
+class IngredientIndex:
+    """Префиксный индекс ингредиентов.
+
+    Индекс перестраивается, если ингредиенты менялись в этом процессе, а
+    изменения из других процессов замечает по счётчику изменений, который
+    читает не чаще, чем раз в INGREDIENT_INDEX_CHECK_INTERVAL секунд.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None
+        self._dirty = True
+        self._checked = 0.0
+
+    def invalidate(self):
+        self._dirty = True
+
+    def _build(self):
+        # версию читаем до данных: если ингредиенты изменятся в промежутке,
+        # следующая проверка увидит новую версию и перестроит индекс
+        version, modified = ChangeCounter.get_versions(
+            VERSION_KEY)[VERSION_KEY]
+        items = [
+            {'id': pk, 'name': name, 'measurement_unit': unit}
+            for pk, name, unit in Ingredient.objects.order_by(
+                'id').values_list(
+                'id', 'name', 'measurement_unit').iterator()]
+        names = [normalize(item['name']) for item in items]
+        prefix, words = [], []
+        for ref, name in enumerate(names):
+            prefix.append((name, ref))
+            words.extend(
+                (name[match.start():], ref)
+                for match in WORD_START.finditer(name))
+        prefix.sort()
+        words.sort()
+        return IndexState(
+            version, modified, items, names,
+            [key for key, _ in prefix], [ref for _, ref in prefix],
+            [key for key, _ in words], [ref for _, ref in words])
+
+    def get_state(self):
+        now = time.monotonic()
+        state = self._state
+        if state is not None and not self._dirty:
+            if now - self._checked < settings.INGREDIENT_INDEX_CHECK_INTERVAL:
+                return state
+            self._checked = now
+            version, _ = ChangeCounter.get_versions(VERSION_KEY)[VERSION_KEY]
+            if version == state.version:
+                return state
+        with self._lock:
+            if self._state is state:
+                self._dirty = False
+                self._state = self._build()
+                self._checked = now
+            return self._state
+
+    def search(self, query, limit=None, state=None):
+        """Ищет ингредиенты по началу названия, слова и по вхождению.
+
+        state — уже проверенное состояние индекса, чтобы не читать версию
+        повторно.
+        """
+        state = state or self.get_state()
+        if limit is None:
+            limit = len(state.items)
+        query = normalize(query.strip())
+        if not query:
+            return state.items[:limit]
+        results, seen = [], set()
+        for keys, refs in ((state.prefix_keys, state.prefix_refs),
+                           (state.word_keys, state.word_refs)):
+            for position in range(bisect_left(keys, query), len(keys)):
+                if len(results) >= limit or not keys[position].startswith(
+                        query):
+                    break
+                ref = refs[position]
+                if ref not in seen:
+                    seen.add(ref)
+                    results.append(state.items[ref])
+        # вхождения в середину слова — полным проходом, только если
+        # совпадений с начала не хватило до предела
+        for ref, name in enumerate(state.names):
+            if len(results) >= limit:
+                break
+            if ref not in seen and query in name:
+                results.append(state.items[ref])
+        return results
+
+
+ingredient_index = IngredientIndex()
@@ -0,0 +1,170 @@
+"""Кэш ответов для анонимных запросов списка рецептов и рецепта.
+
+Каждая запись помнит версии ключей-зависимостей: рецептов, попавших в ответ,
+и состава выборки (все рецепты, рецепты автора, рецепты с тегом). Изменение
+рецепта увеличивает версии только своих ключей, и при чтении устаревшими
+оказываются лишь записи, которые могли его содержать.
+
+Версии хранятся в ChangeCounter, то есть в базе, и общие для всех
+процессов; версии рецептов — это те же счётчики recipe:<id>, что и у ETag.
+Сами записи могут лежать в памяти процесса: запись, которую изменение
+сделало устаревшей, не отдаётся ни одним процессом.
+
+Счётчики в ответе (избранного, рецептов и подписчиков автора) и порядок по
+оценкам меняются без смены версий выборок, поэтому запись живёт не дольше
+RECIPE_COUNTERS_TTL секунд, а ETag рецептов сменяется с тем же периодом,
+см. counters_epoch.
+
+Счётчики попаданий, промахов и вытеснений — в файле общей памяти, их видят
+все процессы и команда response_cache_stats.
+
+Запись кэша видят все, поэтому и версии, и сам ответ читаются с основной
+базы: ответ, собранный по отстающей реплике, остался бы в кэше и после
+того, как реплика догонит основную базу.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from rest_framework.response import Response
+
+from .models import ChangeCounter
+from .replicas import primary
+from .throttling import SharedCounters
+
+CACHE_ALIAS = 'responses'
+# параметры, от которых зависит ответ; остальные в ключ не попадают
+LIST_PARAMS = ('author', 'cursor', 'limit', 'ordering', 'page', 'search',
+               'tags')
+# фильтры по флагам пользователя анонимам не кэшируются
+USER_PARAMS = ('is_favorited', 'is_in_shopping_cart')
+STATS = ('hits', 'misses', 'evictions')
+# порядок по оценкам: и зависимость записей, и версия ETag таких списков
+SCORES_KEY = 'list:scores'
+
+
+def _cache():
+    return caches[CACHE_ALIAS]
+
+
+counters = SharedCounters(settings.RESPONSE_CACHE_STATS_PATH)
+
+
+def _incr(name):
+    counters.count(name)
+
+
+def stats():
+    values = counters.counters()
+    return {name: values.get(name, 0) for name in STATS}
+
+
+def invalidate(*deps):
+    """Делает устаревшими записи, зависящие от ключей deps."""
+    ChangeCounter.bump(*deps)
+
+
+def membership_deps(author_id, tag_slugs, everything=True):
+    """Выборки, в которые рецепт мог войти или из которых выйти."""
+    # результаты поиска зависят и от названия и описания рецепта
+    deps = [f'list:tag:{slug}' for slug in tag_slugs] + ['list:search']
+    if everything:
+        deps += ['list:all', f'list:author:{author_id}']
+    return deps
+
+
+def invalidate_membership(author_id, tag_slugs, everything=True):
+    invalidate(*membership_deps(author_id, tag_slugs, everything))
+
+
+def counters_epoch():
+    """Номер интервала RECIPE_COUNTERS_TTL, общий для всех процессов."""
+    return int(time.time() // settings.RECIPE_COUNTERS_TTL)
+
+
+def _dep_versions(deps):
+    return {
+        key: version for key, (version, _)
+        in ChangeCounter.get_versions(*deps).items()}
+
+
+def _normalized_key(view, request):
+    params = request.query_params
+    parts = [request.get_host(), view.basename, view.action]
+    parts += [f'{name}={value}' for name, value in view.kwargs.items()]
+    for name in LIST_PARAMS:
+        values = sorted(set(params.getlist(name)))
+        if values:
+            parts.append(f'{name}={",".join(values)}')
+    return 'response:' + hashlib.md5('|'.join(parts).encode()).hexdigest()
+
+
+def _membership_deps(request):
+    params = request.query_params
+    deps = [f'list:tag:{slug}' for slug in set(params.getlist('tags'))]
+    if deps:
+        deps.append('list:tags')
+    author = params.get('author')
+    if author:
+        deps.append(f'list:author:{author}')
+    if params.get('search'):
+        deps.append('list:search')
+    deps = deps or ['list:all']
+    # порядок по оценкам меняется при их пересчёте
+    if params.get('ordering'):
+        deps.append(SCORES_KEY)
+    return deps
+
+
+def _recipe_ids(data):
+    if isinstance(data, dict) and 'results' in data:
+        data = data['results']
+    if isinstance(data, dict):
+        data = [data]
+    return [item['id'] for item in data]
+
+
+def cached_response(view, handler, request, *args, **kwargs):
+    """Отдаёт ответ анонимному пользователю из кэша или кэширует его."""
+    params = request.query_params
+    if (request.user.is_authenticated
+            or any(name in params for name in USER_PARAMS)):
+        return handler(request, *args, **kwargs)
+    with primary():
+        return _cached_response(view, handler, request, *args, **kwargs)
+
+
+def _cached_response(view, handler, request, *args, **kwargs):
+    cache = _cache()
+    key = _normalized_key(view, request)
+    entry = cache.get(key)
+    if entry is not None:
+        if (entry['expires'] > time.time()
+                and _dep_versions(entry['deps']) == entry['versions']):
+            _incr('hits')
+            return Response(entry['data'])
+        cache.delete(key)
+        _incr('evictions')
+    _incr('misses')
+
+    started = timezone.now()
+    response = handler(request, *args, **kwargs)
+    if response.status_code == 200:
+        deps = [f'recipe:{recipe_id}'
+                for recipe_id in _recipe_ids(response.data)]
+        if view.action == 'list':
+            deps += _membership_deps(request)
+        versions = ChangeCounter.get_versions(*deps)
+        # данные изменились, пока строился ответ, — такой ответ не кэшируем
+        if all(modified is None or modified < started
+               for _, modified in versions.values()):
+            cache.set(key, {
+                'expires': time.time() + settings.RECIPE_COUNTERS_TTL,
+                'data': response.data,
+                'deps': deps,
+                'versions': {
+                    dep: version for dep, (version, _) in versions.items()},
+            })
+    return response
@@ -0,0 +1,65 @@
+"""Денормализованные счётчики: рецепты и подписчики автора, избранное рецепта.
+
+Счётчик меняется на разницу выражением F() в той же транзакции, что и связь,
+поэтому параллельные запросы не теряют изменений. Команда recount_counters
+пересчитывает счётчики и исправляет расхождения.
+"""
+from collections import Counter, defaultdict
+
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from recipes.models import Favorite, Follow, Recipe
+from users.models import User
+
+# модель связи: (поле связи, модель со счётчиком, поле счётчика)
+COUNTERS = {
+    Recipe: ('author', User, 'recipes_count'),
+    Follow: ('author', User, 'followers_count'),
+    Favorite: ('recipe', Recipe, 'favorites_count'),
+}
+
+
+def change(sender, deltas):
+    """Применяет разницы {id: разница} к счётчику связей модели sender."""
+    _, model, field = COUNTERS[sender]
+    grouped = defaultdict(list)
+    for pk, delta in deltas.items():
+        if delta:
+            grouped[delta].append(pk)
+    # одно обновление на каждое значение разницы
+    for delta, ids in grouped.items():
+        value = F(field) + delta
+        if delta < 0:
+            value = Greatest(value, 0)
+        model.objects.filter(id__in=ids).update(**{field: value})
+
+
+def added(sender, instances, sign=1):
+    """Учитывает созданные (sign=1) или удалённые (sign=-1) связи."""
+    link = COUNTERS[sender][0] + '_id'
+    change(sender, {
+        pk: sign * total for pk, total in Counter(
+            getattr(instance, link) for instance in instances).items()})
+
+
+def actual_count(sender):
+    link, _, _ = COUNTERS[sender]
+    return Coalesce(Subquery(sender.objects.filter(
+        **{link: OuterRef('pk')}).order_by().values(link).annotate(
+        total=Count('*')).values('total')), 0)
+
+
+def drift(sender):
+    """Строки (id, в счётчике, на самом деле) с расхождениями."""
+    _, model, field = COUNTERS[sender]
+    return model.objects.annotate(actual=actual_count(sender)).exclude(
+        **{field: F('actual')}).order_by('id').values_list(
+        'id', field, 'actual')
+
+
+def recount(sender, ids):
+    """Пересчитывает счётчик у объектов ids."""
+    _, model, field = COUNTERS[sender]
+    return model.objects.filter(id__in=ids).update(
+        **{field: actual_count(sender)})
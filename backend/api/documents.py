@@ -0,0 +1,146 @@
+"""Денормализованные документы рецептов.
+
+В документе хранится готовое представление рецепта без полей, которые
+зависят от текущего пользователя. При чтении к документу добавляются только
+эти флаги, поэтому список рецептов собирается из одной таблицы.
+"""
+from django.db.models import Prefetch
+
+from recipes.models import (Favorite, Follow, IngredientRecipe, Recipe,
+                            ShoppingCart, TagRecipe)
+from users.models import User
+
+from .models import ChangeCounter
+from .serializers import (MyUserSerializer, ReadIngredientRecipeSerializer,
+                          ReadRecipeSerializer, ReadTagRecipeSerializer)
+
+USER_FLAGS = ('is_favorited', 'is_in_shopping_cart', 'is_subscribed')
+# счётчики меняются чаще документа и берутся из строк рецепта и автора
+COUNTERS = ('favorites_count',)
+AUTHOR_COUNTERS = ('recipes_count', 'followers_count')
+# поля автора, которые хранятся в документе
+AUTHOR_FIELDS = tuple(
+    field for field in MyUserSerializer.Meta.fields
+    if field not in USER_FLAGS + AUTHOR_COUNTERS)
+
+
+def document_queryset():
+    """Рецепты со всем, что нужно для построения документа."""
+    return Recipe.objects.select_related('author').prefetch_related(
+        Prefetch('tag_recipe',
+                 queryset=TagRecipe.objects.select_related('tags')),
+        Prefetch('recipe',
+                 queryset=IngredientRecipe.objects.select_related(
+                     'ingredients')))
+
+
+def build_document(recipe):
+    data = ReadRecipeSerializer(recipe).data
+    document = {
+        field: value for field, value in data.items()
+        if field not in USER_FLAGS + COUNTERS
+    }
+    document['author'] = {
+        field: data['author'][field] for field in AUTHOR_FIELDS}
+    document['tags'] = [dict(tag) for tag in data['tags']]
+    document['ingredients'] = [
+        dict(ingredient) for ingredient in data['ingredients']]
+    return document
+
+
+def refresh_documents(recipe_ids):
+    """Пересобирает документы рецептов и возвращает их по id."""
+    recipes = list(document_queryset().filter(id__in=recipe_ids))
+    for recipe in recipes:
+        recipe.document = build_document(recipe)
+    Recipe.objects.bulk_update(recipes, ('document',))
+    if recipes:
+        # recipe:<id> — и версия ETag, и зависимость кэша ответов
+        ChangeCounter.bump(
+            'recipes', *(f'recipe:{recipe.id}' for recipe in recipes))
+    return {recipe.id: recipe.document for recipe in recipes}
+
+
+def _ordered(data, fields):
+    return {field: data.get(field) for field in fields}
+
+
+def render_document(document, request=None, is_favorited=False,
+                    is_in_shopping_cart=False, is_subscribed=False,
+                    favorites_count=0, author_counters=None):
+    """Собирает ответ ReadRecipeSerializer из документа, флагов и счётчиков.
+    """
+    data = _ordered(document, ReadRecipeSerializer.Meta.fields)
+    data['is_favorited'] = is_favorited
+    data['is_in_shopping_cart'] = is_in_shopping_cart
+    data['is_subscribed'] = is_subscribed
+    data['favorites_count'] = favorites_count
+    data['author'] = _ordered(document['author'], MyUserSerializer.Meta.fields)
+    data['author']['is_subscribed'] = is_subscribed
+    data['author'].update(author_counters or {})
+    data['tags'] = [
+        _ordered(tag, ReadTagRecipeSerializer.Meta.fields)
+        for tag in document['tags']]
+    data['ingredients'] = [
+        _ordered(ingredient, ReadIngredientRecipeSerializer.Meta.fields)
+        for ingredient in document['ingredients']]
+    if request is not None:
+        if data['image']:
+            data['image'] = request.build_absolute_uri(data['image'])
+        data['image_variants'] = {
+            variant: url and request.build_absolute_uri(url)
+            for variant, url in (data['image_variants'] or {}).items()}
+    return data
+
+
+def resolve_user_flags(recipes, user):
+    """Флаги пользователя для страницы рецептов: по запросу на связь.
+
+    Возвращает множества id избранных рецептов, рецептов в списке покупок и
+    авторов, на которых пользователь подписан.
+    """
+    if user is None or not user.is_authenticated or not recipes:
+        return set(), set(), set()
+    recipe_ids = [recipe.id for recipe in recipes]
+    author_ids = {recipe.author_id for recipe in recipes}
+    favorited = Favorite.objects.filter(
+        user=user, recipe_id__in=recipe_ids).values_list(
+        'recipe_id', flat=True)
+    in_shopping_cart = ShoppingCart.objects.filter(
+        user=user, recipe_id__in=recipe_ids).values_list(
+        'recipe_id', flat=True)
+    subscribed = Follow.objects.filter(
+        user=user, author_id__in=author_ids).values_list(
+        'author_id', flat=True)
+    return set(favorited), set(in_shopping_cart), set(subscribed)
+
+
+def author_counters(recipes):
+    """Счётчики авторов страницы рецептов одним запросом."""
+    author_ids = {recipe.author_id for recipe in recipes}
+    if not author_ids:
+        return {}
+    return {
+        author_id: dict(zip(AUTHOR_COUNTERS, counters))
+        for author_id, *counters in User.objects.filter(
+            id__in=author_ids).values_list('id', *AUTHOR_COUNTERS)}
+
+
+def render_recipes(recipes, request=None):
+    """Представление списка рецептов; недостающие документы строятся."""
+    recipes = list(recipes)
+    missing = [recipe.id for recipe in recipes if not recipe.document]
+    documents = refresh_documents(missing) if missing else {}
+    favorited, in_shopping_cart, subscribed = resolve_user_flags(
+        recipes, getattr(request, 'user', None))
+    counters = author_counters(recipes)
+    return [
+        render_document(
+            documents.get(recipe.id, recipe.document), request,
+            is_favorited=recipe.id in favorited,
+            is_in_shopping_cart=recipe.id in in_shopping_cart,
+            is_subscribed=recipe.author_id in subscribed,
+            favorites_count=recipe.favorites_count,
+            author_counters=counters.get(recipe.author_id))
+        for recipe in recipes
+    ]
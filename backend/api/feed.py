@@ -0,0 +1,139 @@
+"""Лента подписок: рецепты авторов, на которых подписан пользователь.
+
+У каждого подписчика есть ящик FeedEntry. Новый рецепт сразу раскладывается
+по ящикам всех подписчиков автора, при подписке в ящик попадают последние
+рецепты автора, при отписке они оттуда убираются. Рецепты авторов, у которых
+подписчиков больше FEED_FANOUT_LIMIT, по ящикам не раскладываются: они
+читаются из таблицы рецептов при запросе ленты и сливаются с ящиком.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from recipes.models import FeedEntry, Follow, Recipe
+from users.models import User
+
+from .paginators import KeysetPaginator
+
+LARGE_AUTHORS_KEY = 'feed-large-authors'
+
+
+def large_authors():
+    """Авторы, чьи рецепты читаются при запросе, а не из ящиков."""
+    return cache.get_or_set(
+        LARGE_AUTHORS_KEY,
+        lambda: frozenset(User.objects.filter(
+            followers_count__gt=settings.FEED_FANOUT_LIMIT).values_list(
+            'id', flat=True)),
+        settings.FEED_LARGE_AUTHORS_TIMEOUT)
+
+
+def _fill(condition, params):
+    # рецепты раскладываются по ящикам подписчиков их авторов одним запросом
+    table = connection.ops.quote_name(FeedEntry._meta.db_table)
+    recipes = connection.ops.quote_name(Recipe._meta.db_table)
+    follows = connection.ops.quote_name(Follow._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (user_id, recipe_id, author_id, pub_date) '
+            f'SELECT follow.user_id, recipe.id, recipe.author_id, '
+            f'recipe.pub_date FROM {recipes} recipe '
+            f'JOIN {follows} follow ON follow.author_id = recipe.author_id '
+            f'WHERE {condition} '
+            f'ON CONFLICT (user_id, recipe_id) DO UPDATE '
+            f'SET pub_date = excluded.pub_date', params)
+
+
+def _latest(author_id):
+    recipes = connection.ops.quote_name(Recipe._meta.db_table)
+    return (
+        f'recipe.id IN (SELECT id FROM {recipes} WHERE author_id = %s '
+        f'ORDER BY pub_date DESC, id DESC LIMIT %s)',
+        [author_id, settings.FEED_BACKFILL])
+
+
+def deliver(recipe_ids):
+    """Раскладывает рецепты по ящикам подписчиков их авторов."""
+    recipe_ids = list(recipe_ids)
+    if not recipe_ids:
+        return
+    condition = 'recipe.id IN (%s)' % ', '.join(['%s'] * len(recipe_ids))
+    params = recipe_ids
+    large = sorted(large_authors())
+    if large:
+        condition += ' AND recipe.author_id NOT IN (%s)' % ', '.join(
+            ['%s'] * len(large))
+        params = params + large
+    _fill(condition, params)
+
+
+def backfill(user_id, author_id):
+    """Кладёт в ящик подписчика последние рецепты автора."""
+    if author_id in large_authors():
+        return
+    latest, params = _latest(author_id)
+    _fill(f'follow.user_id = %s AND follow.author_id = %s AND {latest}',
+          [user_id, author_id, *params])
+
+
+def cleanup(user_id, author_id):
+    """Убирает рецепты автора из ящика бывшего подписчика."""
+    FeedEntry.objects.filter(user_id=user_id, author_id=author_id).delete()
+    # автор, потерявший подписчика, мог перестать быть крупным: его рецепты,
+    # опубликованные без раскладки, кладутся в ящики подписчиков
+    if Follow.objects.filter(
+            author_id=author_id).count() == settings.FEED_FANOUT_LIMIT:
+        transaction.on_commit(lambda: refill(author_id))
+
+
+def refill(author_id):
+    latest, params = _latest(author_id)
+    _fill(f'follow.author_id = %s AND {latest}', [author_id, *params])
+    cache.delete(LARGE_AUTHORS_KEY)
+
+
+class Feed:
+    """Источники ленты пользователя: ящик и рецепты крупных авторов."""
+
+    def __init__(self, user):
+        large = large_authors()
+        if large:
+            large = large & set(Follow.objects.filter(
+                user=user).values_list('author', flat=True))
+        self.inbox = FeedEntry.objects.filter(user=user).exclude(
+            author_id__in=large)
+        self.direct = Recipe.objects.filter(
+            author_id__in=large) if large else None
+
+
+class FeedPaginator(KeysetPaginator):
+    """Пагинация ленты по ключу (дата публикации, рецепт).
+
+    Страница ящика сливается с такой же страницей рецептов крупных авторов.
+    """
+    # recipe_id, а не recipe: иначе Django сортирует по Meta.ordering рецепта
+    ordering = ('-pub_date', '-recipe_id')
+
+    def get_ordering(self, view):
+        return self.ordering
+
+    def paginate_queryset(self, feed, request, view=None):
+        self.feed = feed
+        return super().paginate_queryset(feed.inbox, request, view)
+
+    def fetch(self, queryset, ordering, values):
+        entries = super().fetch(queryset, ordering, values)
+        if self.feed.direct is None:
+            return entries
+        ordering = tuple(
+            field.replace('recipe_id', 'id') for field in ordering)
+        recipes = self.feed.direct.order_by(*ordering)
+        if values is not None:
+            recipes = recipes.filter(self._after(ordering, values))
+        entries += [
+            FeedEntry(recipe_id=pk, author_id=author_id, pub_date=pub_date)
+            for pk, author_id, pub_date in recipes.values_list(
+                'id', 'author_id', 'pub_date')[:self.page_size + 1]]
+        entries.sort(key=lambda entry: (entry.pub_date, entry.recipe_id),
+                     reverse=ordering[0].startswith('-'))
+        return entries[:self.page_size + 1]
@@ -1,20 +1,44 @@
 from django_filters import rest_framework
-from rest_framework import filters
 
 from recipes.models import Recipe
+from recipes.search import search_recipes
+
+from .scores import SCORES
 
 
 class RecipeFilter(rest_framework.FilterSet):
     """ Фильтр, используется при отображении рецептов. """
     tags = rest_framework.AllValuesMultipleFilter(field_name='tags__slug')
-    is_favorited = rest_framework.BooleanFilter(field_name='is_favorited')
+    is_favorited = rest_framework.BooleanFilter(
+        field_name='selected_recipe', method='filter_by_user')
     is_in_shopping_cart = rest_framework.BooleanFilter(
-        field_name='is_in_shopping_cart')
+        field_name='selected_recipe_cart', method='filter_by_user')
+    search = rest_framework.CharFilter(method='filter_search')
+    # объявлен последним, чтобы его порядок заменял порядок поиска
+    ordering = rest_framework.ChoiceFilter(
+        choices=[(score, score) for score in SCORES],
+        method='filter_ordering')
 
     class Meta:
         model = Recipe
         fields = ('tags', 'author')
 
+    def filter_by_user(self, queryset, name, value):
+        user = self.request.user
+        if not user.is_authenticated:
+            return queryset.none() if value else queryset
+        lookup = {f'{name}__user': user}
+        if value:
+            return queryset.filter(**lookup)
+        return queryset.exclude(**lookup)
+
+    def filter_search(self, queryset, name, value):
+        # в курсорном режиме порядок задаёт пагинатор, а не релевантность
+        return search_recipes(queryset, value).order_by(
+            '-search_rank', '-pub_date', '-id')
 
-class CustomSearchFilter(filters.SearchFilter):
-    search_param = 'name'
+    def filter_ordering(self, queryset, name, value):
+        # оценка есть у каждого рецепта, и внутреннее соединение позволяет
+        # читать страницу по индексу оценки
+        return queryset.filter(score__isnull=False).select_related(
+            'score').order_by(f'-score__{value}', '-id')
@@ -0,0 +1,239 @@
+"""Уменьшенные копии картинок рецептов.
+
+Картинка декодируется и уменьшается не в обработчике запроса, а в небольшом
+пуле фоновых потоков: запрос только проверяет сигнатуру формата. Пока копии
+не готовы, вместо них отдаётся оригинал.
+"""
+import base64
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.db import connections, transaction
+from PIL import Image, ImageOps
+
+from recipes.models import ImageFile, Recipe
+
+logger = logging.getLogger(__name__)
+
+SOURCE = 'source'
+# начало файла -> расширение; остальное проверяет Pillow в фоновом потоке
+SIGNATURES = (
+    (re.compile(rb'\x89PNG\r\n\x1a\n'), 'png'),
+    (re.compile(rb'\xff\xd8\xff'), 'jpg'),
+    (re.compile(rb'GIF8[79]a'), 'gif'),
+    (re.compile(rb'RIFF.{4}WEBP', re.DOTALL), 'webp'),
+)
+BASE64 = re.compile(r'(?:[A-Za-z0-9+/]{4})*(?:[A-Za-z0-9+/]{2}==|'
+                    r'[A-Za-z0-9+/]{3}=)?')
+
+
+def image_extension(header):
+    """Расширение картинки по первым байтам файла или None."""
+    for signature, extension in SIGNATURES:
+        if signature.match(header):
+            return extension
+    return None
+
+
+class _Base64Reader:
+    # читает строку base64 как файл, декодируя её по частям
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+        self.position = 0
+        self.size = len(encoded) // 4 * 3 - encoded[-2:].count('=')
+
+    def read(self, size=-1):
+        start = self.position
+        end = self.size
+        if size is not None and size >= 0:
+            end = min(end, start + size)
+        if end <= start:
+            return b''
+        # декодируются целые группы: каждые 4 символа дают 3 байта
+        first, last = start // 3, (end + 2) // 3
+        data = base64.b64decode(self.encoded[first * 4:last * 4])
+        self.position = end
+        return data[start - first * 3:end - first * 3]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position,
+                os.SEEK_END: self.size}[whence]
+        self.position = max(base + offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+
+class Base64File(File):
+    """Картинка из строки base64, которая декодируется только при чтении.
+
+    Строка проверяется регулярным выражением, и в запросе декодируются лишь
+    первые байты для определения формата. Возвращает None из from_string,
+    если строка не base64 или не похожа на картинку.
+    """
+
+    @classmethod
+    def from_string(cls, encoded, stem='image'):
+        if not BASE64.fullmatch(encoded):
+            return None
+        reader = _Base64Reader(encoded)
+        extension = image_extension(reader.read(12))
+        reader.seek(0)
+        if extension is None:
+            return None
+        return cls(reader, name=f'{stem}.{extension}')
+
+
+def original_url(recipe):
+    if not recipe.image:
+        return None
+    try:
+        return recipe.image.url
+    except AttributeError:
+        return None
+
+
+def variant_url(recipe, variant):
+    """Адрес копии нужного размера или оригинала, если копии ещё нет."""
+    name = recipe.image_variants.get(variant)
+    if name:
+        return recipe.image.storage.url(name)
+    return original_url(recipe)
+
+
+def _encode(image, size):
+    copy = image.copy()
+    copy.thumbnail((size, size), Image.LANCZOS)
+    buffer = BytesIO()
+    copy.save(buffer, settings.IMAGE_VARIANT_FORMAT, quality=80)
+    return buffer.getvalue()
+
+
+def _open(field_file):
+    with field_file.open('rb') as source:
+        image = Image.open(source)
+        image.load()
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    return image
+
+
+def variant_names(source):
+    """Имена копий картинки: зависят только от оригинала и размера."""
+    stem = os.path.splitext(source)[0]
+    extension = settings.IMAGE_VARIANT_FORMAT.lower()
+    return {
+        variant: f'{stem}_{size}.{extension}'
+        for variant, size in settings.IMAGE_VARIANTS.items()}
+
+
+@transaction.atomic
+def release_image(storage, source):
+    """Удаляет картинку и её копии, если на неё не ссылается ни один рецепт.
+
+    Строка ImageFile заблокирована на время проверки и удаления, поэтому
+    параллельное сохранение того же файла дождётся конца удаления.
+    """
+    if not source:
+        return False
+    ImageFile.lock(source)
+    if Recipe.objects.filter(image=source).exists():
+        return False
+    for name in [source, *variant_names(source).values()]:
+        storage.delete(name)
+    return True
+
+
+def build_variants(recipe_id):
+    """Строит копии картинки рецепта и обновляет его документ.
+
+    Уже существующие копии той же картинки переиспользуются. Возвращает
+    False, если рецепта нет или картинка сменилась за время обработки.
+    """
+    from .documents import refresh_documents
+
+    recipe = Recipe.objects.filter(id=recipe_id).only(
+        'id', 'image', 'image_variants').first()
+    if recipe is None or not recipe.image:
+        return False
+    source = recipe.image.name
+    storage = recipe.image.storage
+    save = getattr(storage, 'save_derived', storage.save)
+    names = variant_names(source)
+    with transaction.atomic():
+        # копии не пишутся рядом с картинкой, которую удаляет release_image
+        ImageFile.lock(source)
+        if not Recipe.objects.filter(id=recipe_id, image=source).exists():
+            return False
+        image = None
+        for variant, name in names.items():
+            if storage.exists(name):
+                continue
+            if image is None:
+                image = _open(recipe.image)
+            names[variant] = save(name, ContentFile(
+                _encode(image, settings.IMAGE_VARIANTS[variant])))
+        if not Recipe.objects.filter(id=recipe_id, image=source).update(
+                image_variants={SOURCE: source, **names}):
+            return False
+    refresh_documents([recipe_id])
+    return True
+
+
+class VariantWorker:
+    """Ограниченный пул потоков для построения копий.
+
+    Если в очереди уже IMAGE_QUEUE_SIZE картинок, новая не ставится: рецепт
+    отдаёт оригинал, а копии можно построить командой build_image_variants.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+
+    def _start(self):
+        with self._lock:
+            if self._executor is None:
+                self._slots = threading.BoundedSemaphore(
+                    settings.IMAGE_QUEUE_SIZE)
+                self._executor = ThreadPoolExecutor(
+                    max_workers=settings.IMAGE_WORKERS,
+                    thread_name_prefix='image-variants')
+
+    def submit(self, recipe_id):
+        self._start()
+        if not self._slots.acquire(blocking=False):
+            logger.warning(
+                'Очередь картинок заполнена, рецепт %s пропущен', recipe_id)
+            return None
+        future = self._executor.submit(self._run, recipe_id)
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    @staticmethod
+    def _run(recipe_id):
+        try:
+            return build_variants(recipe_id)
+        except Exception:
+            logger.exception('Не удалось обработать картинку рецепта %s',
+                             recipe_id)
+            return False
+        finally:
+            connections.close_all()
+
+
+image_worker = VariantWorker()
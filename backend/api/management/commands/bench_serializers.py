@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from api.documents import document_queryset
+from api.renderers import FastJSONRenderer
+from api.serializers import (FavoriteSerializer, IngredientSerializer,
+                             ReadRecipeSerializer, TagSerializer)
+from recipes.models import Ingredient, Tag
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает стоимость сериализации одного объекта в режиме DRF '
+            'и в компилированном режиме, а также JSON-рендереры.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--limit', type=int, default=100)
+
+    def handle(self, *args, **options):
+        repeat, limit = options['repeat'], options['limit']
+        context = {'request': APIRequestFactory().get('/api/recipes/')}
+        recipes = list(document_queryset()[:limit])
+        cases = (
+            (ReadRecipeSerializer, recipes),
+            (FavoriteSerializer, recipes),
+            (TagSerializer, list(Tag.objects.all()[:limit])),
+            (IngredientSerializer, list(Ingredient.objects.all()[:limit])),
+        )
+        for serializer_class, objects in cases:
+            if not objects:
+                self.stdout.write(f'{serializer_class.__name__}: нет данных')
+                continue
+            timings, outputs = [], []
+            for compiled in (False, True):
+                with override_settings(API_COMPILED_SERIALIZERS=compiled):
+                    outputs.append(JSONRenderer().render(serializer_class(
+                        objects, many=True, context=context).data))
+                    timings.append(self.per_item(
+                        lambda: serializer_class(
+                            objects, many=True, context=context).data,
+                        repeat, len(objects)))
+            self.report(serializer_class.__name__, *timings,
+                        same=outputs[0] == outputs[1])
+
+        data = ReadRecipeSerializer(recipes, many=True, context=context).data
+        renderers = [
+            self.per_item(lambda: renderer().render(data), repeat,
+                          len(recipes))
+            for renderer in (JSONRenderer, FastJSONRenderer)]
+        same = JSONRenderer().render(data) == FastJSONRenderer().render(data)
+        self.report('JSONRenderer', *renderers, same=same)
+
+    @staticmethod
+    def per_item(func, repeat, count):
+        func()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat / max(count, 1) * 1e6
+
+    def report(self, name, before, after, same):
+        self.stdout.write(
+            f'{name}: {before:.1f} мкс -> {after:.1f} мкс на объект '
+            f'(x{before / after:.1f}), вывод совпадает: {same}')
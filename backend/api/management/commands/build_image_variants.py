@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from api.images import SOURCE, build_variants
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = ('Строит уменьшенные копии картинок рецептов, у которых их нет '
+            'или которые устарели.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Пересобрать копии всех рецептов.')
+
+    def handle(self, *args, **options):
+        built = failed = 0
+        recipes = Recipe.objects.exclude(image='').values_list(
+            'id', 'image', 'image_variants')
+        for recipe_id, image, variants in recipes.iterator():
+            if not options['all'] and variants.get(SOURCE) == image:
+                continue
+            try:
+                if build_variants(recipe_id):
+                    built += 1
+            except (OSError, ValueError) as error:
+                failed += 1
+                self.stderr.write(f'Рецепт {recipe_id}: {error}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано: {built}, с ошибками: {failed}'))
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.shopping import expected_totals, rebuild
+from recipes.models import ShoppingListItem
+
+
+class Command(BaseCommand):
+    help = ('Сверяет итоги списков покупок с пересчитанными по рецептам и '
+            'с --fix пересобирает итоги пользователей с расхождениями.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true')
+
+    def handle(self, *args, **options):
+        stored = ShoppingListItem.objects.filter(amount__gt=0).order_by(
+            'user', 'ingredient').values_list(
+            'user', 'ingredient', 'amount').iterator()
+        expected = expected_totals().iterator()
+        broken = set()
+        # оба потока упорядочены по (user, ingredient): сравниваем слиянием
+        left, right = next(stored, None), next(expected, None)
+        while left is not None or right is not None:
+            if right is None or (left is not None and left[:2] < right[:2]):
+                self.report(left[:2], left[2], 0)
+                broken.add(left[0])
+                left = next(stored, None)
+            elif left is None or right[:2] < left[:2]:
+                self.report(right[:2], 0, right[2])
+                broken.add(right[0])
+                right = next(expected, None)
+            else:
+                if left[2] != right[2]:
+                    self.report(left[:2], left[2], right[2])
+                    broken.add(left[0])
+                left, right = next(stored, None), next(expected, None)
+
+        if not broken:
+            self.stdout.write(self.style.SUCCESS('Расхождений нет'))
+            return
+        if not options['fix']:
+            raise CommandError(
+                f'Расхождения у пользователей: {len(broken)}. '
+                f'Запустите с --fix, чтобы пересобрать их итоги.')
+        with transaction.atomic():
+            rebuild(sorted(broken))
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересобраны итоги пользователей: {len(broken)}'))
+
+    def report(self, key, stored, expected):
+        user_id, ingredient_id = key
+        self.stdout.write(
+            f'Пользователь {user_id}, ингредиент {ingredient_id}: '
+            f'в таблице {stored}, должно быть {expected}')
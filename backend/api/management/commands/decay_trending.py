@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.scores import decay
+
+
+class Command(BaseCommand):
+    help = ('Уменьшает оценки «в тренде» за время с прошлого запуска; '
+            'запускается по расписанию, например раз в час.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            factor = decay()
+        if factor is None:
+            self.stdout.write(self.style.SUCCESS(
+                'Первый запуск: отсчёт времени начат'))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f'Оценки умножены на {factor:.4f}'))
@@ -0,0 +1,36 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from api.transfer import export_recipes
+
+
+class Command(BaseCommand):
+    help = ('Выгружает рецепты в NDJSON: по рецепту на строку, с тегами, '
+            'ингредиентами, автором и картинкой.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-',
+                            help='Файл для выгрузки; по умолчанию stdout.')
+        parser.add_argument('--after-id', type=int, default=0,
+                            help='Продолжить выгрузку после рецепта с этим '
+                                 'id.')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--no-images', action='store_true',
+                            help='Не вкладывать картинки, только их имена.')
+
+    def handle(self, *args, **options):
+        lines = export_recipes(
+            chunk_size=options['chunk_size'],
+            images=not options['no_images'],
+            after_id=options['after_id'])
+        if options['path'] == '-':
+            sys.stdout.writelines(lines)
+            return
+        count = 0
+        with open(options['path'], 'a' if options['after_id'] else 'w',
+                  encoding='utf-8') as target:
+            for line in lines:
+                target.write(line)
+                count += 1
+        self.stderr.write(self.style.SUCCESS(f'Выгружено рецептов: {count}'))
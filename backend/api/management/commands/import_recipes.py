@@ -0,0 +1,52 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.transfer import RecipeImporter
+
+
+class Command(BaseCommand):
+    help = ('Загружает рецепты из NDJSON, выгруженного export_recipes. '
+            'После каждой сохранённой порции номер строки пишется в файл '
+            'прогресса, и при повторном запуске загрузка продолжается с '
+            'него.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--progress',
+                            help='Файл прогресса; по умолчанию '
+                                 '<path>.progress.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Начать с первой строки, забыв прогресс.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'Файл {path} не найден')
+        progress = options['progress'] or f'{path}.progress'
+        start = 0
+        if os.path.exists(progress) and not options['restart']:
+            with open(progress) as source:
+                start = int(source.read().strip() or 0)
+            self.stdout.write(f'Продолжение со строки {start + 1}')
+
+        def save_progress(line):
+            with open(f'{progress}.tmp', 'w') as target:
+                target.write(str(line))
+            os.replace(f'{progress}.tmp', progress)
+
+        importer = RecipeImporter(batch_size=options['batch_size'])
+        try:
+            with open(path, encoding='utf-8') as source:
+                importer.run(source, start=start, on_batch=save_progress)
+        finally:
+            importer.finish()
+            for number, error in importer.errors:
+                self.stderr.write(f'Строка {number}: {error}')
+        if os.path.exists(progress):
+            os.remove(progress)
+        self.stdout.write(self.style.SUCCESS(
+            f'Загружено рецептов: {importer.imported}, '
+            f'с ошибками: {len(importer.errors)}. Копии картинок строит '
+            f'команда build_image_variants.'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.counters import COUNTERS, drift, recount
+
+
+class Command(BaseCommand):
+    help = ('Сверяет счётчики рецептов, подписчиков и избранного с числом '
+            'связей и с --fix пересчитывает расходящиеся.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true')
+
+    def handle(self, *args, **options):
+        broken = {}
+        for sender, (_, model, field) in COUNTERS.items():
+            for pk, stored, actual in drift(sender).iterator():
+                self.stdout.write(
+                    f'{model._meta.verbose_name} {pk}, {field}: '
+                    f'в счётчике {stored}, должно быть {actual}')
+                broken.setdefault(sender, []).append(pk)
+
+        if not broken:
+            self.stdout.write(self.style.SUCCESS('Расхождений нет'))
+            return
+        total = sum(len(ids) for ids in broken.values())
+        if not options['fix']:
+            raise CommandError(
+                f'Расходящихся счётчиков: {total}. '
+                f'Запустите с --fix, чтобы пересчитать их.')
+        with transaction.atomic():
+            for sender, ids in broken.items():
+                recount(sender, ids)
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитано счётчиков: {total}'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.cache import stats
+
+
+class Command(BaseCommand):
+    help = 'Показывает счётчики кэша ответов: попадания, промахи, вытеснения.'
+
+    def handle(self, *args, **options):
+        for name, value in stats().items():
+            self.stdout.write(f'{name}: {value}')
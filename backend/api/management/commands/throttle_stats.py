@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.throttling import buckets
+
+
+class Command(BaseCommand):
+    help = 'Показывает число отклонённых запросов по областям ограничений.'
+
+    def handle(self, *args, **options):
+        for name, value in sorted(buckets.counters().items()):
+            self.stdout.write(f'{name}: {value}')
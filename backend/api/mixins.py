@@ -0,0 +1,85 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from rest_framework.generics import get_object_or_404
+from rest_framework.permissions import SAFE_METHODS
+
+from .models import ChangeCounter
+from .replicas import is_pinned, use_replica
+
+
+class ConditionalGetMixin:
+    """Условные GET-запросы (ETag / Last-Modified) для list и retrieve.
+
+    Валидаторы строятся по счётчикам изменений, поэтому ответ 304 отдаётся
+    без обращения к сериализаторам. Для авторизованных запросов во вьюсетах
+    с user_dependent = True учитываются и флаги пользователя. Валидаторы
+    не зависят от наличия объекта, поэтому retrieve сначала проверяет его.
+    """
+    version_key = None
+    user_dependent = False
+
+    def get_version_keys(self):
+        return [self.version_key]
+
+    def get_validators(self, request):
+        keys = self.get_version_keys()
+        if self.user_dependent and request.user.is_authenticated:
+            keys.append(f'user:{request.user.id}')
+        versions = ChangeCounter.get_versions(*keys)
+        fingerprint = '|'.join(
+            [self.basename, self.action, request.get_full_path()]
+            + [f'{key}={versions[key][0]}' for key in keys])
+        if self.user_dependent and request.user.is_authenticated:
+            fingerprint += f'|{request.user.id}'
+        etag = '"%s"' % hashlib.md5(fingerprint.encode()).hexdigest()
+        modified = [stamp for version, stamp in versions.values() if stamp]
+        last_modified = int(max(modified).timestamp()) if modified else None
+        return etag, last_modified
+
+    def check_object_exists(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        get_object_or_404(self.get_queryset().only('pk'), **{
+            self.lookup_field: self.kwargs[lookup_url_kwarg]})
+
+    def conditional(self, handler, request, *args, **kwargs):
+        if self.detail:
+            self.check_object_exists()
+        etag, last_modified = self.get_validators(request)
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            if self.user_dependent:
+                patch_vary_headers(response, ('Authorization',))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
+
+
+class ReplicaReadMixin:
+    """Безопасные запросы читают с реплики базы, см. api/replicas.py.
+
+    Аутентификация и проверка прав идут до переключения, по основной базе.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and not is_pinned(request.user):
+            self._replica_token = use_replica.set(True)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, '_replica_token', None)
+        if token is not None:
+            use_replica.reset(token)
+            self._replica_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
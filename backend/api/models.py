@@ -0,0 +1,42 @@
+from django.db import models
+from django.db.models import F
+from django.utils import timezone
+
+
+class ChangeCounter(models.Model):
+    """Счётчик изменений набора данных, по нему строятся ETag ответов.
+
+    Ключи: recipes, tags, ingredients — коллекции; recipe:<id> — рецепт;
+    user:<id> — флаги пользователя (избранное, покупки, подписки); list:* —
+    выборки рецептов для кэша ответов (см. api/cache.py).
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+    version = models.PositiveBigIntegerField(default=0)
+    modified = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = 'Счётчик изменений'
+        verbose_name_plural = 'Счётчики изменений'
+
+    def __str__(self):
+        return f'{self.key}: {self.version}'
+
+    @classmethod
+    def bump(cls, *keys):
+        keys = set(keys)
+        if not keys:
+            return
+        cls.objects.bulk_create(
+            [cls(key=key) for key in keys], ignore_conflicts=True)
+        cls.objects.filter(key__in=keys).update(
+            version=F('version') + 1, modified=timezone.now())
+
+    @classmethod
+    def get_versions(cls, *keys):
+        """Версии и время изменения ключей; отсутствующие — (0, None)."""
+        versions = dict.fromkeys(keys, (0, None))
+        versions.update(
+            (key, (version, modified)) for key, version, modified
+            in cls.objects.filter(key__in=keys).values_list(
+                'key', 'version', 'modified'))
+        return versions
@@ -1,5 +1,184 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import binascii
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Q, QuerySet
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class CachedCountPaginator(Paginator):
+    """Пагинатор, который кэширует общее число объектов.
+
+    Включается настройкой PAGINATION_COUNT_CACHE_TIMEOUT (в секундах), иначе
+    считает точно, как обычный Paginator.
+    """
+
+    @cached_property
+    def count(self):
+        timeout = getattr(settings, 'PAGINATION_COUNT_CACHE_TIMEOUT', 0)
+        if not timeout or not isinstance(self.object_list, QuerySet):
+            return super().count
+        sql, params = self.object_list.query.sql_with_params()
+        key = 'paginator-count:' + hashlib.md5(
+            f'{sql}{params}'.encode()).hexdigest()
+        return cache.get_or_set(key, lambda: Paginator.count.func(self),
+                                timeout)
+
+
+class KeysetPaginator(BasePagination):
+    """Пагинация по ключу сортировки без OFFSET и COUNT.
+
+    Поля ключа берутся из атрибута keyset_ordering вьюсета, например
+    ('-pub_date', '-id'), и могут принадлежать связанной модели. Ключ должен
+    быть уникальным, поэтому последним полем идёт первичный ключ.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+    max_page_size = 100
+    invalid_cursor_message = 'Неверный курсор.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = tuple(self.get_ordering(view))
+        self.fields = [
+            self._field(queryset.model, field.lstrip('-'))
+            for field in self.ordering]
+        self.page_size = self.get_page_size(request)
+        values, reverse = self.decode_cursor(request)
+
+        ordering = self.ordering
+        if reverse:
+            ordering = tuple(self._invert(field) for field in ordering)
+        results = self.fetch(queryset, ordering, values)
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.next_values = self.previous_values = None
+        if results:
+            if has_more or reverse:
+                self.next_values = self._values(results[-1])
+            if values is not None and (has_more or not reverse):
+                self.previous_values = self._values(results[0])
+        return results
+
+    def get_ordering(self, view):
+        return view.keyset_ordering
+
+    def fetch(self, queryset, ordering, values):
+        """До page_size + 1 объектов после values в порядке ordering."""
+        queryset = queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self._after(ordering, values))
+        return list(queryset[:self.page_size + 1])
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.encode_cursor(self.next_values, False),
+            'previous': self.encode_cursor(self.previous_values, True),
+            'results': data,
+        })
+
+    @staticmethod
+    def _invert(field):
+        return field[1:] if field.startswith('-') else '-' + field
+
+    def _after(self, ordering, values):
+        # (a, b) < (x, y)  <=>  a < x OR (a = x AND b < y)
+        condition = Q()
+        for index, field in enumerate(ordering):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            step = Q(**{f'{name}__{lookup}': values[index]})
+            for previous, value in zip(ordering[:index], values):
+                step &= Q(**{previous.lstrip('-'): value})
+            condition |= step
+        return condition
+
+    @staticmethod
+    def _field(model, path):
+        # поле может быть и у связанной модели: score__popular
+        *relations, name = path.split('__')
+        for relation in relations:
+            model = model._meta.get_field(relation).related_model
+        return model._meta.get_field(name)
+
+    def _values(self, obj):
+        values = []
+        for path, field in zip(self.ordering, self.fields):
+            target = obj
+            for relation in path.lstrip('-').split('__')[:-1]:
+                target = getattr(target, relation)
+            values.append(getattr(target, field.attname))
+        return values
+
+    def encode_cursor(self, values, reverse):
+        if values is None:
+            return None
+        payload = {
+            'v': [value.isoformat() if hasattr(value, 'isoformat') else value
+                  for value in values],
+            'r': reverse,
+        }
+        token = base64.urlsafe_b64encode(
+            json.dumps(payload, separators=(',', ':')).encode()).decode()
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, token)
+
+    def decode_cursor(self, request):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None, False
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(token.encode()))
+            values = [
+                field.to_python(value)
+                for field, value in zip(self.fields, payload['v'])]
+            if len(values) != len(self.fields):
+                raise ValueError
+            return values, bool(payload.get('r'))
+        except (binascii.Error, ValueError, TypeError, KeyError,
+                ValidationError):
+            raise NotFound(self.invalid_cursor_message)
 
 
 class CustomPaginator(PageNumberPagination):
+    """Постраничная пагинация; с параметром cursor — пагинация по ключу.
+
+    Курсорный режим доступен во вьюсетах с атрибутом keyset_ordering и
+    включается запросом с параметром cursor (для первой страницы пустым).
+    """
     page_size_query_param = 'limit'
+    django_paginator_class = CachedCountPaginator
+    keyset = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        cursor_param = KeysetPaginator.cursor_query_param
+        if (getattr(view, 'keyset_ordering', None)
+                and cursor_param in request.query_params):
+            self.keyset = KeysetPaginator()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
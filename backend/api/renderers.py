@@ -0,0 +1,66 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer на orjson, если библиотека установлена.
+
+    Вывод совпадает с JSONRenderer: компактные разделители, UTF-8 и
+    экранированные \\u2028 / \\u2029. Для отступов (например, в browsable
+    API) и незнакомых типов используется стандартная реализация.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (orjson is None or data is None or self.ensure_ascii
+                or not self.compact or self.get_indent(
+                    accepted_media_type, renderer_context or {}) is not None):
+            return super().render(
+                data, accepted_media_type, renderer_context)
+        try:
+            # даты отдаются кодировщику DRF, чтобы формат не отличался
+            ret = orjson.dumps(
+                data, default=self.encoder_class().default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except orjson.JSONEncodeError:
+            return super().render(
+                data, accepted_media_type, renderer_context)
+        # как и JSONRenderer, экранируем разделители строк для JavaScript
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace(
+            '\u2029'.encode(), b'\\u2029')
+
+
+class DownloadRenderer(BaseRenderer):
+    """Выбор формата файла для скачивания по ?format= или Accept.
+
+    Сам файл отдаётся потоком мимо рендерера, через него проходят только
+    ошибки — они отдаются обычным текстом.
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get('response')
+        if response is not None:
+            response.content_type = 'text/plain; charset=utf-8'
+        if isinstance(data, dict) and 'detail' in data:
+            data = data['detail']
+        return str(data).encode()
+
+
+class PlainTextRenderer(DownloadRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+
+class CSVRenderer(DownloadRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class PDFRenderer(DownloadRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
@@ -0,0 +1,77 @@
+"""Чтение с реплик базы данных.
+
+Безопасные запросы к вьюсетам с ReplicaReadMixin читают со случайной реплики
+из DATABASE_REPLICAS, всё остальное идёт в основную базу. Пользователь,
+который только что что-то изменил, DATABASE_PIN_SECONDS секунд читает с
+основной базы: реплика могла ещё не получить его изменения. Отметка об
+этом хранится в кэше pins, общем для процессов: запись и следующее чтение
+могут попасть в разные процессы.
+Кэш ответов анонимам (api/cache.py) собирается только по основной базе.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.permissions import SAFE_METHODS
+
+use_replica = ContextVar('use_replica', default=False)
+
+
+@contextmanager
+def primary():
+    """Внутри блока чтение идёт с основной базы."""
+    token = use_replica.set(False)
+    try:
+        yield
+    finally:
+        use_replica.reset(token)
+
+
+def _pin_key(user_id):
+    return f'db-pin:{user_id}'
+
+
+def pin(user):
+    caches['pins'].set(
+        _pin_key(user.id), 1, timeout=settings.DATABASE_PIN_SECONDS)
+
+
+def is_pinned(user):
+    return (user.is_authenticated
+            and caches['pins'].get(_pin_key(user.id)) is not None)
+
+
+class ReplicaRouter:
+    """Чтение с реплики, если его разрешил запрос; запись — в основную."""
+
+    def db_for_read(self, model, **hints):
+        if settings.DATABASE_REPLICAS and use_replica.get():
+            return random.choice(settings.DATABASE_REPLICAS)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # во всех базах одни и те же данные
+        return True
+
+
+class PrimaryPinMiddleware:
+    """Закрепляет за основной базой пользователя, сделавшего запись."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        # пользователя DRF определяет уже внутри вьюхи
+        user = getattr(request, 'user', None)
+        # неудачный запрос ничего не изменил, читать с реплики можно
+        if (settings.DATABASE_REPLICAS and request.method not in SAFE_METHODS
+                and 200 <= response.status_code < 300
+                and user is not None and user.is_authenticated):
+            pin(user)
+        return response
@@ -0,0 +1,65 @@
+"""Оценки рецептов для сортировки «популярные» и «в тренде».
+
+Оценки лежат в RecipeScore с индексами по каждой из них и меняются на
+разницу при добавлении рецепта в избранное или список покупок и удалении
+оттуда. Убывание оценки «в тренде» выполняет decay_trending по расписанию:
+все оценки умножаются на один множитель, поэтому порядок между запусками
+сохраняется, а новые добавления весят больше старых.
+"""
+from django.conf import settings
+from django.db.models import Case, F, FloatField, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from recipes.models import RecipeScore
+
+from .cache import SCORES_KEY, invalidate
+from .models import ChangeCounter
+
+SCORES = ('popular', 'trending')
+# время прошлого убывания оценок
+DECAY_KEY = 'scores'
+
+
+def create_scores(recipe_ids):
+    RecipeScore.objects.bulk_create(
+        [RecipeScore(recipe_id=recipe_id) for recipe_id in recipe_ids],
+        ignore_conflicts=True)
+
+
+def record_score(recipe_id, sign):
+    """Учитывает добавление (sign=1) или удаление (sign=-1) рецепта.
+
+    Удаление уменьшает только оценку «популярные»: в тренде учитываются
+    добавления за последнее время.
+    """
+    if sign > 0:
+        changes = {'popular': F('popular') + 1, 'trending': F('trending') + 1}
+    else:
+        changes = {'popular': Greatest(F('popular') - 1, 0)}
+    # общую версию SCORES_KEY не увеличиваем: добавлений слишком много,
+    # списки по оценкам живут в кэше не дольше RECIPE_COUNTERS_TTL секунд
+    RecipeScore.objects.filter(recipe_id=recipe_id).update(**changes)
+
+
+def decay(now=None):
+    """Уменьшает оценки «в тренде» за время с прошлого запуска.
+
+    Возвращает применённый множитель или None при первом запуске.
+    """
+    now = now or timezone.now()
+    _, last = ChangeCounter.get_versions(DECAY_KEY)[DECAY_KEY]
+    factor = None
+    if last is not None:
+        hours = max((now - last).total_seconds(), 0) / 3600
+        factor = 0.5 ** (hours / settings.TRENDING_HALF_LIFE)
+        # маленькие оценки обнуляются, чтобы старые добавления не
+        # тянулись бесконечно
+        RecipeScore.objects.filter(trending__gt=0).update(trending=Case(
+            When(trending__lt=settings.TRENDING_MIN_SCORE / factor,
+                 then=0.0),
+            default=F('trending') * factor,
+            output_field=FloatField()))
+    ChangeCounter.bump(DECAY_KEY)
+    invalidate(SCORES_KEY)
+    return factor
@@ -1,26 +1,142 @@
-import base64
-
-from django.core.files.base import ContentFile
-from django.core.paginator import Paginator
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.db.models import F, Prefetch, Window, prefetch_related_objects
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
+from PIL import Image
 from rest_framework import serializers
 
 from recipes.models import (Follow, Ingredient, IngredientRecipe, Recipe, Tag,
                             TagRecipe)
+from recipes.signals import recipe_saved
 from users.models import User
 
+from .images import (Base64File, image_extension, original_url,
+                     variant_url)
+
 
 class Base64ImageField(serializers.ImageField):
+    """Картинка строкой data:image/...;base64 или обычным файлом.
+
+    В запросе проверяются сигнатура формата и структура файла
+    (Image.verify), но пиксели не декодируются: это делает фоновый поток,
+    который строит копии картинки.
+    """
+
     def to_internal_value(self, data):
         if isinstance(data, str):
-            if data.startswith('data:image'):
-                format, imgstr = data.split(';base64,')
-                ext = format.split('/')[-1]
-                data = ContentFile(base64.b64decode(imgstr),
-                                   name='temp.' + ext)
-        return super().to_internal_value(data)
+            if not data.startswith('data:image'):
+                self.fail('invalid_image')
+            data = Base64File.from_string(data.partition(';base64,')[2])
+        elif hasattr(data, 'read'):
+            header = data.read(12)
+            data.seek(0)
+            if image_extension(header) is None:
+                data = None
+        if data is None:
+            self.fail('invalid_image')
+        try:
+            Image.open(data).verify()
+        except Exception:
+            self.fail('invalid_image')
+        data.seek(0)
+        return serializers.FileField.to_internal_value(self, data)
+
+
+def _to_pk(model, value):
+    if isinstance(value, (bool, dict, list)):
+        return None
+    try:
+        return model._meta.pk.to_python(value)
+    except (DjangoValidationError, TypeError):
+        return None
+
+
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Ищет объект среди загруженных заранее корневым сериализатором.
+
+    Корневой сериализатор собирает все id из запроса и загружает их одним
+    запросом в атрибут prefetched ({модель: {id: объект}}). Без него поле
+    работает как обычный PrimaryKeyRelatedField.
+    """
+
+    def to_internal_value(self, data):
+        model = self.get_queryset().model
+        objects = getattr(self.root, 'prefetched', {}).get(model)
+        if objects is None:
+            return super().to_internal_value(data)
+        pk = _to_pk(model, data)
+        if pk is None:
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if pk not in objects:
+            self.fail('does_not_exist', pk_value=data)
+        return objects[pk]
+
+
+class CompiledSerializerMixin:
+    """Быстрое представление объекта без обхода полей DRF.
+
+    Сериализатор описывает тот же JSON в compiled_representation; режим
+    отключается настройкой API_COMPILED_SERIALIZERS = False.
+    """
+
+    def to_representation(self, instance):
+        if getattr(settings, 'API_COMPILED_SERIALIZERS', True):
+            return self.compiled_representation(instance)
+        return super().to_representation(instance)
+
+    def image_url(self, recipe):
+        return _absolute_url(self.context, original_url(recipe))
+
+    def image_variants(self, recipe):
+        return RecipeImageField.represent(self.context, recipe)
+
+
+def _absolute_url(context, url):
+    request = context.get('request')
+    if request is not None and url:
+        return request.build_absolute_uri(url)
+    return url
+
+
+class RecipeImageField(serializers.Field):
+    """Адреса уменьшенных копий картинки рецепта: {копия: адрес}.
+
+    Пока копии не готовы, вместо них отдаётся оригинал.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.update(source='*', read_only=True)
+        super().__init__(**kwargs)
 
+    def to_representation(self, recipe):
+        return self.represent(self.context, recipe)
 
-class MyUserSerializer(serializers.ModelSerializer):
+    @staticmethod
+    def represent(context, recipe):
+        return {
+            name: _absolute_url(context, variant_url(recipe, name))
+            for name in settings.IMAGE_VARIANTS}
+
+
+_datetime_field = serializers.DateTimeField()
+
+
+def compiled_user(user):
+    return {
+        'username': user.username,
+        'email': user.email,
+        'id': user.id,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'is_subscribed': bool(getattr(user, 'is_subscribed', False)),
+        'recipes_count': user.recipes_count,
+        'followers_count': user.followers_count,
+    }
+
+
+class MyUserSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     """Сериализатор пользователя."""
     is_subscribed = serializers.BooleanField(required=False, default=False)
 
@@ -33,25 +149,47 @@ class MyUserSerializer(serializers.ModelSerializer):
             'first_name',
             'last_name',
             'is_subscribed',
+            'recipes_count',
+            'followers_count',
         )
+        read_only_fields = ('recipes_count', 'followers_count')
+
+    def compiled_representation(self, instance):
+        return compiled_user(instance)
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(CompiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Tag
         fields = '__all__'
 
+    def compiled_representation(self, instance):
+        return {
+            'id': instance.id,
+            'name': instance.name,
+            'slug': instance.slug,
+            'color': instance.color,
+        }
 
-class IngredientSerializer(serializers.ModelSerializer):
+
+class IngredientSerializer(CompiledSerializerMixin,
+                           serializers.ModelSerializer):
     class Meta:
         model = Ingredient
         fields = '__all__'
 
+    def compiled_representation(self, instance):
+        return {
+            'id': instance.id,
+            'name': instance.name,
+            'measurement_unit': instance.measurement_unit,
+        }
+
 
 class IngredientRecipeSerializer(serializers.ModelSerializer):
     """Этот сериализатор используется для записи рецепта."""
     recipe = serializers.PrimaryKeyRelatedField(read_only=True)
-    id = serializers.PrimaryKeyRelatedField(queryset=Ingredient.objects.all())
+    id = PrefetchedPrimaryKeyRelatedField(queryset=Ingredient.objects.all())
 
     class Meta:
         model = IngredientRecipe
@@ -94,10 +232,12 @@ class ReadIngredientRecipeSerializer(serializers.ModelSerializer):
         fields = ('name', 'amount', 'measurement_unit', 'id')
 
 
-class ReadRecipeSerializer(serializers.ModelSerializer):
+class ReadRecipeSerializer(CompiledSerializerMixin,
+                           serializers.ModelSerializer):
     """Этот сериализатор используется для чтения рецептов."""
     author = MyUserSerializer(read_only=True)
-    image = Base64ImageField(required=True)
+    image = serializers.ImageField(read_only=True)
+    image_variants = RecipeImageField()
     tags = ReadTagRecipeSerializer(many=True, source='tag_recipe')
     ingredients = ReadIngredientRecipeSerializer(many=True, source='recipe')
     is_favorited = serializers.BooleanField(default=False)
@@ -111,6 +251,7 @@ class ReadRecipeSerializer(serializers.ModelSerializer):
             'is_in_shopping_cart',
             'is_favorited',
             'image',
+            'image_variants',
             'author',
             'tags',
             'ingredients',
@@ -118,12 +259,47 @@ class ReadRecipeSerializer(serializers.ModelSerializer):
             'text',
             'pub_date',
             'cooking_time',
-            'is_subscribed')
+            'is_subscribed',
+            'favorites_count')
+
+    def compiled_representation(self, instance):
+        return {
+            'id': instance.id,
+            'is_in_shopping_cart': bool(
+                getattr(instance, 'is_in_shopping_cart', False)),
+            'is_favorited': bool(getattr(instance, 'is_favorited', False)),
+            'image': self.image_url(instance),
+            'image_variants': self.image_variants(instance),
+            'author': compiled_user(instance.author),
+            'tags': [
+                {
+                    'name': str(tag_recipe.tags.name),
+                    'id': str(tag_recipe.tags.id),
+                    'color': str(tag_recipe.tags.color),
+                    'slug': str(tag_recipe.tags.slug),
+                }
+                for tag_recipe in instance.tag_recipe.all()],
+            'ingredients': [
+                {
+                    'name': str(ingredient_recipe.ingredients.name),
+                    'amount': ingredient_recipe.amount,
+                    'measurement_unit': str(
+                        ingredient_recipe.ingredients.measurement_unit),
+                    'id': str(ingredient_recipe.ingredients.id),
+                }
+                for ingredient_recipe in instance.recipe.all()],
+            'name': instance.name,
+            'text': instance.text,
+            'pub_date': _datetime_field.to_representation(instance.pub_date),
+            'cooking_time': instance.cooking_time,
+            'is_subscribed': bool(getattr(instance, 'is_subscribed', False)),
+            'favorites_count': instance.favorites_count,
+        }
 
 
 class WriteRecipeSerializer(serializers.ModelSerializer):
     """Этот сериализатор используется для записи рецептов."""
-    tags = serializers.PrimaryKeyRelatedField(
+    tags = PrefetchedPrimaryKeyRelatedField(
         many=True, queryset=Tag.objects.all())
     ingredients = IngredientRecipeSerializer(many=True)
     image = Base64ImageField(required=True)
@@ -140,42 +316,143 @@ class WriteRecipeSerializer(serializers.ModelSerializer):
             'tags')
         read_only_fields = ('pub_date', 'author')
 
+    def to_internal_value(self, data):
+        # все id тегов и ингредиентов проверяются одним запросом на модель
+        self.prefetched = {}
+        ingredients = tags = None
+        if isinstance(data, dict):
+            ingredients, tags = data.get('ingredients'), data.get('tags')
+        ingredient_ids = [
+            item.get('id') if isinstance(item, dict) else None
+            for item in ingredients] if isinstance(ingredients, list) else []
+        self.prefetch(
+            self.fields['ingredients'].child.fields['id'], ingredient_ids)
+        self.prefetch(
+            self.fields['tags'].child_relation,
+            tags if isinstance(tags, list) else [])
+        try:
+            return super().to_internal_value(data)
+        except serializers.ValidationError as error:
+            # повторы ингредиентов сообщаются вместе с остальными ошибками
+            self.add_duplicate_errors(error.detail, ingredient_ids)
+            raise
+
+    def prefetch(self, field, values):
+        queryset = field.get_queryset()
+        pks = {_to_pk(queryset.model, value) for value in values} - {None}
+        self.prefetched[queryset.model] = queryset.in_bulk(pks) if pks else {}
+
+    def duplicate_errors(self, ingredient_ids):
+        model = self.fields['ingredients'].child.fields['id'].queryset.model
+        seen, errors = set(), []
+        for value in ingredient_ids:
+            pk = _to_pk(model, value)
+            errors.append(
+                {'id': ['Ингредиент уже добавлен в рецепт.']}
+                if pk is not None and pk in seen else {})
+            seen.add(pk)
+        return errors if any(errors) else None
+
+    def add_duplicate_errors(self, detail, ingredient_ids):
+        errors = self.duplicate_errors(ingredient_ids)
+        if errors is None or not isinstance(detail, dict):
+            return
+        current = detail.get('ingredients')
+        if current is None:
+            detail['ingredients'] = errors
+        elif isinstance(current, list) and len(current) == len(errors):
+            for item, duplicate in zip(current, errors):
+                if duplicate and not item:
+                    item.update(duplicate)
+
+    def validate_ingredients(self, value):
+        errors = self.duplicate_errors([item['id'].id for item in value])
+        if errors is not None:
+            raise serializers.ValidationError(errors)
+        return value
+
     def creating_ingredient_recipe(self, ingredients, recipe, need_delete):
-        # функция для записи или обновления ингредиентов рецепта
+        # функция для записи или обновления ингредиентов рецепта: при
+        # обновлении меняются только отличающиеся строки; возвращает
+        # количества до изменения
+        amounts = {
+            ingredient['id'].id: ingredient['amount']
+            for ingredient in ingredients}
+        existing, changed, stale, old_amounts = {}, [], [], {}
         if need_delete:
-            IngredientRecipe.objects.filter(recipe=recipe).delete()
-        for ingredient in ingredients:
-            IngredientRecipe.objects.create(
-                ingredients_id=ingredient.pop(
-                    'id').id, amount=ingredient.pop('amount'),
-                recipe=recipe)
+            for row in IngredientRecipe.objects.filter(recipe=recipe).only(
+                    'id', 'ingredients_id', 'amount'):
+                old_amounts[row.ingredients_id] = old_amounts.get(
+                    row.ingredients_id, 0) + row.amount
+                if (row.ingredients_id not in amounts
+                        or row.ingredients_id in existing):
+                    stale.append(row.id)
+                    continue
+                existing[row.ingredients_id] = row
+                if row.amount != amounts[row.ingredients_id]:
+                    row.amount = amounts[row.ingredients_id]
+                    changed.append(row)
+        if stale:
+            IngredientRecipe.objects.filter(id__in=stale).delete()
+        if changed:
+            IngredientRecipe.objects.bulk_update(changed, ('amount',))
+        IngredientRecipe.objects.bulk_create(
+            IngredientRecipe(
+                ingredients_id=ingredient_id, amount=amount, recipe=recipe)
+            for ingredient_id, amount in amounts.items()
+            if ingredient_id not in existing)
+        return old_amounts
 
     def creating_tag_recipe(self, tags, recipe, need_delete):
         # функция для записи или обновления тегов рецепта
+        tag_ids = {tag.id for tag in tags}
+        existing = set()
         if need_delete:
-            TagRecipe.objects.filter(recipe=recipe).delete()
-        for tag in tags:
-            TagRecipe.objects.create(
-                tags_id=tag.id, recipe=recipe)
+            stale = []
+            for row_id, tag_id in TagRecipe.objects.filter(
+                    recipe=recipe).values_list('id', 'tags_id'):
+                if tag_id in tag_ids and tag_id not in existing:
+                    existing.add(tag_id)
+                else:
+                    stale.append(row_id)
+            if stale:
+                TagRecipe.objects.filter(id__in=stale).delete()
+        TagRecipe.objects.bulk_create(
+            TagRecipe(tags_id=tag_id, recipe=recipe)
+            for tag_id in tag_ids - existing)
 
     def pop_it(self, validated_data):
         return (validated_data.pop('ingredients'), validated_data.pop('tags'))
 
+    @transaction.atomic
     def create(self, validated_data):
         ingredients, tags = self.pop_it(validated_data)
         recipe = Recipe.objects.create(**validated_data)
         self.creating_ingredient_recipe(ingredients, recipe, False)
         self.creating_tag_recipe(tags, recipe, False)
+        recipe_saved.send(sender=Recipe, instance=recipe, created=True)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         ingredients, tags = self.pop_it(validated_data)
         super().update(instance, validated_data)
-        self.creating_ingredient_recipe(ingredients, instance, True)
+        old_amounts = self.creating_ingredient_recipe(
+            ingredients, instance, True)
         self.creating_tag_recipe(tags, instance, True)
+        recipe_saved.send(sender=Recipe, instance=instance, created=False,
+                          old_amounts=old_amounts)
         return instance
 
     def to_representation(self, instance):
+        # связи загружаются двумя запросами, а не по одному на ингредиент
+        prefetch_related_objects(
+            [instance],
+            Prefetch('tag_recipe',
+                     queryset=TagRecipe.objects.select_related('tags')),
+            Prefetch('recipe',
+                     queryset=IngredientRecipe.objects.select_related(
+                         'ingredients')))
         return ReadRecipeSerializer(instance).data
 
     def validate_date(self, data):
@@ -185,20 +462,82 @@ class WriteRecipeSerializer(serializers.ModelSerializer):
         return data
 
 
-class FavoriteSerializer(serializers.ModelSerializer):
+class FavoriteSerializer(CompiledSerializerMixin,
+                         serializers.ModelSerializer):
     """Сериализатор для отображения данных при добавлении в избранное."""
+    image = serializers.ImageField(read_only=True)
+    image_variants = RecipeImageField()
+
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time',)
+        fields = ('id', 'name', 'image', 'image_variants', 'cooking_time',)
+
+    def compiled_representation(self, instance):
+        return {
+            'id': instance.id,
+            'name': instance.name,
+            'image': self.image_url(instance),
+            'image_variants': self.image_variants(instance),
+            'cooking_time': instance.cooking_time,
+        }
+
+
+def latest_recipes(author_ids, limit, page=1):
+    """Последние рецепты авторов одним запросом: {author_id: [рецепты]}.
+
+    Рецепты каждого автора нумеруются окном ROW_NUMBER() от новых к старым,
+    и берётся page-я страница по limit штук.
+    """
+    grouped = {author_id: [] for author_id in author_ids}
+    if not grouped:
+        return grouped
+    ranked = Recipe.objects.filter(author_id__in=author_ids).annotate(
+        recipe_rank=Window(
+            RowNumber(), partition_by=[F('author_id')],
+            order_by=[F('pub_date').desc(), F('id').desc()])).values(
+        'id', 'recipe_rank')
+    sql, params = ranked.query.sql_with_params()
+    offset = (page - 1) * limit
+    recipes = Recipe.objects.filter(id__in=RawSQL(
+        f'SELECT id FROM ({sql}) ranked '
+        f'WHERE recipe_rank > %s AND recipe_rank <= %s',
+        (*params, offset, offset + limit))).only(
+        'id', 'name', 'image', 'image_variants', 'cooking_time',
+        'author_id').order_by('-pub_date', '-id')
+    for recipe in recipes:
+        grouped[recipe.author_id].append(recipe)
+    return grouped
+
+
+def _positive_param(request, name, default):
+    try:
+        value = int(request.query_params.get(name) or default)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise serializers.ValidationError(
+            {name: 'Ожидается целое число больше 0.'})
+    return value
+
+
+class AuthorRecipesListSerializer(serializers.ListSerializer):
+    """Загружает рецепты всех авторов страницы одним запросом."""
+
+    def to_representation(self, data):
+        authors = list(data.all() if hasattr(data, 'all') else data)
+        self.child.load_recipes(authors)
+        return super().to_representation(authors)
 
 
 class MyUserAndRecipeSerializer(serializers.ModelSerializer):
     """Агрегирующий сериализатор для отображения данных после подпски на автора
-    и при чтении моих подписок."""
-    recipes_count = serializers.SerializerMethodField()
+    и при чтении моих подписок.
+
+    Число рецептов автора задаёт параметр recipes_limit (по умолчанию 1), а
+    их страницу — recipes_page, независимо от страницы авторов.
+    """
     recipes = serializers.SerializerMethodField()
     is_subscribed = serializers.BooleanField(read_only=True)
-    recipes_count = serializers.IntegerField()
 
     class Meta:
         model = User
@@ -208,16 +547,28 @@ class MyUserAndRecipeSerializer(serializers.ModelSerializer):
             'id',
             'first_name',
             'last_name',
-            'is_subscribed', 'recipes', 'recipes_count',
+            'is_subscribed', 'recipes', 'recipes_count', 'followers_count',
         )
+        list_serializer_class = AuthorRecipesListSerializer
+
+    def load_recipes(self, authors):
+        request = self.context.get('request')
+        limit = page = 1
+        if request is not None:
+            limit = _positive_param(request, 'recipes_limit', 1)
+            page = _positive_param(request, 'recipes_page', 1)
+        self.context['author_recipes'] = latest_recipes(
+            [author.id for author in authors], limit, page)
+
     def get_recipes(self, obj):
-        page_size = self.context['request'].query_params.get('recipes_limit') or 1
-        paginator = Paginator(obj.recipes.all(), page_size)
-        page = self.context['request'].query_params.get('page') or 1
-        recipes = paginator.page(page)
-        serializer = FavoriteSerializer(recipes, many=True)
+        if obj.id not in self.context.get('author_recipes', {}):
+            self.load_recipes([obj])
+        serializer = FavoriteSerializer(
+            self.context['author_recipes'][obj.id], many=True,
+            context=self.context)
         return serializer.data
 
+
 class FollowSerializer(serializers.ModelSerializer):
     """Дополнительный сериализатор, чтобы создать запись при подписке в БД."""
     class Meta:
@@ -225,4 +576,4 @@ class FollowSerializer(serializers.ModelSerializer):
         fields = ()
 
     def to_representation(self, instance):
-        return MyUserAndRecipeSerializer(instance).data
+        return MyUserAndRecipeSerializer(instance, context=self.context).data
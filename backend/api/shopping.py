@@ -0,0 +1,174 @@
+"""Список покупок: итоги по ингредиентам и файл в txt, csv или pdf.
+
+Итоги хранятся в ShoppingListItem и меняются на разницу, когда рецепт
+добавляют в список или убирают из него и когда меняются ингредиенты рецепта
+из чьего-то списка. Файл читается из этой таблицы итератором и сразу
+отдаётся клиенту, так что документ целиком в памяти не собирается.
+
+PDF набирает reportlab: готовые страницы он хранит сжатыми до конца
+документа, а сам файл пишется во временный файл (большой уходит на диск) и
+отдаётся частями.
+"""
+import csv
+import functools
+import os
+import tempfile
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import simpleSplit
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen.canvas import Canvas
+
+from recipes.models import IngredientRecipe, ShoppingCart, ShoppingListItem
+
+TITLE = 'Список покупок'
+PDF_MARGIN = 56
+PDF_SIZE, PDF_TITLE_SIZE, PDF_LEADING = 11, 16, 1.4
+# сколько байт PDF держать в памяти, прежде чем писать на диск
+PDF_SPOOL_SIZE = 1024 * 1024
+PDF_CHUNK_SIZE = 64 * 1024
+
+
+def shopping_list(user):
+    """Строки (название, единица, количество) в алфавитном порядке."""
+    return ShoppingListItem.objects.filter(
+        user=user, amount__gt=0).order_by(
+        'ingredient__name', 'ingredient__measurement_unit').values_list(
+        'ingredient__name', 'ingredient__measurement_unit',
+        'amount').iterator()
+
+
+def expected_totals(**filters):
+    """Итоги, посчитанные заново по спискам покупок.
+
+    Строки (user_id, ingredient_id, количество) по возрастанию ключа.
+    """
+    return IngredientRecipe.objects.filter(
+        recipe__selected_recipe_cart__isnull=False, **filters).values(
+        'recipe__selected_recipe_cart__user', 'ingredients').annotate(
+        total=Sum('amount')).order_by(
+        'recipe__selected_recipe_cart__user', 'ingredients').values_list(
+        'recipe__selected_recipe_cart__user', 'ingredients', 'total')
+
+
+def _upsert(select, params):
+    # одинаковый синтаксис у PostgreSQL и SQLite 3.24+
+    table = connection.ops.quote_name(ShoppingListItem._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (user_id, ingredient_id, amount) {select} '
+            f'ON CONFLICT (user_id, ingredient_id) DO UPDATE '
+            f'SET amount = {table}.amount + excluded.amount', params)
+
+
+def change_cart(user_id, recipe_id, sign):
+    """Добавляет (sign=1) или вычитает (sign=-1) рецепт из итогов."""
+    table = connection.ops.quote_name(IngredientRecipe._meta.db_table)
+    _upsert(
+        f'SELECT %s, ingredients_id, SUM(amount) * %s FROM {table} '
+        f'WHERE recipe_id = %s GROUP BY ingredients_id',
+        (user_id, sign, recipe_id))
+    if sign < 0:
+        ShoppingListItem.objects.filter(
+            user_id=user_id, amount__lte=0).delete()
+
+
+def change_recipe(recipe_id, changes):
+    """Применяет изменения {ingredient_id: разница} рецепта к итогам всех,
+    у кого он в списке покупок."""
+    table = connection.ops.quote_name(ShoppingCart._meta.db_table)
+    changes = {key: delta for key, delta in changes.items() if delta}
+    for ingredient_id, delta in changes.items():
+        _upsert(
+            f'SELECT user_id, %s, %s FROM {table} WHERE recipe_id = %s',
+            (ingredient_id, delta, recipe_id))
+    if changes:
+        ShoppingListItem.objects.filter(
+            ingredient_id__in=changes, amount__lte=0).delete()
+
+
+def rebuild(user_ids):
+    """Пересчитывает итоги пользователей целиком."""
+    ShoppingListItem.objects.filter(user_id__in=user_ids).delete()
+    ShoppingListItem.objects.bulk_create(
+        ShoppingListItem(user_id=user_id, ingredient_id=ingredient_id,
+                         amount=total)
+        for user_id, ingredient_id, total in expected_totals(
+            recipe__selected_recipe_cart__user__in=user_ids))
+
+
+def _lines(rows):
+    for name, unit, amount in rows:
+        yield f'{name} ({unit}) — {amount}'
+
+
+def render_txt(rows):
+    yield f'{TITLE}\n\n'.encode()
+    for line in _lines(rows):
+        yield f'{line}\n'.encode()
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def render_csv(rows):
+    writer = csv.writer(_Echo())
+    # BOM нужен, чтобы Excel распознал UTF-8
+    yield '\ufeff'.encode()
+    yield writer.writerow(('Ингредиент', 'Единица', 'Количество')).encode()
+    for row in rows:
+        yield writer.writerow(row).encode()
+
+
+def pdf_available():
+    return os.path.exists(settings.SHOPPING_LIST_PDF_FONT)
+
+
+@functools.lru_cache(maxsize=4)
+def _pdf_font(path):
+    # в файл reportlab встраивает только использованные символы шрифта
+    name = os.path.splitext(os.path.basename(path))[0]
+    pdfmetrics.registerFont(TTFont(name, path))
+    return name
+
+
+def _draw_pdf(output, rows):
+    font = _pdf_font(settings.SHOPPING_LIST_PDF_FONT)
+    width, height = A4
+    text_width = width - 2 * PDF_MARGIN
+    pdf = Canvas(output, pagesize=A4, pageCompression=1)
+    pdf.setTitle(TITLE)
+    y = height - PDF_MARGIN
+
+    def draw(text, size):
+        nonlocal y
+        for line in simpleSplit(text, font, size, text_width) or ['']:
+            if y - size < PDF_MARGIN:
+                pdf.showPage()
+                y = height - PDF_MARGIN
+            y -= size
+            pdf.setFont(font, size)
+            pdf.drawString(PDF_MARGIN, y, line)
+            y -= size * (PDF_LEADING - 1)
+
+    draw(TITLE, PDF_TITLE_SIZE)
+    y -= PDF_SIZE * PDF_LEADING
+    for line in _lines(rows):
+        draw(line, PDF_SIZE)
+    pdf.save()
+
+
+def render_pdf(rows):
+    with tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_SIZE) as output:
+        _draw_pdf(output, rows)
+        output.seek(0)
+        yield from iter(lambda: output.read(PDF_CHUNK_SIZE), b'')
+
+
+RENDERERS = {'txt': render_txt, 'csv': render_csv, 'pdf': render_pdf}
@@ -0,0 +1,284 @@
+from django.db import transaction
+from django.db.models.signals import (post_delete, post_save, pre_delete,
+                                      pre_save)
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from recipes.models import (Favorite, Follow, Ingredient, IngredientRecipe,
+                            Recipe, ShoppingCart, Tag)
+from recipes.signals import ingredients_loaded, recipe_saved
+from users.models import User
+from users.signals import users_updated
+
+from .authentication import revoke
+from .autocomplete import ingredient_index
+from .cache import invalidate, invalidate_membership
+from .counters import added, change
+from .documents import AUTHOR_FIELDS, refresh_documents
+from .feed import backfill, cleanup, deliver
+from .images import SOURCE, image_worker, release_image
+from .models import ChangeCounter
+from .scores import create_scores, record_score
+from .shopping import change_cart, change_recipe, rebuild
+
+
+def _tag_slugs(document):
+    return {tag['slug'] for tag in document.get('tags', ())}
+
+
+def _schedule_image_variants(recipe):
+    # до готовности копий новой картинки отдаётся оригинал
+    if (not recipe.image
+            or recipe.image_variants.get(SOURCE) == recipe.image.name):
+        return
+    if recipe.image_variants:
+        Recipe.objects.filter(id=recipe.id).update(image_variants={})
+        recipe.image_variants = {}
+    transaction.on_commit(lambda: image_worker.submit(recipe.id))
+
+
+def _release_image_on_commit(field_file, name):
+    storage = field_file.storage
+    transaction.on_commit(lambda: release_image(storage, name))
+
+
+@receiver(pre_save, sender=Recipe)
+def remember_stored_recipe(sender, instance, **kwargs):
+    stored = Recipe.objects.filter(id=instance.id).values_list(
+        'image', 'author_id').first() if instance.id else None
+    instance._stored_image, instance._stored_author = stored or (None, None)
+
+
+@receiver(post_save, sender=Recipe)
+def release_replaced_image(sender, instance, **kwargs):
+    # одна картинка может быть у нескольких рецептов: файл удаляется, когда
+    # на него не осталось ссылок
+    stored = getattr(instance, '_stored_image', None)
+    if stored and stored != instance.image.name:
+        _release_image_on_commit(instance.image, stored)
+
+
+@receiver(post_save, sender=Recipe)
+def count_moved_recipe(sender, instance, created, **kwargs):
+    stored = getattr(instance, '_stored_author', None)
+    if not created and stored and stored != instance.author_id:
+        change(Recipe, {stored: -1, instance.author_id: 1})
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=Follow)
+@receiver(post_save, sender=Favorite)
+def count_created_link(sender, instance, created, **kwargs):
+    if created:
+        added(sender, [instance])
+
+
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Follow)
+@receiver(post_delete, sender=Favorite)
+def count_deleted_link(sender, instance, **kwargs):
+    # вызывается и для каждой строки при каскадном удалении
+    added(sender, [instance], -1)
+
+
+@receiver(post_save, sender=Recipe)
+def create_recipe_score(sender, instance, created, **kwargs):
+    if created:
+        create_scores([instance.id])
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=ShoppingCart)
+def score_added_recipe(sender, instance, created, **kwargs):
+    if created:
+        record_score(instance.recipe_id, 1)
+
+
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=ShoppingCart)
+def score_removed_recipe(sender, instance, **kwargs):
+    record_score(instance.recipe_id, -1)
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+def refresh_favorites_count(sender, instance, **kwargs):
+    # счётчик избранного не хранится в документе рецепта, но есть в ответе:
+    # recipe:<id> — версия ETag рецепта и зависимость кэша ответов; общие
+    # версии списков не трогаем, списки живут RECIPE_COUNTERS_TTL секунд
+    ChangeCounter.bump(f'recipe:{instance.recipe_id}')
+
+
+@receiver(post_save, sender=Recipe)
+def deliver_to_feeds(sender, instance, created, **kwargs):
+    if created:
+        deliver([instance.id])
+
+
+@receiver(post_save, sender=Follow)
+def backfill_feed(sender, instance, created, **kwargs):
+    if created:
+        backfill(instance.user_id, instance.author_id)
+
+
+@receiver(post_delete, sender=Follow)
+def cleanup_feed(sender, instance, **kwargs):
+    cleanup(instance.user_id, instance.author_id)
+
+
+@receiver(recipe_saved, sender=Recipe)
+def refresh_recipe_document(sender, instance, created, **kwargs):
+    _schedule_image_variants(instance)
+    # в instance ещё лежит документ до изменения
+    old_slugs = _tag_slugs(instance.document)
+    new_document = refresh_documents([instance.id])[instance.id]
+    new_slugs = _tag_slugs(new_document)
+    if created:
+        invalidate_membership(instance.author_id, new_slugs)
+    else:
+        invalidate_membership(
+            instance.author_id, old_slugs ^ new_slugs, everything=False)
+        if not instance.document:
+            invalidate('list:tags')
+
+
+@receiver(post_delete, sender=Recipe)
+def bump_deleted_recipe(sender, instance, **kwargs):
+    ChangeCounter.bump('recipes', f'recipe:{instance.id}')
+    invalidate_membership(instance.author_id, _tag_slugs(instance.document))
+    if not instance.document:
+        invalidate('list:tags')
+    _release_image_on_commit(instance.image, instance.image.name)
+
+
+@receiver(post_save, sender=Tag)
+def refresh_tag_documents(sender, instance, created, **kwargs):
+    ChangeCounter.bump('tags')
+    invalidate('list:tags')
+    if not created:
+        refresh_documents(
+            Recipe.objects.filter(tags=instance).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Ingredient)
+def refresh_ingredient_documents(sender, instance, created, **kwargs):
+    ChangeCounter.bump('ingredients')
+    ingredient_index.invalidate()
+    if not created:
+        refresh_documents(Recipe.objects.filter(
+            ingredients=instance).values_list('id', flat=True))
+
+
+@receiver(ingredients_loaded, sender=Ingredient)
+def bump_loaded_ingredients(sender, **kwargs):
+    ChangeCounter.bump('ingredients')
+    ingredient_index.invalidate()
+
+
+@receiver(post_save, sender=User)
+def refresh_author_documents(sender, instance, created, update_fields,
+                             **kwargs):
+    # например, при входе обновляется только last_login
+    if created or (update_fields is not None and not set(
+            update_fields) & set(AUTHOR_FIELDS)):
+        return
+    refresh_documents(instance.recipes.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=User)
+def revoke_cached_tokens(sender, instance, created, update_fields, **kwargs):
+    # смена пароля, деактивация и другие правки пользователя; вход меняет
+    # только last_login
+    if created or (update_fields is not None
+                   and set(update_fields) <= {'last_login'}):
+        return
+    revoke(Token.objects.filter(user=instance).values_list('key', flat=True))
+
+
+@receiver(users_updated, sender=User)
+def handle_updated_users(sender, user_ids, fields, **kwargs):
+    # массовое update() в обход save(), например блокировка в админке
+    if fields <= {'last_login'}:
+        return
+    revoke(Token.objects.filter(user_id__in=user_ids).values_list(
+        'key', flat=True))
+    if fields & set(AUTHOR_FIELDS):
+        refresh_documents(Recipe.objects.filter(
+            author_id__in=user_ids).values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Token)
+def revoke_deleted_token(sender, instance, **kwargs):
+    # выход и каскадное удаление вместе с пользователем
+    revoke([instance.key])
+
+
+@receiver(pre_delete, sender=Tag)
+@receiver(pre_delete, sender=Ingredient)
+def remember_related_recipes(sender, instance, **kwargs):
+    # связи удаляются каскадно, поэтому рецепты запоминаются заранее
+    lookup = 'tags' if sender is Tag else 'ingredients'
+    instance._recipe_ids = list(Recipe.objects.filter(
+        **{lookup: instance}).values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Ingredient)
+def refresh_related_documents(sender, instance, **kwargs):
+    ChangeCounter.bump('tags' if sender is Tag else 'ingredients')
+    if sender is Tag:
+        invalidate('list:tags')
+    else:
+        ingredient_index.invalidate()
+    refresh_documents(getattr(instance, '_recipe_ids', ()))
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=ShoppingCart)
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=ShoppingCart)
+@receiver(post_delete, sender=Follow)
+def bump_user_flags(sender, instance, **kwargs):
+    ChangeCounter.bump(f'user:{instance.user_id}')
+
+
+@receiver(pre_save, sender=ShoppingCart)
+def remember_cart_row(sender, instance, **kwargs):
+    instance._stored_cart = ShoppingCart.objects.filter(
+        id=instance.id).values_list('user_id', 'recipe_id').first() if (
+        instance.id) else None
+
+
+@receiver(post_save, sender=ShoppingCart)
+def add_to_shopping_list(sender, instance, created, **kwargs):
+    current = (instance.user_id, instance.recipe_id)
+    stored = None if created else getattr(instance, '_stored_cart', None)
+    if stored == current:
+        return
+    if stored is not None:
+        change_cart(*stored, -1)
+    change_cart(*current, 1)
+
+
+@receiver(pre_delete, sender=ShoppingCart)
+def remove_from_shopping_list(sender, instance, **kwargs):
+    # до удаления: при удалении рецепта его ингредиенты ещё на месте
+    change_cart(instance.user_id, instance.recipe_id, -1)
+
+
+@receiver(recipe_saved, sender=Recipe)
+def adjust_shopping_lists(sender, instance, created, old_amounts=None,
+                          **kwargs):
+    if created or not ShoppingCart.objects.filter(
+            recipe_id=instance.id).exists():
+        return
+    if old_amounts is None:
+        # прежние количества неизвестны: итоги считаются заново
+        rebuild(list(ShoppingCart.objects.filter(
+            recipe_id=instance.id).values_list('user_id', flat=True)))
+        return
+    new = IngredientRecipe.amounts(instance.id)
+    change_recipe(instance.id, {
+        key: new.get(key, 0) - old_amounts.get(key, 0)
+        for key in {*old_amounts, *new}})
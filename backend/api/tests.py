@@ -0,0 +1,1424 @@
+import base64
+import io
+import json
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from recipes.models import (FeedEntry, ImageFile, Ingredient,
+                            IngredientRecipe, Recipe, RecipeScore,
+                            ShoppingListItem, Tag, TagRecipe)
+from recipes.search import SQLITE_TRIGGERS, restore_sqlite_triggers
+from recipes.signals import recipe_saved
+from users.models import User
+
+from .apps import prepare_shared_dir
+from .autocomplete import ingredient_index
+from .cache import SCORES_KEY, stats
+from .documents import refresh_documents
+from .images import (Base64File, build_variants, release_image,
+                     variant_names)
+from .models import ChangeCounter
+from .replicas import is_pinned, use_replica
+from .scores import decay
+from .serializers import WriteRecipeSerializer
+from .shopping import expected_totals
+from .throttling import SharedBuckets, SharedCounters
+from .transfer import RecipeImporter, export_recipes
+from .views import RecipeViewSet
+
+# без ограничения частоты: у корзин токенов свои тесты
+NO_THROTTLE = dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES={})
+LOCMEM = {
+    alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': f'test-{alias}'}
+    for alias in settings.CACHES
+}
+
+
+def create_user(username, **fields):
+    return User.objects.create_user(
+        username=username, email=f'{username}@example.com',
+        password='password-123', first_name=username, last_name=username,
+        **fields)
+
+
+def create_recipe(author, tags=(), ingredients=(), **fields):
+    """Рецепт с тегами и ингредиентами {ингредиент: количество}."""
+    fields.setdefault('name', 'Рецепт')
+    fields.setdefault('text', 'Описание')
+    fields.setdefault('cooking_time', 10)
+    fields.setdefault('image', 'recipes/test.png')
+    recipe = Recipe.objects.create(author=author, **fields)
+    IngredientRecipe.objects.bulk_create(
+        IngredientRecipe(recipe=recipe, ingredients=ingredient, amount=amount)
+        for ingredient, amount in dict(ingredients).items())
+    TagRecipe.objects.bulk_create(
+        TagRecipe(recipe=recipe, tags=tag) for tag in tags)
+    recipe_saved.send(sender=Recipe, instance=recipe, created=True)
+    return recipe
+
+
+def png_data_uri(size=(2, 2), color='red'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return 'data:image/png;base64,' + base64.b64encode(
+        buffer.getvalue()).decode()
+
+
+@override_settings(REST_FRAMEWORK=NO_THROTTLE, CACHES=LOCMEM)
+class APITestBase(TestCase):
+    """Пользователи, теги, ингредиенты и клиенты для тестов API."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author')
+        cls.reader = create_user('reader')
+        cls.breakfast = Tag.objects.create(
+            name='Завтрак', slug='breakfast', color='#E26C2D')
+        cls.dinner = Tag.objects.create(
+            name='Ужин', slug='dinner', color='#49B64E')
+        cls.salt = Ingredient.objects.create(
+            name='соль', measurement_unit='г')
+        cls.milk = Ingredient.objects.create(
+            name='молоко', measurement_unit='мл')
+
+    def setUp(self):
+        for alias in settings.CACHES:
+            caches[alias].clear()
+        # версии счётчиков повторяются от теста к тесту
+        ingredient_index.invalidate()
+        # счётчики кэша ответов общие для процессов, у теста — свои
+        shm = tempfile.TemporaryDirectory()
+        self.addCleanup(shm.cleanup)
+        self.stats_path = os.path.join(shm.name, 'response-stats')
+        patcher = mock.patch(
+            'api.cache.counters', SharedCounters(self.stats_path))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.anonymous = APIClient()
+        self.client = self.client_for(self.reader)
+
+    def use_temporary_media(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        override = self.settings(MEDIA_ROOT=media.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        return media.name
+
+    @staticmethod
+    def client_for(user):
+        client = APIClient()
+        token, _ = Token.objects.get_or_create(user=user)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        return client
+
+
+class RecipeReadQueriesTest(APITestBase):
+    """Число запросов к базе не зависит от размера страницы."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.recipes = [
+            create_recipe(
+                cls.author, tags=(cls.breakfast, cls.dinner),
+                ingredients={cls.salt: 5, cls.milk: 200},
+                name=f'Рецепт {number}')
+            for number in range(60)]
+
+    def get(self, client, url, queries):
+        # первый запрос кладёт токен в кэш
+        client.get('/api/tags/')
+        with self.assertNumQueries(queries):
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_list_authenticated(self):
+        for limit in (6, 50):
+            with self.subTest(limit=limit):
+                data = self.get(
+                    self.client, f'/api/recipes/?limit={limit}', 8)
+                self.assertEqual(len(data['results']), limit)
+
+    def test_list_anonymous(self):
+        for limit in (6, 50):
+            with self.subTest(limit=limit):
+                caches['responses'].clear()
+                data = self.get(
+                    self.anonymous, f'/api/recipes/?limit={limit}', 6)
+                self.assertEqual(len(data['results']), limit)
+
+    def test_list_filtered_by_tag(self):
+        for limit in (6, 50):
+            with self.subTest(limit=limit):
+                self.get(self.client,
+                         f'/api/recipes/?tags=breakfast&limit={limit}', 9)
+
+    def test_retrieve(self):
+        recipe = self.recipes[0]
+        data = self.get(self.client, f'/api/recipes/{recipe.id}/', 8)
+        self.assertEqual(data['id'], recipe.id)
+        self.assertEqual(len(data['ingredients']), 2)
+        self.assertEqual(len(data['tags']), 2)
+
+
+class ConditionalGetTest(APITestBase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.recipe = create_recipe(
+            cls.author, tags=(cls.breakfast,), ingredients={cls.salt: 5})
+
+    def test_not_modified(self):
+        for url in (f'/api/recipes/{self.recipe.id}/', '/api/recipes/',
+                    '/api/tags/', f'/api/tags/{self.breakfast.id}/'):
+            with self.subTest(url=url):
+                etag = self.client.get(url)['ETag']
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+
+    def test_changed_recipe_gets_new_etag(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        etag = self.anonymous.get(url)['ETag']
+        self.client_for(self.author).patch(url, {
+            'name': 'Новое название', 'text': 'Описание',
+            'cooking_time': 5, 'tags': [self.breakfast.id],
+            'ingredients': [{'id': self.salt.id, 'amount': 5}]},
+            format='json')
+        response = self.anonymous.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['name'], 'Новое название')
+
+    def test_user_flags_change_etag(self):
+        url = '/api/recipes/'
+        etag = self.client.get(url)['ETag']
+        self.client.post(f'/api/recipes/{self.recipe.id}/favorite/')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['results'][0]['is_favorited'])
+
+    def test_missing_object(self):
+        tag = Tag.objects.create(name='Обед', slug='lunch')
+        url = f'/api/tags/{tag.id}/'
+        etag = self.client.get(url)['ETag']
+        # строка удалена в обход сигналов, и версия тегов не изменилась
+        Tag.objects.filter(id=tag.id)._raw_delete('default')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 404)
+        for url in (f'/api/recipes/{self.recipe.id + 100}/',
+                    '/api/recipes/unknown/'):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class ResponseCacheTest(APITestBase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = create_user('other')
+        cls.recipe = create_recipe(
+            cls.author, tags=(cls.breakfast,), ingredients={cls.salt: 5})
+        create_recipe(cls.other, tags=(cls.dinner,), ingredients={
+            cls.milk: 100})
+
+    def edit(self, recipe, name):
+        response = self.client_for(recipe.author).patch(
+            f'/api/recipes/{recipe.id}/', {
+                'name': name, 'text': 'Описание', 'cooking_time': 5,
+                'tags': [self.breakfast.id],
+                'ingredients': [{'id': self.salt.id, 'amount': 5}]},
+            format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_hit(self):
+        first = self.anonymous.get('/api/recipes/').json()
+        with self.assertNumQueries(2):
+            second = self.anonymous.get('/api/recipes/').json()
+        self.assertEqual(first, second)
+        self.assertEqual(stats()['hits'], 1)
+
+    def test_users_are_not_cached(self):
+        self.client.get('/api/recipes/')
+        self.client.get('/api/recipes/')
+        self.anonymous.get('/api/recipes/?is_favorited=1')
+        self.assertEqual(stats()['hits'], 0)
+
+    def test_edit_evicts_only_dependent_entries(self):
+        own = f'/api/recipes/?author={self.author.id}'
+        other = f'/api/recipes/?author={self.other.id}'
+        self.anonymous.get(own)
+        self.anonymous.get(other)
+        self.edit(self.recipe, 'Новое название')
+        self.assertEqual(
+            self.anonymous.get(own).json()['results'][0]['name'],
+            'Новое название')
+        self.anonymous.get(other)
+        self.assertEqual(stats()['evictions'], 1)
+        self.assertEqual(stats()['hits'], 1)
+
+    def test_stats_seen_by_another_process(self):
+        self.anonymous.get('/api/recipes/')
+        self.anonymous.get('/api/recipes/')
+        # другой процесс: свой кэш в памяти и своё отображение файла
+        other_process = dict(LOCMEM, responses={
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'test-another-process'})
+        output = io.StringIO()
+        with self.settings(CACHES=other_process), mock.patch(
+                'api.cache.counters', SharedCounters(self.stats_path)):
+            call_command('response_cache_stats', stdout=output)
+        self.assertEqual(
+            output.getvalue().split('\n')[:3],
+            ['hits: 1', 'misses: 1', 'evictions: 0'])
+
+    def test_write_in_another_process(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        self.anonymous.get(url)
+        # у другого процесса свой кэш в памяти, общая только база
+        other_process = dict(LOCMEM, responses={
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'test-another-process'})
+        with self.settings(CACHES=other_process):
+            self.edit(self.recipe, 'Новое название')
+        self.assertEqual(
+            self.anonymous.get(url).json()['name'], 'Новое название')
+
+
+class IngredientSearchTest(APITestBase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Ingredient.objects.bulk_create([
+            Ingredient(name='Ёлочные иголки', measurement_unit='г'),
+            Ingredient(name='масло сливочное', measurement_unit='г'),
+            Ingredient(name='сливки', measurement_unit='мл'),
+        ])
+
+    def search(self, name, **params):
+        response = self.anonymous.get(
+            '/api/ingredients/', {'name': name, **params})
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.json()]
+
+    def test_prefix_before_word_matches(self):
+        self.assertEqual(
+            self.search('Сли'), ['сливки', 'масло сливочное'])
+        self.assertEqual(self.search('ело'), ['Ёлочные иголки'])
+        self.assertEqual(self.search('сли', limit=1), ['сливки'])
+
+    def test_substring_after_word_matches(self):
+        self.assertEqual(self.search('ивоч'), ['масло сливочное'])
+        self.assertEqual(self.search('ливк'), ['сливки'])
+        self.assertEqual(self.search('ли'), ['масло сливочное', 'сливки'])
+        self.assertEqual(self.search('ли', limit=1), ['масло сливочное'])
+
+    def test_typing_does_not_query(self):
+        self.search('соль')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.search('сол'), ['соль'])
+            self.assertEqual(self.search('соль'), ['соль'])
+
+    @override_settings(INGREDIENT_INDEX_CHECK_INTERVAL=0)
+    def test_change_from_another_process(self):
+        self.assertEqual(self.search('перец'), [])
+        # другой процесс добавил ингредиент: сигналы этого процесса о нём
+        # не знают, меняется только счётчик в базе
+        Ingredient.objects.bulk_create(
+            [Ingredient(name='перец', measurement_unit='г')])
+        ChangeCounter.bump('ingredients')
+        self.assertEqual(self.search('перец'), ['перец'])
+
+
+class RecipeSearchTest(APITestBase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.pancakes = create_recipe(
+            cls.author, tags=(cls.breakfast,), name='Блины на молоке',
+            text='Тонкие блины к чаю.')
+        cls.porridge = create_recipe(
+            cls.author, tags=(cls.breakfast,), name='Овсяная каша',
+            text='Подавать с блинами и ягодами.')
+        cls.salad = create_recipe(
+            cls.author, tags=(cls.dinner,), name='Салат с ёжевикой',
+            text='Лёгкий ужин.')
+
+    def search(self, client=None, **params):
+        response = (client or self.client).get('/api/recipes/', params)
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.json()['results']]
+
+    def test_name_matches_rank_first(self):
+        self.assertEqual(
+            self.search(search='блин'), [self.pancakes.id, self.porridge.id])
+
+    def test_yo_and_e_match(self):
+        self.assertEqual(self.search(search='ежевик'), [self.salad.id])
+        self.assertEqual(self.search(search='лёгкий'), [self.salad.id])
+
+    def test_combines_with_filters(self):
+        self.assertEqual(
+            self.search(search='блин', tags='dinner'), [])
+        self.assertEqual(
+            self.search(search='каша', author=self.author.id),
+            [self.porridge.id])
+
+    def test_edited_recipe_is_reindexed(self):
+        self.search(self.anonymous, search='сырники')
+        self.client_for(self.author).patch(
+            f'/api/recipes/{self.pancakes.id}/', {
+                'name': 'Сырники', 'text': 'Из творога.', 'cooking_time': 5,
+                'tags': [self.breakfast.id],
+                'ingredients': [{'id': self.salt.id, 'amount': 5}]},
+            format='json')
+        self.assertEqual(
+            self.search(self.anonymous, search='сырники'),
+            [self.pancakes.id])
+        self.assertEqual(self.search(search='тонкие'), [])
+
+    def test_sqlite_triggers_survive_migrations(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('только для SQLite')
+        # так пересоздаёт таблицу миграция: триггеры пропадают вместе с ней
+        with connection.cursor() as cursor:
+            for name in SQLITE_TRIGGERS:
+                cursor.execute(f'DROP TRIGGER {name}')
+        self.assertTrue(restore_sqlite_triggers(connection))
+        self.assertFalse(restore_sqlite_triggers(connection))
+        self.assertEqual(self.search(search='каша'), [self.porridge.id])
+        create_recipe(self.author, name='Гречневая каша')
+        self.assertEqual(len(self.search(search='каша')), 2)
+
+    def test_cursor_mode_orders_by_date(self):
+        self.assertEqual(
+            self.search(search='блин', cursor=''),
+            [self.porridge.id, self.pancakes.id])
+
+
+class RecipeWriteTest(APITestBase):
+    """Запись рецепта меняет только отличающиеся строки связей."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'специя {number:02}', measurement_unit='г')
+            for number in range(20))
+        cls.spices = list(Ingredient.objects.filter(
+            name__startswith='специя').order_by('name'))
+
+    def setUp(self):
+        super().setUp()
+        self.author_client = self.client_for(self.author)
+
+    def update(self, recipe, ingredients, tags):
+        response = self.author_client.patch(
+            f'/api/recipes/{recipe.id}/', {
+                'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 5,
+                'tags': [tag.id for tag in tags],
+                'ingredients': [
+                    {'id': ingredient.id, 'amount': amount}
+                    for ingredient, amount in ingredients.items()]},
+            format='json')
+        self.assertEqual(response.status_code, 200)
+
+    @staticmethod
+    def rows(recipe):
+        return {
+            row.ingredients_id: (row.id, row.amount)
+            for row in IngredientRecipe.objects.filter(recipe=recipe)}
+
+    def test_update_touches_only_changed_rows(self):
+        pepper = self.spices[0]
+        recipe = create_recipe(
+            self.author, tags=(self.breakfast,),
+            ingredients={self.salt: 5, self.milk: 200, pepper: 1})
+        before = self.rows(recipe)
+        tag_row = TagRecipe.objects.get(recipe=recipe).id
+        self.update(recipe, {self.salt: 5, self.milk: 300},
+                    (self.breakfast, self.dinner))
+        after = self.rows(recipe)
+        self.assertEqual(after[self.salt.id], before[self.salt.id])
+        self.assertEqual(
+            after[self.milk.id], (before[self.milk.id][0], 300))
+        self.assertNotIn(pepper.id, after)
+        self.assertIn(
+            tag_row, TagRecipe.objects.filter(
+                recipe=recipe, tags=self.breakfast).values_list(
+                'id', flat=True))
+        self.assertEqual(
+            set(recipe.tag_recipe.values_list('tags_id', flat=True)),
+            {self.breakfast.id, self.dinner.id})
+
+    def count_update_queries(self, size):
+        old, new = self.spices[:size], self.spices[size:2 * size]
+        recipe = create_recipe(
+            self.author, tags=(self.breakfast,),
+            ingredients={ingredient: 1 for ingredient in old})
+        # половина старых ингредиентов меняет количество, половина удаляется
+        ingredients = {ingredient: 2 for ingredient in old[:size // 2]}
+        ingredients.update({ingredient: 1 for ingredient in new})
+        with CaptureQueriesContext(connection) as queries:
+            self.update(recipe, ingredients, (self.dinner,))
+        self.assertEqual(
+            {row.ingredients_id: row.amount
+             for row in IngredientRecipe.objects.filter(recipe=recipe)},
+            {ingredient.id: amount
+             for ingredient, amount in ingredients.items()})
+        return len(queries)
+
+    def test_statement_count_does_not_grow(self):
+        # первый запрос кладёт токен в кэш
+        self.author_client.get('/api/tags/')
+        self.assertEqual(
+            self.count_update_queries(2), self.count_update_queries(10))
+
+
+class RecipeValidationTest(APITestBase):
+    """Id тегов и ингредиентов проверяются одним запросом на модель."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'специя {number:02}', measurement_unit='г')
+            for number in range(30))
+        cls.spices = list(Ingredient.objects.filter(
+            name__startswith='специя').order_by('name'))
+
+    def validate(self, ingredients, tags, queries=2):
+        serializer = WriteRecipeSerializer(data={
+            'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 5,
+            'image': png_data_uri(), 'tags': tags,
+            'ingredients': [
+                {'id': ingredient_id, 'amount': 1}
+                for ingredient_id in ingredients]})
+        with self.assertNumQueries(queries):
+            serializer.is_valid()
+        return serializer.errors
+
+    def test_one_query_per_model(self):
+        for size in (1, 30):
+            with self.subTest(size=size):
+                errors = self.validate(
+                    [spice.id for spice in self.spices[:size]],
+                    [self.breakfast.id, self.dinner.id])
+                self.assertEqual(errors, {})
+
+    def test_unknown_ids(self):
+        missing = self.spices[-1].id + 100
+        errors = self.validate(
+            [self.salt.id, missing], [self.breakfast.id, 999])
+        self.assertEqual(errors['ingredients'][0], {})
+        self.assertEqual(errors['ingredients'][1]['id'][0].code,
+                         'does_not_exist')
+        self.assertEqual(errors['tags'][0].code, 'does_not_exist')
+
+    def test_bad_types(self):
+        errors = self.validate(
+            [self.salt.id, 'соль', {'id': 1}], [['x']], queries=1)
+        self.assertEqual(
+            [item and item['id'][0].code for item in errors['ingredients']],
+            [{}, 'incorrect_type', 'incorrect_type'])
+        self.assertEqual(errors['tags'][0].code, 'incorrect_type')
+
+    def test_duplicates_reported_with_other_errors(self):
+        errors = self.validate(
+            [self.salt.id, self.milk.id, self.salt.id, 999],
+            [self.breakfast.id])
+        self.assertEqual(errors['ingredients'][:2], [{}, {}])
+        self.assertEqual(errors['ingredients'][2]['id'],
+                         ['Ингредиент уже добавлен в рецепт.'])
+        self.assertEqual(errors['ingredients'][3]['id'][0].code,
+                         'does_not_exist')
+        self.assertNotIn('tags', errors)
+
+    def test_duplicates_alone(self):
+        errors = self.validate(
+            [self.salt.id, self.salt.id], [self.breakfast.id])
+        self.assertEqual(errors['ingredients'], [
+            {}, {'id': ['Ингредиент уже добавлен в рецепт.']}])
+
+
+class RecipeImageTest(APITestBase):
+    """Картинка декодируется в фоне, а image остаётся оригиналом."""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = self.use_temporary_media()
+        self.author_client = self.client_for(self.author)
+
+    def post(self, image):
+        return self.author_client.post('/api/recipes/', {
+            'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 5,
+            'image': image, 'tags': [self.breakfast.id],
+            'ingredients': [{'id': self.salt.id, 'amount': 5}]},
+            format='json')
+
+    def test_request_does_not_decode_image(self):
+        # структура файла проверяется, но пиксели не декодируются
+        with mock.patch('PIL.ImageFile.ImageFile.load',
+                        side_effect=AssertionError):
+            response = self.post(png_data_uri((1000, 600)))
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertTrue(data['image'].endswith('.png'))
+        # пока копий нет, вместо них отдаётся оригинал
+        self.assertEqual(data['image_variants'], {
+            variant: data['image'] for variant in settings.IMAGE_VARIANTS})
+
+    def test_variants_are_separate_keys(self):
+        recipe_id = self.post(png_data_uri((1000, 600))).json()['id']
+        self.assertTrue(build_variants(recipe_id))
+        data = self.anonymous.get(f'/api/recipes/{recipe_id}/').json()
+        self.assertTrue(data['image'].endswith('.png'))
+        self.assertEqual(set(data['image_variants']),
+                         set(settings.IMAGE_VARIANTS))
+        for variant, size in settings.IMAGE_VARIANTS.items():
+            self.assertTrue(
+                data['image_variants'][variant].endswith(f'_{size}.webp'))
+        name = Recipe.objects.get(id=recipe_id).image_variants['thumbnail']
+        with Image.open(os.path.join(self.media_root, name)) as thumbnail:
+            self.assertEqual(thumbnail.size, (320, 192))
+        favorite = self.client.post(
+            f'/api/recipes/{recipe_id}/favorite/').json()
+        self.assertEqual(favorite['image'], data['image'])
+        self.assertEqual(favorite['image_variants'], data['image_variants'])
+
+    def test_rejects_non_images(self):
+        text = base64.b64encode(b'just some text').decode()
+        png = base64.b64decode(png_data_uri((100, 60)).partition(',')[2])
+        junk = base64.b64encode(png[:16] + os.urandom(300)).decode()
+        truncated = base64.b64encode(png[:len(png) // 2]).decode()
+        for image in ('data:image/png;base64,' + text,
+                      'data:image/png;base64,' + junk,
+                      'data:image/png;base64,' + truncated,
+                      'data:image/png;base64,not base64!',
+                      'data:image/png;base64,',
+                      png_data_uri()[len('data:image/png;base64,'):]):
+            with self.subTest(image=image[:30]):
+                response = self.post(image)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('image', response.json())
+        self.assertFalse(Recipe.objects.exists())
+
+    def test_base64_file_reads_in_chunks(self):
+        content = os.urandom(1000)
+        encoded = base64.b64encode(b'\x89PNG\r\n\x1a\n' + content).decode()
+        image = Base64File.from_string(encoded)
+        self.assertEqual(image.name, 'image.png')
+        self.assertEqual(image.size, len(content) + 8)
+        for chunk_size in (1, 7, 64, 4096):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(
+                    b''.join(image.chunks(chunk_size)),
+                    b'\x89PNG\r\n\x1a\n' + content)
+        image.seek(5)
+        self.assertEqual(image.read(4), (b'\x89PNG\r\n\x1a\n' + content)[5:9])
+        self.assertEqual(image.tell(), 9)
+
+
+class ImageStorageTest(APITestBase):
+    """Одинаковые картинки хранятся один раз и удаляются без ссылок."""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = self.use_temporary_media()
+        self.author_client = self.client_for(self.author)
+        worker = mock.patch('api.signals.image_worker')
+        worker.start()
+        self.addCleanup(worker.stop)
+
+    def post(self, image):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.author_client.post('/api/recipes/', {
+                'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 5,
+                'image': image, 'tags': [self.breakfast.id],
+                'ingredients': [{'id': self.salt.id, 'amount': 5}]},
+                format='json')
+        self.assertEqual(response.status_code, 201)
+        return Recipe.objects.get(id=response.json()['id'])
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.media_root, name))
+
+    def test_same_content_is_stored_once(self):
+        first = self.post(png_data_uri(color='red'))
+        second = self.post(png_data_uri(color='red'))
+        third = self.post(png_data_uri(color='blue'))
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertNotEqual(first.image.name, third.image.name)
+        self.assertEqual(
+            len(os.listdir(os.path.dirname(
+                os.path.join(self.media_root, first.image.name)))), 1)
+
+    def test_file_is_released_with_last_reference(self):
+        first = self.post(png_data_uri())
+        second = self.post(png_data_uri())
+        name = first.image.name
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author_client.delete(f'/api/recipes/{first.id}/')
+        self.assertTrue(self.exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.author_client.patch(f'/api/recipes/{second.id}/', {
+                'name': 'Рецепт', 'text': 'Описание', 'cooking_time': 5,
+                'image': png_data_uri(color='blue'),
+                'tags': [self.breakfast.id],
+                'ingredients': [{'id': self.salt.id, 'amount': 5}]},
+                format='json')
+        self.assertFalse(self.exists(name))
+
+    def test_variants_are_released(self):
+        recipe = self.post(png_data_uri())
+        self.assertTrue(build_variants(recipe.id))
+        names = variant_names(recipe.image.name)
+        self.assertTrue(all(map(self.exists, names.values())))
+        self.assertFalse(release_image(recipe.image.storage,
+                                       recipe.image.name))
+        Recipe.objects.filter(id=recipe.id).update(image='recipes/other.png')
+        self.assertTrue(release_image(recipe.image.storage,
+                                      recipe.image.name))
+        self.assertFalse(any(map(self.exists, names.values())))
+        self.assertFalse(self.exists(recipe.image.name))
+
+    def test_save_and_release_lock_the_same_row(self):
+        with mock.patch.object(
+                ImageFile, 'lock', wraps=ImageFile.lock) as lock:
+            recipe = self.post(png_data_uri())
+            release_image(recipe.image.storage, recipe.image.name)
+        self.assertEqual(lock.call_args_list, [
+            mock.call(recipe.image.name), mock.call(recipe.image.name)])
+        self.assertTrue(
+            ImageFile.objects.filter(name=recipe.image.name).exists())
+
+
+class RecipeImportTest(APITestBase):
+    """Загрузка NDJSON не оставляет файлов после отката порции."""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = self.use_temporary_media()
+
+    def line(self, name, image_name='photo.png', color='red', data=True):
+        image = {'name': image_name}
+        if data:
+            image['data'] = png_data_uri(color=color).partition(',')[2]
+        return json.dumps({
+            'name': name, 'text': 'Описание', 'cooking_time': 5,
+            'pub_date': '2023-01-01T10:00:00+00:00',
+            'author': {'username': self.author.username},
+            'tags': [{'slug': 'breakfast', 'name': 'Завтрак',
+                      'color': '#E26C2D'}],
+            'ingredients': [{'name': 'соль', 'measurement_unit': 'г',
+                             'amount': 5}],
+            'image': image,
+        }, ensure_ascii=False)
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.media_root)
+            for root, _, names in os.walk(self.media_root)
+            for name in names)
+
+    def test_import_and_export(self):
+        importer = RecipeImporter(batch_size=2)
+        importer.run([self.line('Блины'), self.line('Оладьи'),
+                      self.line('Сырники', color='blue')])
+        self.assertEqual(importer.errors, [])
+        self.assertEqual(importer.imported, 3)
+        self.assertEqual(len(self.stored_files()), 2)
+        exported = [json.loads(line) for line in export_recipes(
+            images=False)]
+        self.assertEqual([item['name'] for item in exported],
+                         ['Блины', 'Оладьи', 'Сырники'])
+        self.assertEqual(exported[0]['ingredients'], [
+            {'name': 'соль', 'measurement_unit': 'г', 'amount': 5}])
+
+    def test_failed_batch_removes_stored_images(self):
+        RecipeImporter().run([self.line('Блины')])
+        kept = self.stored_files()
+        importer = RecipeImporter(batch_size=10)
+        with mock.patch('api.transfer.deliver', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                importer.run([
+                    self.line('Оладьи'),
+                    self.line('Сырники', color='blue'),
+                    self.line('Гренки', image_name=kept[0], data=False)])
+        self.assertEqual(
+            list(Recipe.objects.values_list('name', flat=True)), ['Блины'])
+        # файл первого рецепта остаётся: на него есть ссылка
+        self.assertEqual(self.stored_files(), kept)
+
+    def test_bad_image_name_is_reported_per_record(self):
+        importer = RecipeImporter()
+        importer.run([
+            self.line('Блины'),
+            self.line('Оладьи', image_name='../secret.png', data=False),
+            self.line('Сырники', image_name='/etc/passwd', data=False)])
+        self.assertEqual(importer.imported, 1)
+        self.assertEqual([number for number, _ in importer.errors], [2, 3])
+
+    def test_import_requires_admin_role(self):
+        body = self.line('Блины').encode()
+        staff = create_user('staff', is_staff=True)
+        admin = create_user('admin', role='admin')
+        for user, status in ((self.reader, 403), (staff, 403),
+                             (admin, 200)):
+            with self.subTest(user=user.username):
+                response = self.client_for(user).post(
+                    '/api/recipes/import/', body,
+                    content_type='application/x-ndjson')
+                self.assertEqual(response.status_code, status)
+        self.assertEqual(
+            self.client_for(staff).get('/api/recipes/export/').status_code,
+            403)
+
+
+class ShoppingListDownloadTest(APITestBase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.pancakes = create_recipe(
+            cls.author, ingredients={cls.salt: 5, cls.milk: 200})
+        cls.omelette = create_recipe(
+            cls.author, ingredients={cls.salt: 2})
+
+    def setUp(self):
+        super().setUp()
+        for recipe in (self.pancakes, self.omelette):
+            self.client.post(f'/api/recipes/{recipe.id}/shopping_cart/')
+
+    def download(self, file_format):
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': file_format})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_txt(self):
+        self.assertEqual(
+            self.download('txt'),
+            'Список покупок\n\nмолоко (мл) — 200\nсоль (г) — 7\n')
+
+    def test_csv(self):
+        self.assertEqual(self.download('csv').splitlines(), [
+            '\ufeffИнгредиент,Единица,Количество',
+            'молоко,мл,200', 'соль,г,7'])
+
+    def test_pdf(self):
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {number}', measurement_unit='г')
+            for number in range(100))
+        ShoppingListItem.objects.bulk_create(
+            ShoppingListItem(user=self.reader, ingredient=ingredient,
+                             amount=1)
+            for ingredient in Ingredient.objects.filter(
+                name__startswith='ингредиент'))
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': 'pdf'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        content = b''.join(response.streaming_content)
+        self.assertTrue(content.startswith(b'%PDF-'))
+        self.assertTrue(content.rstrip().endswith(b'%%EOF'))
+        # 102 строки не помещаются на одну страницу A4
+        self.assertRegex(content, rb'/Count 3\b')
+
+    def test_pdf_without_font(self):
+        with self.settings(SHOPPING_LIST_PDF_FONT='/nonexistent.ttf'):
+            response = self.client.get(
+                '/api/recipes/download_shopping_cart/', {'format': 'pdf'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_format(self):
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': 'docx'})
+        self.assertEqual(response.status_code, 404)
+
+
+class ShoppingListTotalsTest(APITestBase):
+    """Итоги списка покупок меняются на разницу при правке рецепта."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.sugar = Ingredient.objects.create(
+            name='сахар', measurement_unit='г')
+        cls.other = create_user('other')
+        cls.pancakes = create_recipe(
+            cls.author, tags=(cls.breakfast,),
+            ingredients={cls.salt: 5, cls.milk: 200})
+        cls.omelette = create_recipe(
+            cls.author, tags=(cls.breakfast,),
+            ingredients={cls.salt: 2, cls.milk: 50})
+
+    def setUp(self):
+        super().setUp()
+        for client in (self.client, self.client_for(self.other)):
+            for recipe in (self.pancakes, self.omelette):
+                client.post(f'/api/recipes/{recipe.id}/shopping_cart/')
+
+    def totals(self, user):
+        return dict(ShoppingListItem.objects.filter(user=user).values_list(
+            'ingredient__name', 'amount'))
+
+    def assertTotalsConsistent(self):
+        self.assertEqual(
+            list(ShoppingListItem.objects.order_by(
+                'user_id', 'ingredient_id').values_list(
+                'user', 'ingredient', 'amount')),
+            list(expected_totals()))
+
+    def test_cart_changes(self):
+        self.assertEqual(self.totals(self.reader),
+                         {'соль': 7, 'молоко': 250})
+        self.client.delete(f'/api/recipes/{self.omelette.id}/shopping_cart/')
+        self.assertEqual(self.totals(self.reader),
+                         {'соль': 5, 'молоко': 200})
+        self.assertTotalsConsistent()
+
+    def test_recipe_edit_applies_difference(self):
+        self.client_for(self.author).patch(
+            f'/api/recipes/{self.pancakes.id}/', {
+                'name': 'Блины', 'text': 'Описание', 'cooking_time': 5,
+                'tags': [self.breakfast.id],
+                'ingredients': [{'id': self.milk.id, 'amount': 300},
+                                {'id': self.sugar.id, 'amount': 20}]},
+            format='json')
+        for user in (self.reader, self.other):
+            self.assertEqual(self.totals(user),
+                             {'соль': 2, 'молоко': 350, 'сахар': 20})
+        self.assertTotalsConsistent()
+
+    def test_old_amounts_do_not_depend_on_document(self):
+        # документ уже пересобран другим обработчиком: разница берётся из
+        # переданных количеств, а не из instance.document
+        old_amounts = IngredientRecipe.amounts(self.pancakes.id)
+        IngredientRecipe.objects.filter(
+            recipe=self.pancakes, ingredients=self.salt).update(amount=1)
+        recipe = Recipe.objects.get(id=self.pancakes.id)
+        recipe.document = refresh_documents([recipe.id])[recipe.id]
+        recipe_saved.send(sender=Recipe, instance=recipe, created=False,
+                          old_amounts=old_amounts)
+        self.assertEqual(self.totals(self.reader),
+                         {'соль': 3, 'молоко': 250})
+        self.assertTotalsConsistent()
+
+    def test_unknown_old_amounts_rebuild(self):
+        IngredientRecipe.objects.filter(recipe=self.omelette).delete()
+        recipe_saved.send(sender=Recipe, instance=self.omelette,
+                          created=False)
+        self.assertEqual(self.totals(self.other),
+                         {'соль': 5, 'молоко': 200})
+        self.assertTotalsConsistent()
+
+
+class SubscriptionsTest(APITestBase):
+    """Рецепты авторов на странице подписок читаются одним запросом."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.authors = [create_user(f'cook{number}') for number in range(4)]
+        cls.recipes = {
+            author.id: [
+                create_recipe(author, name=f'{author.username} {number}')
+                for number in range(3)]
+            for author in cls.authors}
+
+    def follow(self, *authors):
+        for author in authors:
+            response = self.client.post(f'/api/users/{author.id}/subscribe/')
+            self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def subscriptions(self, **params):
+        response = self.client.get('/api/users/subscriptions/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def recipe_names(self, author, numbers):
+        return [f'{author.username} {number}' for number in numbers]
+
+    def test_latest_recipes_per_author(self):
+        self.follow(*self.authors[:2])
+        results = self.subscriptions(recipes_limit=2)
+        self.assertEqual([item['id'] for item in results],
+                         [author.id for author in self.authors[:2]])
+        for item, author in zip(results, self.authors):
+            self.assertTrue(item['is_subscribed'])
+            self.assertEqual(item['recipes_count'], 3)
+            self.assertEqual([recipe['name'] for recipe in item['recipes']],
+                             self.recipe_names(author, (2, 1)))
+        results = self.subscriptions(recipes_limit=2, recipes_page=2)
+        self.assertEqual(
+            [recipe['name'] for recipe in results[0]['recipes']],
+            self.recipe_names(self.authors[0], (0,)))
+
+    def test_query_count_does_not_grow(self):
+        self.follow(self.authors[0])
+        self.subscriptions()
+        with CaptureQueriesContext(connection) as one_author:
+            self.subscriptions(recipes_limit=3)
+        self.follow(*self.authors[1:])
+        with CaptureQueriesContext(connection) as four_authors:
+            results = self.subscriptions(recipes_limit=3)
+        self.assertEqual(len(one_author), len(four_authors))
+        self.assertEqual(
+            [len(item['recipes']) for item in results], [3, 3, 3, 3])
+
+    def test_subscribe_response(self):
+        data = self.follow(self.authors[0])
+        self.assertEqual(
+            [recipe['name'] for recipe in data['recipes']],
+            self.recipe_names(self.authors[0], (2,)))
+
+    def test_bad_params(self):
+        self.follow(self.authors[0])
+        for params in ({'recipes_limit': 0}, {'recipes_limit': 'abc'},
+                       {'recipes_page': -1}):
+            with self.subTest(params=params):
+                response = self.client.get(
+                    '/api/users/subscriptions/', params)
+                self.assertEqual(response.status_code, 400)
+
+
+class FeedTest(APITestBase):
+    """Лента подписок из ящика и рецептов крупных авторов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = create_user('other')
+        cls.stranger = create_user('stranger')
+
+    def feed(self, limit=100):
+        names, url = [], f'/api/recipes/feed/?limit={limit}'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            names += [item['name'] for item in data['results']]
+            url = data['next']
+        return names
+
+    def publish(self, author, *names):
+        return [create_recipe(author, name=name) for name in names]
+
+    def test_subscribe_publish_unsubscribe(self):
+        self.publish(self.author, 'старый')
+        self.client.post(f'/api/users/{self.author.id}/subscribe/')
+        self.publish(self.author, 'новый')
+        self.publish(self.other, 'чужой')
+        self.publish(self.stranger, 'незнакомый')
+        self.client.post(f'/api/users/{self.other.id}/subscribe/')
+        self.assertEqual(self.feed(), ['чужой', 'новый', 'старый'])
+        self.client.delete(f'/api/users/{self.author.id}/subscribe/')
+        self.assertEqual(self.feed(), ['чужой'])
+
+    def test_pages_with_equal_dates(self):
+        self.client.post(f'/api/users/{self.author.id}/subscribe/')
+        recipes = self.publish(self.author, *(str(n) for n in range(7)))
+        # при равных датах в ящике порядок задаёт id рецепта, а не
+        # Meta.ordering модели рецепта
+        FeedEntry.objects.update(pub_date=recipes[0].pub_date)
+        self.assertEqual(
+            self.feed(limit=3), [str(n) for n in reversed(range(7))])
+
+    @override_settings(FEED_FANOUT_LIMIT=0)
+    def test_large_authors_are_read_directly(self):
+        self.client.post(f'/api/users/{self.author.id}/subscribe/')
+        self.client.post(f'/api/users/{self.other.id}/subscribe/')
+        caches['default'].clear()
+        self.publish(self.author, 'первый')
+        self.publish(self.other, 'второй', 'третий')
+        self.assertFalse(FeedEntry.objects.exists())
+        self.assertEqual(
+            self.feed(limit=1), ['третий', 'второй', 'первый'])
+
+
+class CounterTest(APITestBase):
+    """Счётчики меняются на разницу и не затираются полным save()."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = create_user('other')
+        cls.recipe = create_recipe(
+            cls.author, tags=(cls.breakfast,), ingredients={cls.salt: 5})
+
+    def counters(self):
+        self.author.refresh_from_db()
+        self.recipe.refresh_from_db()
+        return (self.author.recipes_count, self.author.followers_count,
+                self.recipe.favorites_count)
+
+    def test_links_change_counters(self):
+        other_client = self.client_for(self.other)
+        for client in (self.client, other_client):
+            client.post(f'/api/users/{self.author.id}/subscribe/')
+            client.post(f'/api/recipes/{self.recipe.id}/favorite/')
+        create_recipe(self.author)
+        self.assertEqual(self.counters(), (2, 2, 2))
+        other_client.delete(f'/api/users/{self.author.id}/subscribe/')
+        other_client.delete(f'/api/recipes/{self.recipe.id}/favorite/')
+        self.assertEqual(self.counters(), (2, 1, 1))
+        data = self.client.get('/api/users/subscriptions/').json()
+        self.assertEqual(
+            (data['results'][0]['recipes_count'],
+             data['results'][0]['followers_count']), (2, 1))
+
+    def test_stale_instance_save_keeps_counters(self):
+        author = User.objects.get(id=self.author.id)
+        recipe = Recipe.objects.get(id=self.recipe.id)
+        self.client.post(f'/api/users/{self.author.id}/subscribe/')
+        self.client.post(f'/api/recipes/{self.recipe.id}/favorite/')
+        author.first_name = 'Новое имя'
+        author.save()
+        recipe.name = 'Новое название'
+        recipe.save()
+        self.assertEqual(self.counters(), (1, 1, 1))
+        self.assertEqual(self.author.first_name, 'Новое имя')
+        self.assertEqual(self.recipe.name, 'Новое название')
+        # явно переданные поля записываются, даже если это счётчики
+        author.followers_count = 5
+        author.save(update_fields=('followers_count',))
+        self.assertEqual(self.counters(), (1, 5, 1))
+
+    def test_password_change_keeps_counters(self):
+        author_client = self.client_for(self.author)
+        # пользователь запроса берётся из кэша токенов со старыми счётчиками
+        author_client.get('/api/users/me/')
+        self.client.post(f'/api/users/{self.author.id}/subscribe/')
+        response = author_client.post('/api/users/set_password/', {
+            'current_password': 'password-123',
+            'new_password': 'another-password-456'})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.counters(), (1, 1, 0))
+
+    def test_recipe_edit_keeps_favorites_count(self):
+        self.client.post(f'/api/recipes/{self.recipe.id}/favorite/')
+        response = self.client_for(self.author).patch(
+            f'/api/recipes/{self.recipe.id}/', {
+                'name': 'Новое название', 'text': 'Описание',
+                'cooking_time': 5, 'tags': [self.breakfast.id],
+                'ingredients': [{'id': self.salt.id, 'amount': 5}]},
+            format='json')
+        self.assertEqual(response.json()['favorites_count'], 1)
+        self.assertEqual(self.counters(), (1, 0, 1))
+
+    def test_favorite_refreshes_lists_after_ttl(self):
+        url = '/api/recipes/'
+        keys = ('recipes', SCORES_KEY)
+        versions = ChangeCounter.get_versions(*keys)
+        with mock.patch('time.time', return_value=3000.0):
+            etag = self.anonymous.get(url)['ETag']
+            self.client.post(f'/api/recipes/{self.recipe.id}/favorite/')
+            # общие версии списков не меняются, ETag живёт до конца периода
+            self.assertEqual(ChangeCounter.get_versions(*keys), versions)
+            self.assertEqual(self.anonymous.get(
+                url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with mock.patch('time.time', return_value=(
+                3000.0 + settings.RECIPE_COUNTERS_TTL)):
+            response = self.anonymous.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['favorites_count'], 1)
+
+    def test_user_payloads_have_counters(self):
+        self.client.post(f'/api/users/{self.author.id}/subscribe/')
+        author_client = self.client_for(self.author)
+        me = author_client.get('/api/users/me/').json()
+        self.assertEqual((me['recipes_count'], me['followers_count']), (1, 1))
+        users = {user['id']: user for user in self.client.get(
+            '/api/users/', {'limit': 10}).json()['results']}
+        self.assertEqual(
+            (users[self.author.id]['recipes_count'],
+             users[self.author.id]['followers_count']), (1, 1))
+        author = self.anonymous.get(
+            f'/api/recipes/{self.recipe.id}/').json()['author']
+        self.assertEqual(
+            (author['recipes_count'], author['followers_count']), (1, 1))
+        author_client.patch('/api/users/me/', {'followers_count': 100})
+        self.assertEqual(self.counters(), (1, 1, 0))
+
+
+class PopularOrderingTest(APITestBase):
+    """Сортировка по оценкам и её версии для ETag и кэша ответов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = create_user('other')
+        cls.first, cls.second, cls.third = (
+            create_recipe(cls.author, name=name)
+            for name in ('первый', 'второй', 'третий'))
+
+    def names(self, client=None, **params):
+        response = (client or self.anonymous).get('/api/recipes/', params)
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.json()['results']]
+
+    def add(self, client, recipe, to='shopping_cart'):
+        client.post(f'/api/recipes/{recipe.id}/{to}/')
+
+    def test_popular_order(self):
+        self.add(self.client, self.first)
+        self.add(self.client, self.first, 'favorite')
+        self.add(self.client, self.second)
+        self.assertEqual(self.names(ordering='popular'),
+                         ['первый', 'второй', 'третий'])
+        self.assertEqual(self.names(ordering='popular', cursor='', limit=2),
+                         ['первый', 'второй'])
+        self.client.delete(f'/api/recipes/{self.first.id}/shopping_cart/')
+        self.client.delete(f'/api/recipes/{self.first.id}/favorite/')
+        self.assertEqual(self.names(ordering='popular'),
+                         ['второй', 'третий', 'первый'])
+
+    def test_score_change_shows_after_ttl(self):
+        url = '/api/recipes/?ordering=popular'
+        with mock.patch('time.time', return_value=3000.0):
+            etag = self.anonymous.get(url)['ETag']
+            self.assertEqual(self.names(ordering='popular'),
+                             ['третий', 'второй', 'первый'])
+            # список покупок не меняет ни документ, ни версии: новый
+            # порядок виден через RECIPE_COUNTERS_TTL секунд
+            self.add(self.client_for(self.other), self.first)
+            self.assertEqual(self.anonymous.get(
+                url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.names(ordering='popular'),
+                             ['третий', 'второй', 'первый'])
+        with mock.patch('time.time', return_value=(
+                3000.0 + settings.RECIPE_COUNTERS_TTL)):
+            response = self.anonymous.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.names(ordering='popular'),
+                             ['первый', 'третий', 'второй'])
+        self.assertEqual(stats()['evictions'], 1)
+
+    def test_trending_decays(self):
+        now = timezone.now()
+        decay(now)
+        self.add(self.client, self.first)
+        self.add(self.client, self.second, 'favorite')
+        self.add(self.client_for(self.other), self.second, 'favorite')
+        self.assertAlmostEqual(decay(now + timedelta(
+            hours=settings.TRENDING_HALF_LIFE)), 0.5)
+        trending = dict(RecipeScore.objects.values_list(
+            'recipe', 'trending'))
+        for recipe, expected in ((self.first, 0.5), (self.second, 1.0),
+                                 (self.third, 0)):
+            self.assertAlmostEqual(trending[recipe.id], expected)
+        self.assertEqual(self.names(ordering='trending'),
+                         ['второй', 'первый', 'третий'])
+
+
+class CachedTokenTest(APITestBase):
+    """Токен читается из кэша и отзывается при изменении пользователя."""
+
+    def token_queries(self, client):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/users/me/')
+        return response.status_code, sum(
+            'authtoken_token' in query['sql'] for query in queries)
+
+    def test_token_is_cached(self):
+        self.assertEqual(self.token_queries(self.client), (200, 1))
+        self.assertEqual(self.token_queries(self.client), (200, 0))
+        # счётчики и вход не отзывают токен
+        self.client_for(self.author).post(
+            f'/api/users/{self.reader.id}/subscribe/')
+        User.objects.filter(id=self.reader.id).update(
+            last_login=timezone.now())
+        self.assertEqual(self.token_queries(self.client), (200, 0))
+
+    def test_logout_and_save_revoke(self):
+        author_client = self.client_for(self.author)
+        for client in (self.client, author_client):
+            self.token_queries(client)
+        self.assertEqual(
+            self.client.post('/api/auth/token/logout/').status_code, 204)
+        self.assertEqual(self.token_queries(self.client)[0], 401)
+        self.author.is_active = False
+        self.author.save()
+        self.assertEqual(self.token_queries(author_client)[0], 401)
+
+    def test_revoke_during_database_read(self):
+        token = Token.objects.get(user=self.reader)
+        original = TokenAuthentication.authenticate_credentials
+
+        def logout_meanwhile(authentication, key):
+            result = original(authentication, key)
+            # выход, пока запрос читал токен; бэкенд к тому же вытеснил
+            # все ключи, включая отметки об отзыве
+            token.delete()
+            caches['tokens'].clear()
+            return result
+
+        with mock.patch.object(
+                TokenAuthentication, 'authenticate_credentials',
+                autospec=True, side_effect=logout_meanwhile):
+            self.assertEqual(self.token_queries(self.client)[0], 200)
+        self.assertEqual(self.token_queries(self.client), (401, 1))
+
+    def test_shared_dir_is_private(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'shared')
+            prepare_shared_dir(path)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+            os.chmod(path, 0o777)
+            with self.assertRaises(ImproperlyConfigured):
+                prepare_shared_dir(path)
+            link = os.path.join(root, 'link')
+            os.symlink(path, link)
+            os.chmod(path, 0o700)
+            with self.assertRaises(ImproperlyConfigured):
+                prepare_shared_dir(link)
+
+    def test_queryset_update_revokes(self):
+        self.token_queries(self.client)
+        User.objects.filter(id=self.reader.id).update(is_active=False)
+        self.assertEqual(self.token_queries(self.client)[0], 401)
+
+    def test_admin_deactivate_action(self):
+        admin = create_user('admin', is_staff=True, is_superuser=True)
+        self.token_queries(self.client)
+        admin_client = APIClient()
+        admin_client.force_login(admin)
+        response = admin_client.post('/admin/users/user/', {
+            'action': 'deactivate', '_selected_action': [self.reader.id]})
+        self.assertEqual(response.status_code, 302)
+        self.reader.refresh_from_db()
+        self.assertFalse(self.reader.is_active)
+        self.assertEqual(self.token_queries(self.client)[0], 401)
+
+    def test_profile_update_refreshes_documents(self):
+        recipe = create_recipe(self.author)
+        User.objects.filter(id=self.author.id).update(first_name='Новое')
+        data = self.anonymous.get(f'/api/recipes/{recipe.id}/').json()
+        self.assertEqual(data['author']['first_name'], 'Новое')
+
+
+class ThrottleTest(APITestBase):
+
+    def setUp(self):
+        super().setUp()
+        shm = tempfile.TemporaryDirectory()
+        self.addCleanup(shm.cleanup)
+        patcher = mock.patch('api.throttling.buckets', SharedBuckets(
+            os.path.join(shm.name, 'throttle'), 4, 4))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        override = self.settings(REST_FRAMEWORK=dict(
+            settings.REST_FRAMEWORK,
+            DEFAULT_THROTTLE_RATES={'anon_read': '2/min'}))
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def get_tags(self, forwarded_for):
+        return self.anonymous.get(
+            '/api/tags/', REMOTE_ADDR='172.18.0.5',
+            HTTP_X_FORWARDED_FOR=forwarded_for).status_code
+
+    def test_spoofed_forwarded_for_shares_bucket(self):
+        codes = [self.get_tags(f'10.0.0.{number}, 203.0.113.7')
+                 for number in range(3)]
+        self.assertEqual(codes, [200, 200, 429])
+
+    def test_clients_have_own_buckets(self):
+        self.assertEqual(self.get_tags('203.0.113.7'), 200)
+        self.assertEqual(self.get_tags('203.0.113.7'), 200)
+        self.assertEqual(self.get_tags('203.0.113.7'), 429)
+        self.assertEqual(self.get_tags('203.0.113.8'), 200)
+
+
+class ReplicaCacheTest(APITestBase):
+    """Ответы, которые попадают в кэш, строятся по основной базе."""
+
+    def setUp(self):
+        super().setUp()
+        self.handler_reads = []
+        for name in ('list_documents', 'retrieve_document'):
+            original = getattr(RecipeViewSet, name)
+            patcher = mock.patch.object(
+                RecipeViewSet, name, autospec=True,
+                side_effect=self.recording(original))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def recording(self, handler):
+        def wrapper(*args, **kwargs):
+            self.handler_reads.append(use_replica.get())
+            return handler(*args, **kwargs)
+        return wrapper
+
+    def test_anonymous_responses_built_from_primary(self):
+        recipe = create_recipe(self.author)
+        for _ in range(2):
+            self.assertEqual(
+                self.anonymous.get('/api/recipes/').status_code, 200)
+            self.assertEqual(self.anonymous.get(
+                f'/api/recipes/{recipe.id}/').status_code, 200)
+        self.assertEqual(self.handler_reads, [False, False])
+        self.assertEqual(stats()['hits'], 2)
+
+    def test_user_reads_use_replica(self):
+        create_recipe(self.author)
+        self.assertEqual(self.client.get('/api/recipes/').status_code, 200)
+        self.assertEqual(self.handler_reads, [True])
+
+
+class PrimaryPinTest(APITestBase):
+    """После своей записи пользователь читает с основной базы."""
+
+    def setUp(self):
+        super().setUp()
+        pins = tempfile.TemporaryDirectory()
+        self.addCleanup(pins.cleanup)
+        override = self.settings(DATABASE_REPLICAS=['default'], CACHES=dict(
+            LOCMEM, pins={
+                'BACKEND':
+                    'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': pins.name}))
+        override.enable()
+        self.addCleanup(override.disable)
+        self.recipe = create_recipe(self.author)
+
+    def pinned_in_another_process(self, user):
+        # у другого процесса свой объект кэша, общие только файлы
+        other = caches.create_connection('pins')
+        return other.get(f'db-pin:{user.id}') is not None
+
+    def test_successful_write_pins(self):
+        response = self.client.post(f'/api/recipes/{self.recipe.id}/favorite/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.pinned_in_another_process(self.reader))
+        self.assertFalse(self.pinned_in_another_process(self.author))
+
+    def test_failed_write_does_not_pin(self):
+        response = self.client.post(
+            f'/api/recipes/{self.recipe.id + 100}/favorite/')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(is_pinned(self.reader))
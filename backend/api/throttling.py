@@ -0,0 +1,182 @@
+"""Ограничение частоты запросов корзинами токенов.
+
+Корзины лежат в файле, отображённом в память (по умолчанию в /dev/shm),
+поэтому их видят все процессы gunicorn на машине без внешнего сервиса.
+Файл разбит на наборы по THROTTLE_WAYS корзин; корзина ищется в наборе по
+хэшу ключа, а новый ключ вытесняет корзину, к которой дольше всего не
+обращались. Набор на время изменения блокируется fcntl-блокировкой своего
+участка файла. В конце файла — счётчики отклонённых запросов по областям;
+SharedCounters без корзин так же хранит и другие счётчики, см. api/cache.py.
+
+Область запроса: export для действий из throttle_scopes вьюсета, write для
+изменяющих запросов, user_read и anon_read для чтения. Предел действия
+'<basename>.<action>' из DEFAULT_THROTTLE_RATES заменяет предел области.
+"""
+import fcntl
+import functools
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from django.conf import settings
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+SLOT = struct.Struct('<16sdd')
+COUNTER = struct.Struct('<32sq')
+COUNTERS = 128
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+@functools.lru_cache(maxsize=64)
+def parse_rate(rate):
+    """'60/min' -> (60, 60.0): ёмкость корзины и период в секундах."""
+    count, period = rate.split('/')
+    return int(count), float(PERIODS[period[0]])
+
+
+class SharedCounters:
+    """Именованные счётчики в файле общей памяти процессов.
+
+    Счётчики лежат в конце файла, с отступа buckets_size.
+    """
+    buckets_size = 0
+
+    def __init__(self, path):
+        self.path = path
+        self.size = self.buckets_size + COUNTERS * COUNTER.size
+        self._lock = threading.Lock()
+        self._map = None
+
+    def _open(self):
+        if self._map is not None:
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size < self.size:
+            os.ftruncate(fd, self.size)
+        self._fd, self._map = fd, mmap.mmap(fd, self.size)
+
+    @contextmanager
+    def _locked(self, start, length):
+        # fcntl не разделяет потоки одного процесса, поэтому нужен и Lock
+        with self._lock:
+            self._open()
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+            try:
+                yield self._map
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+    def count(self, name):
+        """Увеличивает счётчик name на единицу."""
+        raw = name.encode()[:COUNTER.size - 8]
+        with self._locked(self.buckets_size,
+                          COUNTERS * COUNTER.size) as memory:
+            first = zlib.crc32(raw) % COUNTERS
+            for probe in range(COUNTERS):
+                offset = self.buckets_size + (
+                    (first + probe) % COUNTERS) * COUNTER.size
+                stored, value = COUNTER.unpack_from(memory, offset)
+                stored = stored.rstrip(b'\0')
+                if stored in (raw, b''):
+                    COUNTER.pack_into(memory, offset, raw, value + 1)
+                    return
+
+    def counters(self):
+        with self._locked(self.buckets_size,
+                          COUNTERS * COUNTER.size) as memory:
+            entries = [
+                COUNTER.unpack_from(
+                    memory, self.buckets_size + index * COUNTER.size)
+                for index in range(COUNTERS)]
+        return {
+            stored.rstrip(b'\0').decode(errors='replace'): value
+            for stored, value in entries if value}
+
+
+class SharedBuckets(SharedCounters):
+    """Корзины токенов и счётчики в общей памяти процессов."""
+
+    def __init__(self, path, sets, ways):
+        self.sets, self.ways = sets, ways
+        self.buckets_size = sets * ways * SLOT.size
+        # в имени файла — его разметка, чтобы смена настроек не читала
+        # чужие данные
+        super().__init__(f'{path}-{sets}x{ways}')
+
+    def take(self, key, capacity, period, now=None):
+        """Берёт токен из корзины key.
+
+        Возвращает (разрешено, сколько секунд ждать следующего токена).
+        """
+        now = time.time() if now is None else now
+        rate = capacity / period
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        start = int.from_bytes(digest[:8], 'little') % self.sets * (
+            self.ways * SLOT.size)
+        with self._locked(start, self.ways * SLOT.size) as memory:
+            slots = [
+                SLOT.unpack_from(memory, start + way * SLOT.size)
+                for way in range(self.ways)]
+            for way, (stored, tokens, stamp) in enumerate(slots):
+                if stored == digest:
+                    break
+            else:
+                way = min(range(self.ways), key=lambda way: slots[way][2])
+                tokens, stamp = capacity, now
+            tokens = min(capacity, tokens + max(now - stamp, 0) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            SLOT.pack_into(memory, start + way * SLOT.size, digest, tokens,
+                           now)
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+
+buckets = SharedBuckets(
+    settings.THROTTLE_SHM_PATH, settings.THROTTLE_SETS,
+    settings.THROTTLE_WAYS)
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Корзина токенов на пользователя (или адрес) и область запроса."""
+
+    def get_scope(self, request, view):
+        rates = api_settings.DEFAULT_THROTTLE_RATES
+        action = getattr(view, 'action', None)
+        own = f'{getattr(view, "basename", None)}.{action}'
+        if own in rates:
+            return own
+        scope = getattr(view, 'throttle_scopes', {}).get(action)
+        if scope:
+            return scope
+        if request.method not in SAFE_METHODS:
+            return 'write'
+        if request.user and request.user.is_authenticated:
+            return 'user_read'
+        return 'anon_read'
+
+    def get_ident(self, request):
+        if request.user and request.user.is_authenticated:
+            return f'user:{request.user.pk}'
+        return super().get_ident(request)
+
+    def allow_request(self, request, view):
+        scope = self.get_scope(request, view)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope)
+        if rate is None:
+            return True
+        allowed, self.delay = buckets.take(
+            f'{scope}:{self.get_ident(request)}', *parse_rate(rate))
+        if not allowed:
+            buckets.count(scope)
+        return allowed
+
+    def wait(self):
+        return self.delay
@@ -0,0 +1,353 @@
+"""Выгрузка и загрузка рецептов в формате NDJSON.
+
+Одна строка — один рецепт с тегами, ингредиентами, ссылкой на автора и,
+по желанию, самой картинкой в base64. Выгрузка читает рецепты порциями по
+id, поэтому память не зависит от размера каталога. Загрузка пишет порциями в
+отдельных транзакциях и после каждой сообщает номер последней сохранённой
+строки: с него можно продолжить после сбоя.
+"""
+import base64
+import binascii
+import json
+import posixpath
+from itertools import islice
+
+from django.core.exceptions import SuspiciousFileOperation, ValidationError
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.db.models import Prefetch
+from django.utils.dateparse import parse_datetime
+
+from recipes.models import (Ingredient, IngredientRecipe, Recipe, Tag,
+                            TagRecipe)
+from recipes.signals import ingredients_loaded
+from users.models import User
+
+from .cache import invalidate, membership_deps
+from .counters import added
+from .documents import refresh_documents
+from .feed import deliver
+from .images import release_image
+from .models import ChangeCounter
+from .scores import create_scores
+
+IMAGE_FIELD = Recipe._meta.get_field('image')
+UNIT_MAX_LENGTH = Ingredient._meta.get_field('measurement_unit').max_length
+RECIPE_UNCHECKED = ('author', 'image', 'pub_date', 'document',
+                    'image_variants', 'favorites_count')
+
+
+class RecordError(ValueError):
+    """Ошибка в строке файла загрузки."""
+
+
+def export_queryset():
+    return Recipe.objects.select_related('author').prefetch_related(
+        Prefetch('tag_recipe',
+                 queryset=TagRecipe.objects.select_related('tags')),
+        Prefetch('recipe',
+                 queryset=IngredientRecipe.objects.select_related(
+                     'ingredients')))
+
+
+def export_recipe(recipe, images=True):
+    image = {'name': recipe.image.name} if recipe.image else None
+    if image and images:
+        with recipe.image.open('rb') as source:
+            image['data'] = base64.b64encode(source.read()).decode()
+    return {
+        'id': recipe.id,
+        'name': recipe.name,
+        'text': recipe.text,
+        'cooking_time': recipe.cooking_time,
+        'pub_date': recipe.pub_date.isoformat(),
+        'author': {
+            'username': recipe.author.username,
+            'email': recipe.author.email,
+        },
+        'tags': [
+            {
+                'name': tag_recipe.tags.name,
+                'slug': tag_recipe.tags.slug,
+                'color': tag_recipe.tags.color,
+            }
+            for tag_recipe in recipe.tag_recipe.all()],
+        'ingredients': [
+            {
+                'name': ingredient_recipe.ingredients.name,
+                'measurement_unit':
+                    ingredient_recipe.ingredients.measurement_unit,
+                'amount': ingredient_recipe.amount,
+            }
+            for ingredient_recipe in recipe.recipe.all()],
+        'image': image,
+    }
+
+
+def export_recipes(queryset=None, chunk_size=500, images=True, after_id=0):
+    """Строки NDJSON с рецептами в порядке id, начиная после after_id."""
+    queryset = export_queryset() if queryset is None else queryset
+    while True:
+        # связи подгружаются запросом на порцию, а не на рецепт
+        chunk = list(queryset.filter(id__gt=after_id).order_by('id')[
+            :chunk_size])
+        for recipe in chunk:
+            yield json.dumps(
+                export_recipe(recipe, images), ensure_ascii=False) + '\n'
+        if len(chunk) < chunk_size:
+            return
+        after_id = chunk[-1].id
+
+
+class RecipeImporter:
+    """Загружает рецепты из строк NDJSON порциями.
+
+    Ингредиенты и теги ищутся в словарях, загруженных один раз; недостающие
+    создаются. Авторы ищутся по username одним запросом на порцию; рецепты
+    неизвестных авторов пропускаются с ошибкой в отчёте.
+    """
+
+    def __init__(self, batch_size=200):
+        self.batch_size = batch_size
+        self.imported = 0
+        self.errors = []
+        self.created_ingredients = self.created_tags = False
+        self.load_lookups()
+
+    def load_lookups(self):
+        self.ingredients = {
+            (name, unit): pk for pk, name, unit in
+            Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit').iterator()}
+        self.tags = dict(Tag.objects.values_list('slug', 'id'))
+
+    def run(self, lines, start=0, on_batch=None):
+        """Загружает строки после первых start.
+
+        on_batch(line) вызывается после фиксации каждой порции с номером
+        последней обработанной строки. Возвращает этот номер.
+        """
+        numbered = islice(enumerate(lines, 1), start, None)
+        position = start
+        while True:
+            batch = list(islice(numbered, self.batch_size))
+            if not batch:
+                return position
+            records = []
+            for number, line in batch:
+                if isinstance(line, bytes):
+                    line = line.decode('utf-8')
+                if not line.strip():
+                    continue
+                try:
+                    records.append((number, self.parse(line)))
+                except RecordError as error:
+                    self.errors.append((number, str(error)))
+            self.save_batch(records)
+            position = batch[-1][0]
+            if on_batch is not None:
+                on_batch(position)
+
+    @staticmethod
+    def parse(line):
+        try:
+            record = json.loads(line)
+            pub_date = parse_datetime(record['pub_date'])
+            if not isinstance(record['author']['username'], str):
+                raise TypeError
+            ingredients = [
+                (str(item['name']), str(item['measurement_unit']),
+                 int(item['amount']))
+                for item in record['ingredients']]
+            tags = [
+                (str(tag['slug']), str(tag['name']), str(tag['color']))
+                for tag in record['tags']]
+            recipe = Recipe(
+                name=str(record['name']), text=str(record['text']),
+                cooking_time=int(record['cooking_time']))
+            image = record.get('image') or {}
+            if image.get('data'):
+                content = base64.b64decode(image['data'], validate=True)
+            else:
+                content = None
+        except (ValueError, TypeError, KeyError, AttributeError,
+                binascii.Error) as error:
+            raise RecordError(f'Неверная строка: {error!r}')
+        try:
+            recipe.clean_fields(exclude=RECIPE_UNCHECKED)
+        except ValidationError as error:
+            raise RecordError(f'Неверный рецепт: {error.message_dict}')
+        if any(amount < 1 or len(unit) > UNIT_MAX_LENGTH
+               for _, unit, amount in ingredients):
+            raise RecordError('Неверный ингредиент')
+        if pub_date is None:
+            raise RecordError('Неверная дата публикации')
+        if not ingredients:
+            raise RecordError('Нет ингредиентов')
+        image_name = image.get('name')
+        if not image_name:
+            raise RecordError('Нет картинки')
+        # имя без данных — файл в хранилище, выходить за его пределы нельзя
+        if (not isinstance(image_name, str) or image_name.startswith('/')
+                or '\\' in image_name or '..' in image_name.split('/')):
+            raise RecordError(f'Неверное имя картинки: {image_name!r}')
+        recipe.pub_date = pub_date
+        return {
+            'recipe': recipe,
+            'author': record['author']['username'],
+            'ingredients': ingredients,
+            'tags': tags,
+            'image_name': image_name,
+            'image_content': content,
+        }
+
+    def resolve_ingredients(self, records):
+        missing = {
+            (name, unit) for record in records
+            for name, unit, _ in record['ingredients']
+        } - self.ingredients.keys()
+        if missing:
+            Ingredient.objects.bulk_create(
+                Ingredient(name=name, measurement_unit=unit)
+                for name, unit in missing)
+            self.created_ingredients = True
+            self.ingredients.update(
+                ((name, unit), pk) for pk, name, unit in
+                Ingredient.objects.filter(
+                    name__in={name for name, _ in missing}).values_list(
+                    'id', 'name', 'measurement_unit'))
+
+    def resolve_tags(self, records):
+        missing = {}
+        for record in records:
+            for slug, name, color in record['tags']:
+                if slug not in self.tags:
+                    missing[slug] = Tag(slug=slug, name=name, color=color)
+        if missing:
+            Tag.objects.bulk_create(missing.values(), ignore_conflicts=True)
+            self.created_tags = True
+            self.tags.update(Tag.objects.filter(
+                slug__in=missing).values_list('slug', 'id'))
+
+    def store_image(self, record):
+        # одинаковые картинки хранилище сохраняет один раз
+        storage = IMAGE_FIELD.storage
+        content = record['image_content']
+        try:
+            if content is None:
+                if not storage.exists(record['image_name']):
+                    raise RecordError(
+                        f'Картинка {record["image_name"]} не найдена')
+                return record['image_name']
+            name = IMAGE_FIELD.generate_filename(
+                None, posixpath.basename(record['image_name']))
+            record['stored_image'] = storage.save(name, ContentFile(content))
+        except SuspiciousFileOperation as error:
+            raise RecordError(f'Неверное имя картинки: {error}')
+        return record['stored_image']
+
+    def store_images(self, records):
+        stored = []
+        for number, record in records:
+            try:
+                record['recipe'].image = self.store_image(record)
+            except (RecordError, OSError) as error:
+                self.errors.append((number, str(error)))
+                continue
+            stored.append(record)
+        return stored
+
+    @staticmethod
+    def release_images(records):
+        # после отката на сохранённые картинки никто не ссылается; файл,
+        # который уже был у другого рецепта, release_image не тронет
+        for _, record in records:
+            if record.get('stored_image'):
+                release_image(IMAGE_FIELD.storage, record['stored_image'])
+
+    def save_batch(self, records):
+        authors = dict(User.objects.filter(
+            username__in={record['author'] for _, record in records}
+        ).values_list('username', 'id'))
+        found = []
+        for number, record in records:
+            if record['author'] not in authors:
+                self.errors.append(
+                    (number, f'Автор {record["author"]} не найден'))
+                continue
+            record['recipe'].author_id = authors[record['author']]
+            found.append((number, record))
+        if not found:
+            return
+
+        try:
+            ready, documents = self.write(found)
+        except Exception:
+            # созданные в откаченной транзакции id больше не существуют
+            self.load_lookups()
+            self.release_images(found)
+            raise
+        deps = set()
+        for record in ready:
+            recipe = record['recipe']
+            deps.update(membership_deps(recipe.author_id, {
+                tag['slug'] for tag in documents[recipe.id]['tags']}))
+        invalidate(*deps)
+        self.imported += len(ready)
+
+    def write(self, records):
+        """Сохраняет порцию в одной транзакции вместе с картинками.
+
+        Картинки пишутся внутри транзакции, чтобы их файлы оставались
+        заблокированы до фиксации. Возвращает сохранённые записи и их
+        документы.
+        """
+        with transaction.atomic():
+            ready = self.store_images(records)
+            if not ready:
+                return ready, {}
+            self.resolve_ingredients(ready)
+            self.resolve_tags(ready)
+            recipes = [record['recipe'] for record in ready]
+            pub_dates = [recipe.pub_date for recipe in recipes]
+            if connection.features.can_return_rows_from_bulk_insert:
+                Recipe.objects.bulk_create(recipes)
+                # bulk_create не вызывает post_save
+                added(Recipe, recipes)
+                create_scores(recipe.id for recipe in recipes)
+            else:
+                for recipe in recipes:
+                    recipe.save()
+            # auto_now_add подменяет дату при вставке, возвращаем исходную
+            for recipe, pub_date in zip(recipes, pub_dates):
+                recipe.pub_date = pub_date
+            Recipe.objects.bulk_update(recipes, ('pub_date',))
+            # bulk_create не вызывает post_save, а в ящиках нужны
+            # восстановленные даты
+            deliver(recipe.id for recipe in recipes)
+            amounts, tags = [], []
+            for record in ready:
+                recipe = record['recipe']
+                merged = {}
+                for name, unit, amount in record['ingredients']:
+                    key = self.ingredients[(name, unit)]
+                    merged[key] = merged.get(key, 0) + amount
+                amounts += [
+                    IngredientRecipe(
+                        recipe=recipe, ingredients_id=key, amount=amount)
+                    for key, amount in merged.items()]
+                tags += [
+                    TagRecipe(recipe=recipe, tags_id=tag_id)
+                    for tag_id in {self.tags[slug]
+                                   for slug, _, _ in record['tags']}]
+            IngredientRecipe.objects.bulk_create(amounts)
+            TagRecipe.objects.bulk_create(tags)
+            return ready, refresh_documents([recipe.id for recipe in recipes])
+
+    def finish(self):
+        """Сообщает об ингредиентах и тегах, созданных при загрузке."""
+        if self.created_ingredients:
+            ingredients_loaded.send(sender=Ingredient)
+        if self.created_tags:
+            ChangeCounter.bump('tags')
+            invalidate('list:tags')
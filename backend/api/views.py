@@ -1,37 +1,51 @@
+import hashlib
 from typing import Type
 
+from django.conf import settings as django_settings
 from django.contrib.auth.tokens import default_token_generator
-from django.db import models
-from django.db.models import Count, Exists, OuterRef, Sum
+from django.db import DatabaseError, models
+from django.db.models import Exists, OuterRef
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.conf import settings
 from djoser.views import UserViewSet
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 
-from recipes.models import (Favorite, Follow, Ingredient, IngredientRecipe,
-                            Recipe, ShoppingCart, Tag)
+from recipes.models import (Favorite, Follow, Ingredient, Recipe,
+                            ShoppingCart, Tag)
 from users.models import User
 
-from .filters import CustomSearchFilter, RecipeFilter
-from .permissions import AuthorPermission, ReadOnly
+from .autocomplete import ingredient_index
+from .cache import SCORES_KEY, cached_response, counters_epoch
+from .documents import render_recipes
+from .feed import Feed, FeedPaginator
+from .filters import RecipeFilter
+from .mixins import ConditionalGetMixin, ReplicaReadMixin
+from .permissions import AuthorPermission, IsAdmin, ReadOnly
+from .renderers import CSVRenderer, PDFRenderer, PlainTextRenderer
+from .scores import SCORES
 from .serializers import (FavoriteSerializer, FollowSerializer,
                           IngredientSerializer, MyUserAndRecipeSerializer,
                           ReadRecipeSerializer, TagSerializer,
                           WriteRecipeSerializer)
+from .shopping import RENDERERS, pdf_available, shopping_list
+from .transfer import RecipeImporter, export_recipes
 
 
-class MyUserViewSet(UserViewSet):
+class MyUserViewSet(ReplicaReadMixin, UserViewSet):
     """Вьюсет для эндпоинтов пользователя."""
     serializer_class = settings.SERIALIZERS.user
     queryset = User.objects.all()
     permission_classes = settings.PERMISSIONS.user
     token_generator = default_token_generator
     lookup_field = settings.USER_ID_FIELD
+    keyset_ordering = ('id',)
 
     @action(methods=['GET'], detail=False)
     def me(self, request, *args, **kwargs):
@@ -49,8 +63,8 @@ class MyUserViewSet(UserViewSet):
             if self.action == 'subscriptions':
                 return User.objects.annotate(
                     is_subscribed=Exists(Follow.objects.filter(
-                        user=self.request.user, author=OuterRef('id'))),
-                    recipes_count=Count('recipes')).filter(is_subscribed=True)
+                        user=self.request.user, author=OuterRef('id')))
+                ).filter(is_subscribed=True).order_by('id')
             return User.objects.annotate(
                 is_subscribed=Exists(Follow.objects.filter(
                     user=self.request.user, author=OuterRef('id'))))
@@ -79,8 +93,7 @@ class MyUserViewSet(UserViewSet):
             serializer.save(user=self.request.user, author=author)
             instance = User.objects.annotate(
                 is_subscribed=Exists(Follow.objects.filter(
-                    user=self.request.user, author=author)),
-                recipes_count=Count('recipes')).get(id=author.id)
+                    user=self.request.user, author=author))).get(id=author.id)
             serializer = self.get_serializer(instance)
             return Response(serializer.data, status=status.HTTP_200_OK)
         if request.method == 'DELETE':
@@ -91,31 +104,69 @@ class MyUserViewSet(UserViewSet):
             return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class TagViewSet(ReadOnlyModelViewSet):
+class TagViewSet(ReplicaReadMixin, ConditionalGetMixin,
+                 ReadOnlyModelViewSet):
     """Вьюсет тегов."""
     queryset = Tag.objects.all()
+    version_key = 'tags'
     serializer_class = TagSerializer
     permission_classes = (ReadOnly,)
     pagination_class = None
 
 
-class IngredientViewSet(ReadOnlyModelViewSet):
-    """Вьюсет ингредиентов."""
+class IngredientViewSet(ReplicaReadMixin, ConditionalGetMixin,
+                        ReadOnlyModelViewSet):
+    """Вьюсет ингредиентов.
+
+    Список и поиск по параметру name обслуживаются индексом в памяти.
+    """
     queryset = Ingredient.objects.all()
+    version_key = 'ingredients'
     serializer_class = IngredientSerializer
     permission_classes = (ReadOnly,)
     pagination_class = None
-    search_fields = ('^name',)
-    filter_backends = (CustomSearchFilter,)
 
+    def get_validators(self, request):
+        if self.action != 'list':
+            return super().get_validators(request)
+        # версия берётся из индекса, поиск использует то же состояние
+        state = self.index_state = ingredient_index.get_state()
+        fingerprint = f'{state.version}|{request.get_full_path()}'
+        etag = '"%s"' % hashlib.md5(fingerprint.encode()).hexdigest()
+        modified = state.modified and int(state.modified.timestamp())
+        return etag, modified
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(self.search, request, *args, **kwargs)
+
+    def search(self, request, *args, **kwargs):
+        name = request.query_params.get('name', '')
+        limit = request.query_params.get('limit')
+        if limit is not None:
+            try:
+                limit = max(0, int(limit))
+            except ValueError:
+                raise ValidationError({'limit': 'Укажите целое число.'})
+        elif name:
+            limit = django_settings.INGREDIENT_SEARCH_LIMIT
+        return Response(ingredient_index.search(
+            name, limit, getattr(self, 'index_state', None)))
 
-class RecipeViewSet(ModelViewSet):
+
+class RecipeViewSet(ReplicaReadMixin, ConditionalGetMixin, ModelViewSet):
     """Вьюсет рецепта."""
     queryset = Recipe.objects.all()
+    version_key = 'recipes'
+    user_dependent = True
     filter_backends = (DjangoFilterBackend,)
     ordering = ('pub_date',)
     http_method_names = ['get', 'post', 'patch', 'delete', 'head', 'options']
     filterset_class = (RecipeFilter)
+    throttle_scopes = {
+        'download_shopping_cart': 'export',
+        'export': 'export',
+        'import_recipes': 'export',
+    }
     lookup_field = Recipe._meta.pk.name
 
     def get_permissions(self):
@@ -127,6 +178,56 @@ class RecipeViewSet(ModelViewSet):
             return (AuthorPermission(),)
         return super().get_permissions()
 
+    @property
+    def keyset_ordering(self):
+        score = self.request.query_params.get('ordering')
+        if score in SCORES:
+            return (f'-score__{score}', '-id')
+        return ('-pub_date', '-id')
+
+    def get_version_keys(self):
+        if self.action == 'retrieve':
+            return [f'recipe:{self.kwargs[self.lookup_field]}']
+        keys = super().get_version_keys()
+        if self.request.query_params.get('ordering'):
+            keys.append(SCORES_KEY)
+        return keys
+
+    def get_validators(self, request):
+        # счётчики в ответе меняются без смены версий, поэтому валидаторы
+        # действуют не дольше RECIPE_COUNTERS_TTL секунд
+        etag, last_modified = super().get_validators(request)
+        epoch = counters_epoch()
+        etag = '"%s"' % hashlib.md5(f'{etag}|{epoch}'.encode()).hexdigest()
+        started = epoch * django_settings.RECIPE_COUNTERS_TTL
+        return etag, max(last_modified or 0, started)
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(self.cached_list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(
+            self.cached_retrieve, request, *args, **kwargs)
+
+    def cached_list(self, request, *args, **kwargs):
+        return cached_response(
+            self, self.list_documents, request, *args, **kwargs)
+
+    def cached_retrieve(self, request, *args, **kwargs):
+        return cached_response(
+            self, self.retrieve_document, request, *args, **kwargs)
+
+    def list_documents(self, request, *args, **kwargs):
+        # ответ собирается из готовых документов рецептов
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(render_recipes(page, request))
+        return Response(render_recipes(queryset, request))
+
+    def retrieve_document(self, request, *args, **kwargs):
+        return Response(render_recipes([self.get_object()], request)[0])
+
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
@@ -141,20 +242,6 @@ class RecipeViewSet(ModelViewSet):
             return FavoriteSerializer
         return ReadRecipeSerializer
 
-    def get_queryset(self):
-        if self.request.user.is_authenticated:
-            recipes = Recipe.objects.all()
-            recipes.annotate(is_subscribed=Exists(Follow.objects.filter(
-                user=self.request.user, author=recipes.values('author'))))
-            return recipes.annotate(
-                is_favorited=Exists(Favorite.objects.filter(
-                    user=self.request.user, recipe=OuterRef('id'))),
-                is_in_shopping_cart=Exists(ShoppingCart.objects.filter(
-                    user=self.request.user, recipe=OuterRef('id')))
-            )
-
-        return super().get_queryset()
-
     def _add_to_shopping_or_favorite(
             self, Model: Type[models.base.ModelBase], request, word, *args, **kwargs):
         recipe = get_object_or_404(Recipe, id=self.kwargs.get('id'))
@@ -184,16 +271,80 @@ class RecipeViewSet(ModelViewSet):
         return self._add_to_shopping_or_favorite(
             ShoppingCart, request, 'списке покупок', *args, **kwargs)
 
+    @action(methods=['GET'], detail=False, pagination_class=FeedPaginator,
+            permission_classes=(IsAuthenticated,))
+    def feed(self, request, *args, **kwargs):
+        """Рецепты авторов из подписок, от новых к старым."""
+        page = self.paginate_queryset(Feed(request.user))
+        recipes = Recipe.objects.only(
+            'id', 'author_id', 'document', 'favorites_count').in_bulk(
+            [entry.recipe_id for entry in page])
+        return self.get_paginated_response(render_recipes(
+            [recipes[entry.recipe_id] for entry in page
+             if entry.recipe_id in recipes], request))
+
+    @action(methods=['GET'], detail=False,
+            permission_classes=(IsAdmin,))
+    def export(self, request, *args, **kwargs):
+        """Выгрузка рецептов в NDJSON для переноса между окружениями."""
+        try:
+            after_id = int(request.query_params.get('after_id', 0))
+        except ValueError:
+            raise ValidationError({'after_id': 'Ожидается целое число.'})
+        images = request.query_params.get('images') not in ('0', 'false')
+        response = StreamingHttpResponse(
+            (line.encode() for line in export_recipes(
+                images=images, after_id=after_id)),
+            content_type='application/x-ndjson; charset=utf-8')
+        response['Content-Disposition'] = (
+            'attachment; filename="recipes.ndjson"')
+        return response
+
+    @action(methods=['POST'], detail=False, url_path='import',
+            permission_classes=(IsAdmin,))
+    def import_recipes(self, request, *args, **kwargs):
+        """Загрузка NDJSON из тела запроса.
+
+        Если загрузка прервалась, её можно продолжить, передав в параметре
+        start значение position из ответа.
+        """
+        try:
+            start = int(request.query_params.get('start', 0))
+        except ValueError:
+            raise ValidationError({'start': 'Ожидается целое число.'})
+        importer = RecipeImporter()
+        committed = [start]
+        try:
+            importer.run(request.stream or (), start=start,
+                         on_batch=committed.append)
+        except DatabaseError:
+            failed = True
+        else:
+            failed = False
+        finally:
+            importer.finish()
+        return Response({
+            'imported': importer.imported,
+            'position': committed[-1],
+            'errors': [
+                {'line': number, 'error': error}
+                for number, error in importer.errors],
+        }, status=(status.HTTP_500_INTERNAL_SERVER_ERROR if failed
+                   else status.HTTP_200_OK))
+
     # скачать спискок покупок
-    @action(methods=['GET'], detail=False)
+    @action(methods=['GET'], detail=False, renderer_classes=(
+        PlainTextRenderer, CSVRenderer, PDFRenderer))
     def download_shopping_cart(self, request, *args, **kwargs):
-        user = request.user
-        ing = 'Список покупок: '
-        ingredients_list = IngredientRecipe.objects.filter(
-            recipe__selected_recipe_cart__user=user).values(
-            'ingredients__name',
-            'ingredients__measurement_unit').annotate(
-            Sum('amount'))
-        for item in ingredients_list:
-            ing += f"{item['ingredients__name']} ({item['ingredients__measurement_unit']}) - {str(item['amount__sum'])} ; "
-        return Response(ing, content_type='text/plain')
+        renderer = request.accepted_renderer
+        if renderer.format == 'pdf' and not pdf_available():
+            raise ValidationError('Список покупок в PDF сейчас недоступен.')
+        content_type = renderer.media_type
+        if renderer.charset:
+            content_type += f'; charset={renderer.charset}'
+        response = StreamingHttpResponse(
+            RENDERERS[renderer.format](shopping_list(request.user)),
+            content_type=content_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename="shopping_list.{renderer.format}"')
+        return response
@@ -1,4 +1,6 @@
+import hashlib
 import os
+import tempfile
 
 from dotenv import load_dotenv
 
@@ -45,6 +47,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.replicas.PrimaryPinMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
@@ -86,6 +89,78 @@ DATABASES = {
     }
 }
 
+# реплики только для чтения, см. api/replicas.py: в DB_REPLICAS через
+# запятую адреса серверов, а для SQLite — файлы баз
+DATABASE_REPLICAS = []
+for index, location in enumerate(
+        filter(None, os.getenv('DB_REPLICAS', '').split(',')), 1):
+    replica = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+    if 'sqlite3' in (replica['ENGINE'] or ''):
+        replica['NAME'] = location.strip()
+    else:
+        replica['HOST'] = location.strip()
+    DATABASES[f'replica{index}'] = replica
+    DATABASE_REPLICAS.append(f'replica{index}')
+DATABASE_ROUTERS = ['api.replicas.ReplicaRouter']
+# сколько секунд после своей записи пользователь читает с основной базы
+DATABASE_PIN_SECONDS = int(os.getenv('DATABASE_PIN_SECONDS', 10))
+
+
+# каталог в общей памяти для данных, которые видят все процессы на машине;
+# кэши в нём читаются через pickle, поэтому имя не угадать без SECRET_KEY, а
+# права 0700 проверяются при запуске, см. api/apps.py
+SHARED_MEMORY_DIR = os.getenv('SHARED_MEMORY_DIR', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+    'foodgram-' + hashlib.sha256(
+        (SECRET_KEY or '').encode()).hexdigest()[:16]))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # ответы для анонимных пользователей, см. api/cache.py; версии
+    # зависимостей хранятся в базе, поэтому бэкенд может быть и в памяти
+    # процесса
+    'responses': {
+        'BACKEND': os.getenv(
+            'RESPONSE_CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('RESPONSE_CACHE_LOCATION', 'responses'),
+        'TIMEOUT': int(os.getenv('RESPONSE_CACHE_TIMEOUT', 300)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 2000)),
+        },
+    },
+    # пользователи по токенам, см. api/authentication.py; отзыв токена
+    # должны видеть все процессы, поэтому кэш не в памяти процесса, а в
+    # файлах общей памяти (или в общем бэкенде вроде Redis)
+    'tokens': {
+        'BACKEND': os.getenv(
+            'TOKEN_CACHE_BACKEND',
+            'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.getenv(
+            'TOKEN_CACHE_LOCATION',
+            os.path.join(SHARED_MEMORY_DIR, 'tokens')),
+        'TIMEOUT': int(os.getenv('TOKEN_CACHE_TIMEOUT', 300)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('TOKEN_CACHE_MAX_ENTRIES', 10000)),
+        },
+    },
+    # отметки о недавней записи пользователя, см. api/replicas.py; запись
+    # и следующее чтение могут попасть в разные процессы
+    'pins': {
+        'BACKEND': os.getenv(
+            'PIN_CACHE_BACKEND',
+            'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.getenv(
+            'PIN_CACHE_LOCATION',
+            os.path.join(SHARED_MEMORY_DIR, 'pins')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('PIN_CACHE_MAX_ENTRIES', 10000)),
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -135,16 +210,95 @@ REST_FRAMEWORK = {
     ],
 
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
     ],
     'DEFAULT_PAGINATION_CLASS':
         'api.paginators.CustomPaginator',
     'PAGE_SIZE': 6,
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
-    ]
+    ],
+    # корзины токенов, см. api/throttling.py; '<basename>.<action>' задаёт
+    # отдельный предел действия вьюсета
+    'DEFAULT_THROTTLE_CLASSES': [
+        'api.throttling.TokenBucketThrottle',
+    ],
+    # перед приложением один nginx (infra/nginx.conf), он дописывает адрес
+    # клиента в конец X-Forwarded-For; всё левее присылает сам клиент
+    'NUM_PROXIES': 1,
+    'DEFAULT_THROTTLE_RATES': {
+        'anon_read': os.getenv('THROTTLE_ANON_READ', '120/min'),
+        'user_read': os.getenv('THROTTLE_USER_READ', '600/min'),
+        'write': os.getenv('THROTTLE_WRITE', '120/min'),
+        'export': os.getenv('THROTTLE_EXPORT', '20/hour'),
+        'recipe.favorite': '60/min',
+        'recipe.shopping_cart': '60/min',
+        'user.subscribe': '60/min',
+        'ingredient.list': '300/min',
+    },
 }
 
+# файл с корзинами токенов, общий для процессов на машине
+THROTTLE_SHM_PATH = os.getenv(
+    'THROTTLE_SHM_PATH', os.path.join(SHARED_MEMORY_DIR, 'throttle'))
+THROTTLE_SETS = int(os.getenv('THROTTLE_SETS', 4096))
+THROTTLE_WAYS = 4
+
+# файл со счётчиками кэша ответов, см. api/cache.py
+RESPONSE_CACHE_STATS_PATH = os.getenv(
+    'RESPONSE_CACHE_STATS_PATH',
+    os.path.join(SHARED_MEMORY_DIR, 'response-stats'))
+
+# сериализаторы горячих эндпоинтов строят ответ без обхода полей DRF
+API_COMPILED_SERIALIZERS = True
+
+# сколько результатов отдаёт поиск ингредиентов
+INGREDIENT_SEARCH_LIMIT = 50
+# сколько секунд счётчики избранного, рецептов и подписчиков в ответах с
+# рецептами и порядок по оценкам могут отставать: на это время ответы
+# остаются в кэше, а ETag рецептов не меняется
+RECIPE_COUNTERS_TTL = int(os.getenv('RECIPE_COUNTERS_TTL', 30))
+
+# как часто (в секундах) индекс ингредиентов в памяти процесса проверяет,
+# не изменили ли их другие процессы
+INGREDIENT_INDEX_CHECK_INTERVAL = int(
+    os.getenv('INGREDIENT_INDEX_CHECK_INTERVAL', 5))
+
+# сколько секунд хранить в кэше общее число объектов при постраничной
+# пагинации; 0 — считать каждый раз
+PAGINATION_COUNT_CACHE_TIMEOUT = int(
+    os.getenv('PAGINATION_COUNT_CACHE_TIMEOUT', 0))
+
+# уменьшенные копии картинок рецептов: наибольшая сторона в пикселях,
+# число фоновых потоков и сколько картинок может ждать обработки
+IMAGE_VARIANTS = {'thumbnail': 320, 'card': 800, 'full': 1600}
+IMAGE_VARIANT_FORMAT = 'WEBP'
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 2))
+IMAGE_QUEUE_SIZE = int(os.getenv('IMAGE_QUEUE_SIZE', 32))
+
+# шрифт TrueType с кириллицей для списка покупок в PDF
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+
+# лента подписок: рецепты авторов, у которых больше FEED_FANOUT_LIMIT
+# подписчиков, не раскладываются по лентам, а читаются при запросе; при
+# подписке в ленту попадают FEED_BACKFILL последних рецептов автора
+FEED_FANOUT_LIMIT = int(os.getenv('FEED_FANOUT_LIMIT', 10000))
+FEED_BACKFILL = int(os.getenv('FEED_BACKFILL', 50))
+FEED_LARGE_AUTHORS_TIMEOUT = int(os.getenv('FEED_LARGE_AUTHORS_TIMEOUT', 300))
+
+# сортировка «в тренде»: вес добавления в избранное и список покупок
+# убывает вдвое за TRENDING_HALF_LIFE часов; оценки пересчитывает команда
+# decay_trending, запускаемая по расписанию, и обнуляет те, что меньше
+# TRENDING_MIN_SCORE
+TRENDING_HALF_LIFE = float(os.getenv('TRENDING_HALF_LIFE', 48))
+TRENDING_MIN_SCORE = 0.01
+
 AUTH_USER_MODEL = 'users.User'
 
 DJOSER = {'HIDE_USERS': False,
@@ -2,6 +2,7 @@ from django.contrib import admin
 
 from .models import (Favorite, Follow, Ingredient, IngredientRecipe, Recipe,
                      ShoppingCart, Tag, TagRecipe)
+from .signals import recipe_saved
 
 
 class TagRecipeInLine(admin.TabularInline):
@@ -46,6 +47,14 @@ class RecipeAdmin(admin.ModelAdmin):
     list_filter = ('author', 'tags', 'ingredients')
     inlines = [IngredientRecipeInLine, TagRecipeInLine]
 
+    def save_related(self, request, form, formsets, change):
+        old_amounts = IngredientRecipe.amounts(
+            form.instance.id) if change else None
+        super().save_related(request, form, formsets, change)
+        recipe_saved.send(
+            sender=Recipe, instance=form.instance, created=not change,
+            old_amounts=old_amounts)
+
 
 @admin.register(Follow)
 class FollowAdmin(admin.ModelAdmin):
@@ -1,5 +1,20 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+
+def restore_search_triggers(sender, using, **kwargs):
+    from .search import restore_sqlite_triggers
+
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        restore_sqlite_triggers(connection)
 
 
 class RecipesConfig(AppConfig):
     name = 'recipes'
+
+    def ready(self):
+        # миграции SQLite, пересоздающие таблицу рецептов, теряют триггеры
+        # поиска
+        post_migrate.connect(restore_search_triggers, sender=self)
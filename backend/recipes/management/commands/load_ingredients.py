@@ -0,0 +1,131 @@
+import csv
+import io
+import os
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from recipes.models import Ingredient
+from recipes.signals import ingredients_loaded
+
+DEFAULT_PATH = os.path.join(
+    os.path.dirname(settings.BASE_DIR), 'data', 'ingredients.csv')
+STAGING = 'ingredient_staging'
+UNIT_MAX_LENGTH = Ingredient._meta.get_field('measurement_unit').max_length
+
+
+class Command(BaseCommand):
+    help = ('Загружает ингредиенты из CSV (название, единица измерения). '
+            'Файл читается потоково и пачками попадает во временную '
+            'таблицу (COPY на PostgreSQL), откуда добавляются только новые '
+            'пары (название, единица).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=DEFAULT_PATH)
+        parser.add_argument(
+            '--mode', choices=('upsert', 'resync'), default='upsert',
+            help='upsert — только добавить новые; resync — ещё и удалить '
+                 'отсутствующие в файле ингредиенты, если они не '
+                 'используются в рецептах. Удаление идёт через ORM, вместе '
+                 'с зависящими строками (например, итогами списков '
+                 'покупок) и сигналами.')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--skip-header', action='store_true')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'Файл {path} не найден')
+        started = time.monotonic()
+        quote = connection.ops.quote_name
+        ingredient = quote(Ingredient._meta.db_table)
+
+        with transaction.atomic(), connection.cursor() as cursor, open(
+                path, encoding='utf-8', newline='') as source:
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE {STAGING} '
+                f'(name TEXT NOT NULL, measurement_unit '
+                f'VARCHAR({UNIT_MAX_LENGTH}) NOT NULL)')
+            rows = csv.reader(source)
+            if options['skip_header']:
+                next(rows, None)
+            read, skipped = self.stage(cursor, rows, options['batch_size'])
+            cursor.execute(
+                f'CREATE INDEX {STAGING}_idx '
+                f'ON {STAGING} (name, measurement_unit)')
+
+            cursor.execute(
+                f'INSERT INTO {ingredient} (name, measurement_unit) '
+                f'SELECT DISTINCT s.name, s.measurement_unit FROM {STAGING} s '
+                f'WHERE NOT EXISTS (SELECT 1 FROM {ingredient} i '
+                f'WHERE i.name = s.name '
+                f'AND i.measurement_unit = s.measurement_unit)')
+            created = cursor.rowcount
+            deleted = 0
+            if options['mode'] == 'resync':
+                deleted = self.remove_missing(
+                    cursor, ingredient, options['batch_size'])
+            cursor.execute(f'DROP TABLE {STAGING}')
+
+        if created or deleted:
+            ingredients_loaded.send(sender=Ingredient)
+        elapsed = max(time.monotonic() - started, 1e-6)
+        self.stdout.write(self.style.SUCCESS(
+            f'Прочитано строк: {read}, пропущено: {skipped}, '
+            f'добавлено: {created}, удалено: {deleted}; '
+            f'{read / elapsed:.0f} строк/с'))
+
+    def remove_missing(self, cursor, ingredient, batch_size):
+        # id выбираются пачками, а удаляются через ORM: каскад и сигналы
+        # обрабатывают зависящие строки, документы и индекс поиска
+        deleted = last_id = 0
+        while True:
+            cursor.execute(
+                f'SELECT id FROM {ingredient} WHERE id > %s AND NOT EXISTS ('
+                f'SELECT 1 FROM {STAGING} s '
+                f'WHERE s.name = {ingredient}.name '
+                f'AND s.measurement_unit = {ingredient}.measurement_unit'
+                f') ORDER BY id LIMIT %s', [last_id, batch_size])
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                return deleted
+            last_id = ids[-1]
+            # используемые в рецептах ингредиенты остаются
+            _, removed = Ingredient.objects.filter(
+                id__in=ids, ingredients__isnull=True).delete()
+            deleted += removed.get(Ingredient._meta.label, 0)
+
+    def stage(self, cursor, rows, batch_size):
+        read = skipped = 0
+        copy = connection.vendor == 'postgresql'
+        while True:
+            batch, chunk = [], 0
+            for row in islice(rows, batch_size):
+                chunk += 1
+                if len(row) < 2 or not row[0].strip() or not row[1].strip():
+                    skipped += 1
+                    continue
+                name, unit = row[0].strip(), row[1].strip()
+                if len(unit) > UNIT_MAX_LENGTH:
+                    skipped += 1
+                    continue
+                batch.append((name, unit))
+            read += chunk
+            if not chunk:
+                return read, skipped
+            if not batch:
+                continue
+            if copy:
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(batch)
+                buffer.seek(0)
+                cursor.copy_expert(
+                    f'COPY {STAGING} (name, measurement_unit) '
+                    f'FROM STDIN WITH (FORMAT csv)', buffer)
+            else:
+                cursor.executemany(
+                    f'INSERT INTO {STAGING} (name, measurement_unit) '
+                    f'VALUES (%s, %s)', batch)
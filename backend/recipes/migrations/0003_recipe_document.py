@@ -0,0 +1,18 @@
+# Generated by Django 3.2.17 on 2026-10-18 03:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0002_auto_20230222_0350'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='document',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='готовое представление рецепта'),
+        ),
+    ]
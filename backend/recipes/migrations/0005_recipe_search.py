@@ -0,0 +1,96 @@
+from django.db import migrations
+
+FTS_TABLE = 'recipes_recipe_fts'
+
+
+def normalized(column):
+    return f"replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+POSTGRESQL_VECTOR = (
+    f"setweight(to_tsvector('russian', "
+    f"coalesce({normalized('NEW.name')}, '')), 'A') || "
+    f"setweight(to_tsvector('russian', "
+    f"coalesce({normalized('NEW.text')}, '')), 'B')")
+
+POSTGRESQL_FORWARD = (
+    'ALTER TABLE recipes_recipe ADD COLUMN search_vector tsvector',
+    f'''CREATE FUNCTION recipes_recipe_search_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := {POSTGRESQL_VECTOR};
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql''',
+    '''CREATE TRIGGER recipes_recipe_search_update
+    BEFORE INSERT OR UPDATE OF name, text ON recipes_recipe
+    FOR EACH ROW EXECUTE PROCEDURE recipes_recipe_search_update()''',
+    'UPDATE recipes_recipe SET name = name',
+    'CREATE INDEX recipe_search_idx ON recipes_recipe '
+    'USING gin (search_vector)',
+)
+POSTGRESQL_BACKWARD = (
+    'DROP TRIGGER IF EXISTS recipes_recipe_search_update ON recipes_recipe',
+    'DROP FUNCTION IF EXISTS recipes_recipe_search_update()',
+    'ALTER TABLE recipes_recipe DROP COLUMN IF EXISTS search_vector',
+)
+
+
+def sqlite_values(prefix):
+    return f"{prefix}.id, {normalized(f'{prefix}.name')}, " \
+           f"{normalized(f'{prefix}.text')}"
+
+
+# FTS5 без собственного хранения: в индекс пишутся нормализованные строки
+SQLITE_FORWARD = (
+    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(name, text, content='', "
+    f"tokenize='unicode61 remove_diacritics 2')",
+    f'''CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON recipes_recipe
+    BEGIN
+        INSERT INTO {FTS_TABLE} (rowid, name, text)
+        VALUES ({sqlite_values('new')});
+    END''',
+    f'''CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON recipes_recipe
+    BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, name, text)
+        VALUES ('delete', {sqlite_values('old')});
+    END''',
+    f'''CREATE TRIGGER {FTS_TABLE}_update
+    AFTER UPDATE OF name, text ON recipes_recipe
+    BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, name, text)
+        VALUES ('delete', {sqlite_values('old')});
+        INSERT INTO {FTS_TABLE} (rowid, name, text)
+        VALUES ({sqlite_values('new')});
+    END''',
+    f'INSERT INTO {FTS_TABLE} (rowid, name, text) '
+    f'SELECT {sqlite_values("recipes_recipe")} FROM recipes_recipe',
+)
+SQLITE_BACKWARD = (
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_insert',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_delete',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_update',
+    f'DROP TABLE IF EXISTS {FTS_TABLE}',
+)
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for statement in statements.get(vendor, ()):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'postgresql': POSTGRESQL_FORWARD,
+                 'sqlite': SQLITE_FORWARD}),
+            run({'postgresql': POSTGRESQL_BACKWARD,
+                 'sqlite': SQLITE_BACKWARD})),
+    ]
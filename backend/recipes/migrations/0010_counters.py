@@ -0,0 +1,39 @@
+# Generated by Django 3.2.17 on 2026-10-18 03:51
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def _count(model, link):
+    return Coalesce(Subquery(model.objects.filter(
+        **{link: OuterRef('pk')}).order_by().values(link).annotate(
+        total=Count('*')).values('total')), 0)
+
+
+def fill_counters(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Follow = apps.get_model('recipes', 'Follow')
+    Favorite = apps.get_model('recipes', 'Favorite')
+    User.objects.update(
+        recipes_count=_count(Recipe, 'author'),
+        followers_count=_count(Follow, 'author'))
+    Recipe.objects.update(favorites_count=_count(Favorite, 'recipe'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_feed_entry'),
+        ('users', '0002_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='в избранном'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 3.2.17 on 2026-10-18 03:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def _count(model):
+    return Coalesce(Subquery(model.objects.filter(
+        recipe=OuterRef('pk')).order_by().values('recipe').annotate(
+        total=Count('*')).values('total')), 0)
+
+
+def fill_scores(apps, schema_editor):
+    # у избранного и списка покупок нет даты добавления, поэтому оценка
+    # «в тренде» начинается с нуля
+    Recipe = apps.get_model('recipes', 'Recipe')
+    RecipeScore = apps.get_model('recipes', 'RecipeScore')
+    Favorite = apps.get_model('recipes', 'Favorite')
+    ShoppingCart = apps.get_model('recipes', 'ShoppingCart')
+    scores = Recipe.objects.annotate(
+        favorites=_count(Favorite), carts=_count(ShoppingCart)).values_list(
+        'id', 'favorites', 'carts')
+    RecipeScore.objects.bulk_create(
+        (RecipeScore(recipe_id=recipe_id, popular=favorites + carts)
+         for recipe_id, favorites, carts in scores.iterator()),
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeScore',
+            fields=[
+                ('recipe', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='score', serialize=False, to='recipes.recipe')),
+                ('popular', models.PositiveIntegerField(default=0)),
+                ('trending', models.FloatField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Оценка рецепта',
+                'verbose_name_plural': 'Оценки рецептов',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='recipescore',
+            index=models.Index(fields=['-popular', '-recipe'], name='score_popular_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipescore',
+            index=models.Index(fields=['-trending', '-recipe'], name='score_trending_idx'),
+        ),
+        migrations.RunPython(fill_scores, migrations.RunPython.noop),
+    ]
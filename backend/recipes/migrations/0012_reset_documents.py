@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+def reset_documents(apps, schema_editor):
+    # в image теперь оригинал, а не копия для карточки: документы
+    # пересоберутся при первом чтении
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Recipe.objects.update(document={})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0011_recipe_score'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_documents, migrations.RunPython.noop),
+    ]
@@ -2,7 +2,11 @@ from colorfield.fields import ColorField
 from django.conf import settings
 from django.core.validators import MinValueValidator
 from django.db import models
-from django.db.models import F, Q
+from django.db.models import F, Q, Sum
+
+from users.models import CounterFieldsMixin
+
+from .storage import ContentAddressedStorage
 
 
 class Ingredient(models.Model):
@@ -17,6 +21,8 @@ class Ingredient(models.Model):
     class Meta:
         verbose_name_plural = 'Ингредиенты'
         verbose_name = 'Ингредиент'
+        indexes = (models.Index(fields=('name', 'measurement_unit'),
+                                name='ingredient_name_unit_idx'),)
 
 
 class Tag(models.Model):
@@ -33,7 +39,7 @@ class Tag(models.Model):
         verbose_name = 'Тег'
 
 
-class Recipe(models.Model):
+class Recipe(CounterFieldsMixin, models.Model):
     """Модель рецепта."""
     name = models.CharField(max_length=200, verbose_name='название рецепта')
     text = models.TextField(verbose_name='описание рецепта')
@@ -46,7 +52,9 @@ class Recipe(models.Model):
 
     image = models.ImageField(
         'Картинка',
-        upload_to='recipes/'
+        upload_to='recipes/',
+        storage=ContentAddressedStorage(),
+        db_index=True
     )
     ingredients = models.ManyToManyField(
         Ingredient,
@@ -55,6 +63,15 @@ class Recipe(models.Model):
         Tag, through='TagRecipe')
     cooking_time = models.PositiveSmallIntegerField(
         validators=(MinValueValidator(1),))
+    document = models.JSONField(
+        default=dict, blank=True, editable=False,
+        verbose_name='готовое представление рецепта')
+    image_variants = models.JSONField(
+        default=dict, blank=True, editable=False,
+        verbose_name='уменьшенные копии картинки')
+    favorites_count = models.PositiveIntegerField(
+        'в избранном', default=0, editable=False)
+    counter_fields = ('favorites_count',)
 
     def __str__(self):
         return f'{self.name}-{self.text[:15]}'
@@ -63,6 +80,12 @@ class Recipe(models.Model):
         ordering = ['-pub_date']
         verbose_name_plural = 'Рецепты'
         verbose_name = 'Рецепт'
+        indexes = (
+            models.Index(fields=('-pub_date', '-id'),
+                         name='recipe_pub_date_idx'),
+            models.Index(fields=('author', '-pub_date', '-id'),
+                         name='recipe_author_pub_date_idx'),
+        )
 
 
 class Follow(models.Model):
@@ -102,6 +125,18 @@ class IngredientRecipe(models.Model):
     amount = models.PositiveSmallIntegerField(validators=(MinValueValidator(1),),
                                               error_messages={'invalid': 'Выберите целое значение больше 1'})
 
+    class Meta:
+        # покрывает суммирование списка покупок без чтения таблицы
+        indexes = (models.Index(fields=('recipe', 'ingredients', 'amount'),
+                                name='ingredientrecipe_recipe_idx'),)
+
+    @classmethod
+    def amounts(cls, recipe_id):
+        """Количества ингредиентов рецепта: {id ингредиента: сумма}."""
+        return dict(cls.objects.filter(recipe_id=recipe_id).values(
+            'ingredients').annotate(total=Sum('amount')).values_list(
+            'ingredients', 'total'))
+
 
 class TagRecipe(models.Model):
     """Модель manytomany связывает тег и рецепт."""
@@ -114,6 +149,10 @@ class TagRecipe(models.Model):
         on_delete=models.CASCADE,
         related_name='tag_recipe')
 
+    class Meta:
+        indexes = (models.Index(fields=('tags', 'recipe'),
+                                name='tagrecipe_tag_recipe_idx'),)
+
     def __str__(self):
         return f'{self.tags} {self.recipe}'
 
@@ -160,3 +199,116 @@ class ShoppingCart(models.Model):
         ),)
         verbose_name = 'Список покупок'
         verbose_name_plural = 'Список покупок'
+
+
+class ShoppingListItem(models.Model):
+    """Итог списка покупок пользователя по ингредиенту.
+
+    Поддерживается при добавлении и удалении рецептов из списка покупок и
+    при изменении ингредиентов таких рецептов.
+    """
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='shopping_list'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shopping_list_items'
+    )
+    amount = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = (models.UniqueConstraint(
+            fields=['user', 'ingredient'],
+            name='user_ingredient_shopping_list',
+        ),)
+        verbose_name = 'Итог списка покупок'
+        verbose_name_plural = 'Итоги списков покупок'
+
+
+class FeedEntry(models.Model):
+    """Рецепт в ленте подписчика.
+
+    Записи появляются при публикации рецепта и при подписке на автора.
+    Автор и дата публикации повторяют поля рецепта, чтобы лента читалась
+    по одному индексу.
+    """
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='feed'
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feed_entries'
+    )
+    author = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        constraints = (models.UniqueConstraint(
+            fields=['user', 'recipe'],
+            name='user_recipe_feed',
+        ),)
+        indexes = (
+            models.Index(fields=('user', '-pub_date', '-recipe'),
+                         name='feed_user_pub_date_idx'),
+            models.Index(fields=('user', 'author'),
+                         name='feed_user_author_idx'),
+        )
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Ленты подписок'
+
+
+class RecipeScore(models.Model):
+    """Оценки рецепта для сортировки «популярные» и «в тренде».
+
+    popular — сколько раз рецепт сейчас в избранном и списках покупок;
+    trending — добавления туда же, вес которых убывает со временем.
+    """
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='score'
+    )
+    popular = models.PositiveIntegerField(default=0)
+    trending = models.FloatField(default=0)
+
+    class Meta:
+        indexes = (
+            models.Index(fields=('-popular', '-recipe'),
+                         name='score_popular_idx'),
+            models.Index(fields=('-trending', '-recipe'),
+                         name='score_trending_idx'),
+        )
+        verbose_name = 'Оценка рецепта'
+        verbose_name_plural = 'Оценки рецептов'
+
+
+class ImageFile(models.Model):
+    """Строка-замок для файла картинки рецепта.
+
+    Сохранение картинки и удаление файла, на который больше не ссылаются
+    рецепты, блокируют эту строку до конца своей транзакции. Поэтому файл
+    не удаляется, пока другая транзакция сохраняет рецепт с ним же.
+    """
+    name = models.CharField(max_length=255, primary_key=True)
+
+    class Meta:
+        verbose_name = 'Файл картинки'
+        verbose_name_plural = 'Файлы картинок'
+
+    @classmethod
+    def lock(cls, name):
+        """Блокирует строку файла до конца текущей транзакции."""
+        _, created = cls.objects.get_or_create(name=name)
+        if not created:
+            cls.objects.select_for_update().get(name=name)
@@ -0,0 +1,117 @@
+"""Полнотекстовый поиск рецептов по названию и описанию.
+
+Индекс поддерживается триггерами базы данных (см. миграцию
+0005_recipe_search): на PostgreSQL это колонка search_vector с GIN-индексом
+и русской конфигурацией, на SQLite — таблица FTS5. Буквы «ё» и «е» не
+различаются.
+
+SQLite не умеет многие ALTER TABLE, и миграции Django пересоздают таблицу
+рецептов — вместе со старой таблицей пропадают и триггеры. Поэтому после
+каждого migrate restore_sqlite_triggers создаёт недостающие триггеры и
+заново заполняет индекс.
+"""
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'recipes_recipe_fts'
+WORD = re.compile(r'\w+')
+
+
+def _sqlite_values(prefix):
+    return ', '.join(
+        [f'{prefix}.id'] + [
+            f"replace(replace({prefix}.{column}, 'ё', 'е'), 'Ё', 'Е')"
+            for column in ('name', 'text')])
+
+
+SQLITE_TRIGGERS = {
+    f'{FTS_TABLE}_insert': f'''AFTER INSERT ON recipes_recipe
+    BEGIN
+        INSERT INTO {FTS_TABLE} (rowid, name, text)
+        VALUES ({_sqlite_values('new')});
+    END''',
+    f'{FTS_TABLE}_delete': f'''AFTER DELETE ON recipes_recipe
+    BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, name, text)
+        VALUES ('delete', {_sqlite_values('old')});
+    END''',
+    f'{FTS_TABLE}_update': f'''AFTER UPDATE OF name, text ON recipes_recipe
+    BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, name, text)
+        VALUES ('delete', {_sqlite_values('old')});
+        INSERT INTO {FTS_TABLE} (rowid, name, text)
+        VALUES ({_sqlite_values('new')});
+    END''',
+}
+
+
+def restore_sqlite_triggers(connection):
+    """Создаёт пропавшие триггеры FTS5 и перестраивает индекс.
+
+    Возвращает True, если триггеры пришлось создавать.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', "
+            "'trigger') AND name IN (%s)" % ', '.join(
+                ['%s'] * (len(SQLITE_TRIGGERS) + 1)),
+            [FTS_TABLE, *SQLITE_TRIGGERS])
+        existing = {name for name, in cursor.fetchall()}
+        if FTS_TABLE not in existing or existing >= set(SQLITE_TRIGGERS):
+            return False
+        for name, body in SQLITE_TRIGGERS.items():
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+        # без триггеров индекс мог разойтись с таблицей
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('delete-all')")
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, name, text) '
+            f'SELECT {_sqlite_values("recipes_recipe")} FROM recipes_recipe')
+    return True
+
+
+def normalize(query):
+    return query.replace('ё', 'е').replace('Ё', 'Е')
+
+
+def search_recipes(queryset, query):
+    """Рецепты, подходящие под запрос, с аннотацией search_rank.
+
+    Чем больше search_rank, тем релевантнее рецепт.
+    """
+    words = WORD.findall(normalize(query))
+    if not words:
+        return queryset
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        tsquery = "websearch_to_tsquery('russian', %s)"
+        text = ' '.join(words)
+        return queryset.annotate(
+            search_match=RawSQL(
+                f'"{table}"."search_vector" @@ {tsquery}', (text,),
+                output_field=BooleanField()),
+            search_rank=RawSQL(
+                f'ts_rank("{table}"."search_vector", {tsquery})', (text,),
+                output_field=FloatField()),
+        ).filter(search_match=True)
+    if connection.vendor == 'sqlite':
+        # каждое слово ищется как префикс: стемминга в FTS5 нет
+        match = ' '.join(f'"{word}"*' for word in words)
+        return queryset.annotate(
+            search_match=RawSQL(
+                f'"{table}"."id" IN (SELECT rowid FROM {FTS_TABLE} '
+                f'WHERE {FTS_TABLE} MATCH %s)', (match,),
+                output_field=BooleanField()),
+            search_rank=RawSQL(
+                f'(SELECT -bm25({FTS_TABLE}, 10.0, 1.0) FROM {FTS_TABLE} '
+                f'WHERE {FTS_TABLE} MATCH %s AND rowid = "{table}"."id")',
+                (match,), output_field=FloatField()),
+        ).filter(search_match=True)
+    condition = Q()
+    for word in words:
+        condition &= Q(name__icontains=word) | Q(text__icontains=word)
+    return queryset.filter(condition).annotate(
+        search_rank=RawSQL('0', (), output_field=FloatField()))
@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+# отправляется после того, как рецепт сохранён вместе с ингредиентами и
+# тегами: аргументы instance, created и old_amounts — количества
+# ингредиентов до изменения {id: количество} или None, если они неизвестны
+recipe_saved = Signal()
+
+# отправляется после массовой загрузки ингредиентов в обход save()
+ingredients_loaded = Signal()
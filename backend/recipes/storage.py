@@ -0,0 +1,43 @@
+import hashlib
+import posixpath
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Хранилище, в котором имя файла — хэш его содержимого.
+
+    Файл сохраняется как <папка>/<ab>/<sha256>.<расширение>; одинаковые
+    картинки хранятся один раз, а содержимое по адресу никогда не меняется.
+    Сохранение блокирует строку ImageFile до конца транзакции, чтобы файл
+    не удалили как ненужный, пока рецепт с ним не записан.
+    """
+
+    def save(self, name, content, max_length=None):
+        digest = hashlib.sha256()
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        digest = digest.hexdigest()
+        directory, filename = posixpath.split(name.replace('\\', '/'))
+        extension = posixpath.splitext(filename)[1].lower()
+        name = posixpath.join(directory, digest[:2], digest + extension)
+        with transaction.atomic():
+            apps.get_model('recipes', 'ImageFile').lock(name)
+            if self.exists(name):
+                return name
+            return super().save(name, content, max_length)
+
+    def save_derived(self, name, content):
+        """Сохраняет файл, производный от уже адресованного, под его именем.
+        """
+        if self.exists(name):
+            return name
+        return super().save(name, content)
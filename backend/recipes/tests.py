@@ -0,0 +1,120 @@
+import os
+import re
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.test import TestCase
+
+from users.models import User
+
+from .models import Ingredient, IngredientRecipe, Recipe, ShoppingListItem
+
+ORDERING = ('-pub_date', '-id')
+# строки плана SQLite вида «SCAN recipes_recipe» без индекса
+SQLITE_FULL_SCAN = re.compile(r'SCAN (?:TABLE )?(\w+)\s*$', re.MULTILINE)
+
+
+class HotQueryIndexTest(TestCase):
+    """Горячие запросы читают таблицы по индексам, а не целиком."""
+
+    def explain(self, queryset):
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # на маленьких таблицах планировщик и так выберет Seq Scan;
+                # проверяем, что индекс для запроса вообще есть
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+            return queryset.explain()
+
+    def full_scans(self, plan):
+        if connection.vendor == 'postgresql':
+            return re.findall(r'Seq Scan on (\w+)', plan)
+        return SQLITE_FULL_SCAN.findall(plan)
+
+    def assertUsesIndex(self, queryset, index):
+        plan = self.explain(queryset)
+        self.assertIn(index, plan)
+        self.assertEqual(self.full_scans(plan), [], plan)
+
+    def test_recipe_list(self):
+        self.assertUsesIndex(
+            Recipe.objects.order_by(*ORDERING)[:6], 'recipe_pub_date_idx')
+
+    def test_recipes_by_author(self):
+        self.assertUsesIndex(
+            Recipe.objects.filter(author_id=1).order_by(*ORDERING)[:6],
+            'recipe_author_pub_date_idx')
+
+    def test_recipes_by_tag(self):
+        self.assertUsesIndex(
+            Recipe.objects.filter(tags__slug='breakfast').order_by(
+                *ORDERING)[:6],
+            'tagrecipe_tag_recipe_idx')
+
+    def test_shopping_list_totals(self):
+        self.assertUsesIndex(
+            IngredientRecipe.objects.filter(recipe_id=1).values(
+                'ingredients').annotate(total=Sum('amount')),
+            'ingredientrecipe_recipe_idx')
+
+    def test_ingredient_lookup(self):
+        # так загрузка ингредиентов и рецептов ищет существующие
+        self.assertUsesIndex(
+            Ingredient.objects.filter(name='соль', measurement_unit='г'),
+            'ingredient_name_unit_idx')
+
+
+class LoadIngredientsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='cook', email='cook@example.com', password='password')
+        cls.salt = Ingredient.objects.create(
+            name='соль', measurement_unit='г')
+        cls.sugar = Ingredient.objects.create(
+            name='сахар', measurement_unit='г')
+        cls.pepper = Ingredient.objects.create(
+            name='перец', measurement_unit='г')
+        recipe = Recipe.objects.create(
+            author=cls.user, name='Рецепт', text='Описание',
+            cooking_time=5, image='recipes/test.png')
+        IngredientRecipe.objects.create(
+            recipe=recipe, ingredients=cls.pepper, amount=1)
+
+    def load(self, rows, **options):
+        with tempfile.NamedTemporaryFile(
+                'w', suffix='.csv', encoding='utf-8', delete=False) as source:
+            source.write(rows)
+        self.addCleanup(os.remove, source.name)
+        output = StringIO()
+        call_command('load_ingredients', source.name, stdout=output,
+                     batch_size=2, **options)
+        return output.getvalue()
+
+    def catalogue(self):
+        return set(Ingredient.objects.values_list(
+            'name', 'measurement_unit'))
+
+    def test_upsert_adds_only_new_pairs(self):
+        output = self.load(
+            'соль,г\nмолоко,мл\nмолоко,мл\nмолоко,л\n,г\nмука\n')
+        self.assertIn('добавлено: 2', output)
+        self.assertIn('пропущено: 2', output)
+        self.assertEqual(self.catalogue(), {
+            ('соль', 'г'), ('сахар', 'г'), ('перец', 'г'), ('молоко', 'мл'),
+            ('молоко', 'л')})
+
+    def test_resync_removes_unused_missing(self):
+        # итог списка покупок удаляется вместе с ингредиентом
+        ShoppingListItem.objects.create(
+            user=self.user, ingredient=self.sugar, amount=0)
+        output = self.load('соль,г\nмолоко,мл\n', mode='resync')
+        self.assertIn('удалено: 1', output)
+        # перец не в файле, но используется в рецепте
+        self.assertEqual(self.catalogue(), {
+            ('соль', 'г'), ('перец', 'г'), ('молоко', 'мл')})
+        self.assertFalse(ShoppingListItem.objects.exists())
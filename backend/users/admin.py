@@ -15,3 +15,10 @@ class UserAdmin(admin.ModelAdmin):
     search_fields = ('username', 'email',)
     list_filter = ('username',)
     empty_value_display = '-пусто-'
+    actions = ('deactivate',)
+
+    @admin.action(description='Заблокировать выбранных пользователей')
+    def deactivate(self, request, queryset):
+        # QuerySet.update() отзывает токены через сигнал users_updated
+        updated = queryset.update(is_active=False)
+        self.message_user(request, f'Заблокировано пользователей: {updated}')
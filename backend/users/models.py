@@ -1,6 +1,8 @@
 from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import UserManager as BaseUserManager
 from django.db import models
 
+from .signals import users_updated
 from .validators import validate_username
 
 USER = 'user'
@@ -11,7 +13,53 @@ USER_TYPE = [
 ]
 
 
-class User(AbstractUser):
+class CounterFieldsMixin:
+    """Полный save() не записывает денормализованные счётчики.
+
+    Счётчики из counter_fields меняются только выражениями F() в
+    api.counters, а объект в памяти может держать их устаревшими: например,
+    пользователь из кэша токенов. Поэтому save() без update_fields пишет все
+    поля, кроме счётчиков; явно переданные update_fields не меняются.
+    """
+    counter_fields = ()
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        if (update_fields is None and not force_insert
+                and not self._state.adding):
+            deferred = self.get_deferred_fields()
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields
+                and field.attname not in deferred]
+        super().save(force_insert, force_update, using, update_fields)
+
+
+class UserQuerySet(models.QuerySet):
+
+    def update(self, **kwargs):
+        """update() в обход save() сообщает о себе сигналом users_updated.
+
+        Счётчики меняются часто и ни на что, кроме себя, не влияют, поэтому
+        их обновление сигнал не отправляет.
+        """
+        # у исторических моделей в миграциях counter_fields нет
+        if set(kwargs) <= set(getattr(self.model, 'counter_fields', ())):
+            return super().update(**kwargs)
+        user_ids = list(self.values_list('id', flat=True))
+        rows = super().update(**kwargs)
+        if user_ids:
+            users_updated.send(sender=self.model, user_ids=user_ids,
+                               fields=frozenset(kwargs))
+        return rows
+
+
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
+    pass
+
+
+class User(CounterFieldsMixin, AbstractUser):
     """ Модель Пользователя. """
     username = models.CharField(
         max_length=150,
@@ -44,8 +92,15 @@ class User(AbstractUser):
         default=USER,
         blank=True,
     )
+    recipes_count = models.PositiveIntegerField(
+        'число рецептов', default=0, editable=False)
+    followers_count = models.PositiveIntegerField(
+        'число подписчиков', default=0, editable=False, db_index=True)
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
+    counter_fields = ('recipes_count', 'followers_count')
+
+    objects = UserManager()
 
     @property
     def is_user(self):
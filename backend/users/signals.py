@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# отправляется после QuerySet.update() пользователей в обход save():
+# аргументы user_ids и fields — множество изменённых полей
+users_updated = Signal()